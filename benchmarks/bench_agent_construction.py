@@ -0,0 +1,67 @@
+'''
+compares building the ReAct agent per query with ReActAgent.from_tools against AgentFactory.create_agent
+
+each round builds an agent for a session context and renders the prompt of a few reasoning steps,
+which is what a query pays before and between its LLM calls. memory is the peak traced allocation
+of one round. no request is sent, the llm is only constructed
+
+usage: python benchmarks/bench_agent_construction.py
+'''
+
+import logging
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+os.environ.setdefault("TOGETHER_API_KEY", "benchmark")
+
+from llama_index.core.agent import ReActAgent
+
+import aitools
+import llm
+from agent_factory import AGENT_TOOL_NAMES, agent_factory
+
+ROUNDS = 200
+REASONING_STEPS = 3
+CONTEXT = "originLocation: Paris (CDG), destination: Tokyo, departure: 2025-05-01, adults: 2"
+
+def build_with_from_tools():
+    agent = ReActAgent.from_tools([aitools.get_tool(name) for name in AGENT_TOOL_NAMES], llm=llm.get_llm(), verbose=True, context=CONTEXT, max_iterations=20)
+    return agent, agent.agent_worker
+
+def build_with_factory():
+    agent = agent_factory.create_agent(CONTEXT)
+    return agent, agent.agent_worker
+
+def run_round(build):
+    agent, worker = build()
+    for _ in range(REASONING_STEPS):
+        worker._react_chat_formatter.format(worker.get_tools(""), agent.memory.get())
+
+def measure(build) -> tuple[float, float]:
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        run_round(build)
+    elapsed_us = (time.perf_counter() - start) / ROUNDS * 1e6
+
+    tracemalloc.start()
+    run_round(build)
+    peak_kb = tracemalloc.get_traced_memory()[1] / 1024
+    tracemalloc.stop()
+    return elapsed_us, peak_kb
+
+if __name__ == "__main__":
+    # from_context logs a deprecation warning per agent, keep it out of the output but not out of the timing
+    logging.getLogger("llama_index").addHandler(logging.NullHandler())
+    logging.getLogger("llama_index").propagate = False
+
+    # both paths share the same tools and llm, only the per query work is compared
+    run_round(build_with_from_tools)
+    run_round(build_with_factory)
+
+    print(f"{'per query, ' + str(REASONING_STEPS) + ' prompt renders':34} {'us':>10} {'peak KB':>10}")
+    for name, build in (("ReActAgent.from_tools", build_with_from_tools), ("AgentFactory.create_agent", build_with_factory)):
+        elapsed_us, peak_kb = measure(build)
+        print(f"{name:34} {elapsed_us:10.1f} {peak_kb:10.1f}")
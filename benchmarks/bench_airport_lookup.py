@@ -0,0 +1,59 @@
+'''
+compares the AirportIndex lookup against the previous linear scan over airportsdata
+
+the linear scan only finds exact full airport names, the index also resolves codes,
+cities, prefixes and misspellings, so the "found" column is reported for both
+
+usage: python benchmarks/bench_airport_lookup.py
+'''
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import airportsdata
+
+from airport_index import AirportIndex
+from airport_table import AirportTable, compile_airport_table
+
+QUERIES = [
+    "John F Kennedy International Airport",
+    "JFK",
+    "RJTT",
+    "Tokyo",
+    "osaka",
+    "heathrow",
+    "londn heathrow",
+    "Singapore",
+    "kuala lumpur",
+    "San Francisco",
+]
+REPEAT = 200
+
+def linear_scan(airports: dict, airport_name: str):
+    for code, airport in airports.items():
+        if airport['name'] == airport_name:
+            return code
+    return None
+
+def time_per_call(fn, query: str) -> float:
+    start = time.perf_counter()
+    for _ in range(REPEAT):
+        result = fn(query)
+    return (time.perf_counter() - start) / REPEAT * 1e6, result
+
+if __name__ == "__main__":
+    airports = airportsdata.load('IATA')
+
+    start = time.perf_counter()
+    airport_index = AirportIndex(AirportTable(compile_airport_table(airports)))
+    print(f"table compile: {(time.perf_counter() - start) * 1e3:.1f} ms over {len(airports)} airports\n")
+
+    print(f"{'query':38} | {'scan us':>9} {'found':>6} | {'index us':>9} {'best':>6}")
+    for query in QUERIES:
+        scan_us, scan_result = time_per_call(lambda q: linear_scan(airports, q), query)
+        index_us, index_result = time_per_call(lambda q: airport_index.search(q, limit=5), query)
+        best = index_result[0]["iata"] if index_result else "-"
+        print(f"{query:38} | {scan_us:9.1f} {scan_result or '-':>6} | {index_us:9.1f} {best:>6}")
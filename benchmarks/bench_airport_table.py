@@ -0,0 +1,76 @@
+'''
+measures what the airport search costs a worker on boot: time to first search and memory added
+
+every run is a fresh interpreter that imports numpy first (the app needs it anyway), then times
+get_airport_index() and one search. memory is read from /proc/self/smaps_rollup: rss is every
+resident page, anonymous is the part no other process can share. pages of the mapped airport table
+are file backed, so they are not anonymous and are shared by every worker through the page cache.
+pass the src directory of another checkout to compare against it, e.g. the tree before the table:
+
+    git worktree add /tmp/before <commit>
+    python benchmarks/bench_airport_table.py /tmp/before/src
+    python benchmarks/bench_airport_table.py
+
+usage: python benchmarks/bench_airport_table.py [src_dir]
+'''
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+SRC_DIR = os.path.abspath(sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(__file__), "..", "src"))
+RUNS = 5
+
+WORKER_SCRIPT = '''
+import json
+import time
+
+import numpy
+
+def memory_kb() -> dict:
+    fields = {}
+    with open("/proc/self/smaps_rollup") as smaps:
+        for line in smaps:
+            parts = line.split()
+            if len(parts) == 3 and parts[0].endswith(":"):
+                fields[parts[0][:-1]] = int(parts[1])
+    return fields
+
+import airport_index
+
+before = memory_kb()
+start = time.perf_counter()
+airport_index.get_airport_index().search("tokyo")
+elapsed = time.perf_counter() - start
+after = memory_kb()
+print(json.dumps({"seconds": elapsed, "rss_kb": after["Rss"] - before["Rss"], "anonymous_kb": after["Anonymous"] - before["Anonymous"]}))
+'''
+
+def run_worker(env: dict) -> dict:
+    result = subprocess.run([sys.executable, "-c", WORKER_SCRIPT], cwd=SRC_DIR, env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+if __name__ == "__main__":
+    with tempfile.TemporaryDirectory() as directory:
+        env = dict(os.environ, AIRPORT_TABLE_PATH=os.path.join(directory, "airports.table"))
+
+        if os.path.exists(os.path.join(SRC_DIR, "airport_table.py")):
+            sys.path.insert(0, SRC_DIR)
+            from airport_table import build_airport_table
+
+            start = time.perf_counter()
+            path = build_airport_table(env["AIRPORT_TABLE_PATH"])
+            print(f"build step: {(time.perf_counter() - start) * 1e3:.0f} ms, {os.path.getsize(path) / 1e6:.2f} MB table\n")
+
+        runs = [run_worker(env) for _ in range(RUNS)]
+        runs.sort(key=lambda run: run["seconds"])
+        median = runs[len(runs) // 2]
+        print(f"{SRC_DIR}, median of {RUNS} fresh workers:")
+        print(f"first search:     {median['seconds'] * 1e3:8.1f} ms")
+        print(f"rss added:        {median['rss_kb'] / 1024:8.1f} MB")
+        print(f"anonymous added:  {median['anonymous_kb'] / 1024:8.1f} MB (not shareable between workers)")
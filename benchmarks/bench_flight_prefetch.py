@@ -0,0 +1,101 @@
+'''
+times a query turn whose summary completes the flight slots, with and without the speculative flight prefetch
+
+the summary is streamed by a fake llm at a fixed token rate and Amadeus answers after a fixed
+latency, both in process so nothing but the turn itself is measured. every turn uses a fresh
+conversation and date so no cache is warm. "after summary" is what the user waits between the
+last summary token and the flights in the message
+
+usage: python benchmarks/bench_flight_prefetch.py [--turns N] [--tokens-per-second N] [--amadeus-latency S]
+'''
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+sys.path.insert(0, os.path.dirname(__file__))
+os.environ["COMPLETION_CACHE_SIZE"] = "0"
+
+import ai
+from amadeus_client import amadeus_client
+import llm
+import prefetch
+import session_manager
+import utilities
+from stub_servers import stub_flight_offer, tokenize
+
+class StreamedDelta:
+    def __init__(self, delta: str):
+        self.delta = delta
+
+class FakeLLM:
+    def __init__(self, tokens_per_second: float):
+        self.tokens_per_second = tokens_per_second
+        self.summaries = []
+        self.summary_done_at = 0.0
+
+    async def astream_complete(self, prompt: str):
+        summary = self.summaries.pop(0)
+
+        async def stream():
+            for token in tokenize(summary):
+                await asyncio.sleep(1 / self.tokens_per_second)
+                yield StreamedDelta(token)
+            self.summary_done_at = time.perf_counter()
+        return stream()
+
+def summary_text(turn: int) -> str:
+    # the order of the summary prompt: the flight slots, the travel class, then the confirmation question
+    return "\n".join([
+        "Here is a summary of your trip so far.",
+        "origin: Paris",
+        "destination: Tokyo",
+        "date: 2027-%02d-%02d" % (turn % 12 + 1, turn % 28 + 1),
+        "adults: " + str(turn % 3 + 1),
+        "travel class: economy",
+        "Does everything look right? Once you confirm I will look for the best flights and then we can move on to your hotel in Tokyo.",
+    ])
+
+async def run_turns(fake_llm: FakeLLM, turns: int, offset: int) -> tuple[float, float]:
+    totals = []
+    waits = []
+    for turn in range(offset, offset + turns):
+        conversation_id = "bench-" + str(turn)
+        current_session = session_manager.session_controller.create_session(conversation_id)
+        fake_llm.summaries.append(summary_text(turn))
+        start = time.perf_counter()
+        await ai.handle_query(current_session, "paris to tokyo, " + str(turn))
+        end = time.perf_counter()
+        assert any(isinstance(response, utilities.PossibleFlightsMessage) for response in current_session.messages[-1].responses)
+        totals.append(end - start)
+        waits.append(end - fake_llm.summary_done_at)
+    return sum(totals) / turns, sum(waits) / turns
+
+async def main(arguments):
+    fake_llm = FakeLLM(arguments.tokens_per_second)
+    llm.get_llm = lambda: fake_llm
+
+    async def get(url: str, params: dict) -> dict:
+        await asyncio.sleep(arguments.amadeus_latency)
+        return {"data": [
+            stub_flight_offer(str(index), params["originLocationCode"], params["destinationLocationCode"], params["departureDate"])
+            for index in range(params.get("max", 3))
+        ]}
+    amadeus_client.get = get
+
+    print(f"{'prefetch':10} | {'turn ms':>9} | {'after summary ms':>17}")
+    for offset, enabled in enumerate((False, True)):
+        prefetch.FLIGHT_PREFETCH_ENABLED = enabled
+        total, wait = await run_turns(fake_llm, arguments.turns, offset * arguments.turns)
+        print(f"{'on' if enabled else 'off':10} | {total * 1e3:9.1f} | {wait * 1e3:17.1f}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--turns", type=int, default=10)
+    parser.add_argument("--tokens-per-second", type=float, default=50.0)
+    parser.add_argument("--amadeus-latency", type=float, default=1.0)
+    arguments = parser.parse_args()
+    asyncio.run(main(arguments))
@@ -0,0 +1,63 @@
+'''
+times the GeoIndex lookups against a pure python haversine scan over airportsdata
+
+usage: python benchmarks/bench_geo_index.py
+'''
+
+import math
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import airportsdata
+
+from airport_table import get_airport_table
+from geo_index import EARTH_RADIUS_KM, GeoIndex
+
+POINTS = [
+    ("Kyoto", 35.0116, 135.7681),
+    ("Paris", 48.8566, 2.3522),
+    ("Banff", 51.1784, -115.5708),
+    ("Cusco", -13.5320, -71.9675),
+]
+CITIES = ["Paris", "tokyo", "London", "Springfield", "Barcelna"]
+REPEAT = 500
+
+def haversine_scan(airports: dict, latitude: float, longitude: float, limit: int = 5) -> list[str]:
+    distances = []
+    for code, airport in airports.items():
+        dlat = math.radians(airport["lat"] - latitude)
+        dlon = math.radians(airport["lon"] - longitude)
+        a = math.sin(dlat / 2) ** 2 + math.cos(math.radians(latitude)) * math.cos(math.radians(airport["lat"])) * math.sin(dlon / 2) ** 2
+        distances.append((2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a)), code))
+    return [code for _, code in sorted(distances)[:limit]]
+
+def time_per_call(fn, *args) -> float:
+    start = time.perf_counter()
+    for _ in range(REPEAT):
+        result = fn(*args)
+    return (time.perf_counter() - start) / REPEAT * 1e6, result
+
+if __name__ == "__main__":
+    airports = airportsdata.load('IATA')
+    table = get_airport_table()
+
+    start = time.perf_counter()
+    geo_index = GeoIndex(table)
+    print(f"index build: {(time.perf_counter() - start) * 1e3:.1f} ms over {len(geo_index)} airports\n")
+
+    print(f"{'nearest 5 airports':20} | {'scan us':>9} | {'index us':>9} {'within 100 km us':>17} | closest")
+    for name, latitude, longitude in POINTS:
+        scan_us, scan_result = time_per_call(haversine_scan, airports, latitude, longitude)
+        index_us, index_result = time_per_call(geo_index.nearest, latitude, longitude)
+        within_us, _ = time_per_call(geo_index.within, latitude, longitude, 100)
+        assert scan_result == [airport["iata"] for airport in index_result]
+        print(f"{name:20} | {scan_us:9.1f} | {index_us:9.1f} {within_us:17.1f} | {', '.join(scan_result)}")
+
+    print(f"\n{'city':20} | {'locate us':>9} | best")
+    for city in CITIES:
+        locate_us, candidates = time_per_call(geo_index.locate_city, city)
+        best = candidates[0]["city"] + ", " + candidates[0]["country"] + " " + str((candidates[0]["latitude"], candidates[0]["longitude"])) if candidates else "-"
+        print(f"{city:20} | {locate_us:9.1f} | {best}")
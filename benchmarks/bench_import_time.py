@@ -0,0 +1,70 @@
+'''
+measures how long a worker takes to import the app and how much each lazy resource costs on first use
+
+every run happens in a fresh interpreter with the proxies pointed at a closed port, so any
+network access during import fails the run instead of silently slowing it down
+
+usage: python benchmarks/bench_import_time.py [runs]
+'''
+
+import os
+import subprocess
+import sys
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+RUNS = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+
+OFFLINE_ENV = dict(
+    os.environ,
+    HTTP_PROXY="http://127.0.0.1:9",
+    HTTPS_PROXY="http://127.0.0.1:9",
+    NO_PROXY="",
+)
+
+IMPORT_SCRIPT = '''
+import time
+start = time.perf_counter()
+import main
+print(time.perf_counter() - start)
+'''
+
+FIRST_USE_SCRIPT = '''
+import time
+import main, aitools, airport_index, llm
+
+def timed(label, fn):
+    start = time.perf_counter()
+    fn()
+    print(f"{label}: {(time.perf_counter() - start) * 1e3:.1f} ms")
+
+timed("airport index", airport_index.get_airport_index)
+timed("tools", lambda: [aitools.get_tool(name) for name in aitools.tool_functions])
+timed("llm client", llm.get_llm)
+'''
+
+def run(script: str) -> str:
+    result = subprocess.run([sys.executable, "-c", script], cwd=SRC_DIR, env=OFFLINE_ENV, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr)
+    return result.stdout
+
+def slowest_imports(limit: int = 10) -> list[str]:
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import main"], cwd=SRC_DIR, env=OFFLINE_ENV, capture_output=True, text=True)
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative_us, module = line.split("|")
+        rows.append((int(cumulative_us), module.strip()))
+    rows.sort(reverse=True)
+    return [f"{cumulative_us / 1e3:9.1f} ms  {module}" for cumulative_us, module in rows[:limit]]
+
+if __name__ == "__main__":
+    timings = sorted(float(run(IMPORT_SCRIPT).strip().splitlines()[-1]) for _ in range(RUNS))
+    print(f"import main (offline) over {RUNS} runs: min {timings[0] * 1e3:.0f} ms, median {timings[len(timings) // 2] * 1e3:.0f} ms\n")
+
+    print("first use of lazy resources:")
+    print(run(FIRST_USE_SCRIPT))
+
+    print("slowest imports (cumulative):")
+    print("\n".join(slowest_imports()))
@@ -0,0 +1,41 @@
+'''
+micro-benchmark for SessionController lookups
+
+creates 1k -> 1M sessions and measures the average latency of get_session for
+random existing ids. with the hash index the latency should stay flat as the
+number of sessions grows.
+
+usage: python benchmarks/bench_session_lookup.py
+'''
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import session_manager
+
+SESSION_COUNTS = [1_000, 10_000, 100_000, 1_000_000]
+LOOKUPS = 200_000
+
+def bench(session_count: int) -> float:
+    controller = session_manager.SessionController()
+    ids = [str(i).zfill(20) for i in range(session_count)]
+    for conversation_id in ids:
+        controller.create_session(conversation_id)
+
+    sample = [random.choice(ids) for _ in range(LOOKUPS)]
+    get_session = controller.get_session
+
+    start = time.perf_counter()
+    for conversation_id in sample:
+        get_session(conversation_id)
+    elapsed = time.perf_counter() - start
+    return elapsed / LOOKUPS * 1e9
+
+if __name__ == "__main__":
+    print(f"{'sessions':>10} | {'ns/lookup':>10}")
+    for count in SESSION_COUNTS:
+        print(f"{count:>10} | {bench(count):>10.1f}")
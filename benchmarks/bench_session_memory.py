@@ -0,0 +1,72 @@
+'''
+measures how many bytes a realistic session takes in memory and how long serving /message takes
+
+every session gets a few turns, each holding a summary, a handful of flight offers and places, which
+is roughly what a real conversation accumulates. pass the src directory of another checkout to
+compare against it, e.g. the tree before the slotted message model:
+
+    git worktree add /tmp/before <commit>
+    python benchmarks/bench_session_memory.py /tmp/before/src
+    python benchmarks/bench_session_memory.py
+
+usage: python benchmarks/bench_session_memory.py [src_dir]
+'''
+
+import gc
+import os
+import sys
+import time
+import tracemalloc
+
+SRC_DIR = sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(__file__), "..", "src")
+sys.path.insert(0, os.path.abspath(SRC_DIR))
+
+import session_manager
+import utilities
+
+SESSION_COUNT = 2_000
+TURNS = 4
+READS = 20_000
+
+# older trees stored the constructed dicts instead of the typed responses
+STORES_TYPED_RESPONSES = hasattr(session_manager.Message, "add_response")
+
+FLIGHT = {
+    "price": {"total": "412.35", "currency": "EUR"},
+    "itineraries": [{"duration": "PT7H25M", "segments": [{"departure": {"iataCode": "CDG", "at": "2024-07-01T10:00:00"}, "arrival": {"iataCode": "JFK", "at": "2024-07-01T12:25:00"}}]}],
+}
+PLACE = {"name": "Louvre Museum guided tour", "price": {"amount": "65.00", "currencyCode": "EUR"}, "geoCode": {"latitude": 48.86, "longitude": 2.33}}
+
+def add_response(session, response):
+    session.add_response(response if STORES_TYPED_RESPONSES else response.construct())
+
+def build_session(index: int):
+    session = session_manager.Session(str(index).zfill(20), [])
+    for turn in range(TURNS):
+        session.add_message(session_manager.Message("User", "I want to fly from Paris to New York on the first of July, turn " + str(turn)))
+        session.add_message(session_manager.Message("AI", "Here is what I found for your trip from Paris to New York. " * 3))
+        add_response(session, utilities.SummaryMessage("origin: Paris\ndestination: New York\ndate: 2024-07-01\nadults: 1"))
+        add_response(session, utilities.PossibleFlightsMessage([dict(FLIGHT) for _ in range(5)]))
+        add_response(session, utilities.PossiblePlacesMessage([dict(PLACE) for _ in range(5)]))
+    return session
+
+def read_latest_message(session):
+    if hasattr(session, "get_latest_message_json"):
+        return session.get_latest_message_json()
+    return session_manager.json.dumps({"message": session.get_latest_message()})
+
+if __name__ == "__main__":
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    sessions = [build_session(index) for index in range(SESSION_COUNT)]
+    gc.collect()
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    print(f"{SESSION_COUNT} sessions of {TURNS} turns: {used / SESSION_COUNT:,.0f} bytes per session")
+
+    session = sessions[0]
+    start = time.perf_counter()
+    for _ in range(READS):
+        read_latest_message(session)
+    print(f"serializing the latest message: {(time.perf_counter() - start) / READS * 1e6:.2f} us per read")
@@ -0,0 +1,275 @@
+'''
+offline load test of the whole service against stub Together and Amadeus servers
+
+starts the stubs (benchmarks/stub_servers.py) and the app in their own processes, points the app
+at the stubs through TOGETHER_API_BASE and AMADEUS_BASE_URL, then runs virtual users that create
+conversations, send queries, long-poll /chat-status, read /message and (some of them) follow
+the conversation websocket. the report gives p50/p95/p99 latencies per step, throughput and the
+event loop lag measured inside the app process
+
+usage:
+    pip install -r benchmarks/requirements.txt
+    python benchmarks/load_test.py --users 50 --duration 30 --llm-latency 0.5 --tokens-per-second 40
+
+any other setting of the app (JOB_WORKERS, caches, SESSION_STORE, ...) is read from the environment as usual.
+the completion cache is off unless COMPLETION_CACHE_SIZE is set, and every query names its own
+cities and a concrete date, so summaries go to the (stub) model and plain turns take the dispatch path
+'''
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+from collections import deque
+
+import httpx
+import websockets
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+SRC_DIR = os.path.join(BENCHMARKS_DIR, "..", "src")
+
+LOOP_LAG_INTERVAL = 0.01
+
+def free_port() -> int:
+    with socket.socket() as listener:
+        listener.bind(("127.0.0.1", 0))
+        return listener.getsockname()[1]
+
+def percentile(sorted_values: list[float], fraction: float) -> float:
+    if len(sorted_values) == 0:
+        return float("nan")
+    return sorted_values[min(int(fraction * len(sorted_values)), len(sorted_values) - 1)]
+
+# ---- processes under test ----
+
+def serve_stubs(port: int, args):
+    import uvicorn
+    from stub_servers import create_stub_app
+
+    app = create_stub_app(args.llm_latency, args.tokens_per_second, args.amadeus_latency)
+    uvicorn.run(app, host="127.0.0.1", port=port, log_level="warning")
+
+def serve_app(port: int):
+    '''
+    runs main.app with a sampler measuring how late the event loop wakes up, read through /_load_test/loop-lag
+    '''
+    import uvicorn
+
+    sys.path.insert(0, SRC_DIR)
+    import main
+
+    lag_samples = deque(maxlen=1_000_000)
+
+    async def sample_loop_lag():
+        loop = asyncio.get_running_loop()
+        while True:
+            started_at = loop.time()
+            await asyncio.sleep(LOOP_LAG_INTERVAL)
+            lag_samples.append(loop.time() - started_at - LOOP_LAG_INTERVAL)
+
+    @main.app.get("/_load_test/loop-lag")
+    def read_loop_lag(reset: bool = False):
+        samples = sorted(lag_samples)
+        if reset:
+            lag_samples.clear()
+        return {"count": len(samples), "p50": percentile(samples, 0.5), "p99": percentile(samples, 0.99), "max": samples[-1] if samples else 0.0}
+
+    async def serve():
+        sampler = asyncio.create_task(sample_loop_lag())
+        server = uvicorn.Server(uvicorn.Config(main.app, host="127.0.0.1", port=port, log_level="warning"))
+        await server.serve()
+        sampler.cancel()
+
+    asyncio.run(serve())
+
+def start_process(mode: str, port: int, argv: list[str], env: dict = None) -> subprocess.Popen:
+    return subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), "--serve", mode, "--port", str(port)] + argv,
+        env=env,
+        # the app prints every upstream payload, keep only errors
+        stdout=subprocess.DEVNULL
+    )
+
+async def wait_until_up(url: str, process: subprocess.Popen, timeout: float = 60):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                raise RuntimeError(url + " exited with code " + str(process.returncode))
+            try:
+                await client.get(url)
+                return
+            except httpx.TransportError:
+                await asyncio.sleep(0.1)
+    raise RuntimeError(url + " did not come up in time")
+
+# ---- load generation ----
+
+class Recorder:
+    def __init__(self):
+        self.latencies: dict[str, list[float]] = {}
+        self.errors: dict[str, int] = {}
+        self.request_count = 0
+        self.completed_queries = 0
+
+    def record(self, name: str, seconds: float):
+        self.latencies.setdefault(name, []).append(seconds)
+
+    def fail(self, name: str):
+        self.errors[name] = self.errors.get(name, 0) + 1
+
+    async def request(self, client: httpx.AsyncClient, name: str, path: str, **params) -> httpx.Response:
+        started_at = time.perf_counter()
+        self.request_count += 1
+        try:
+            response = await client.get(path, params=params)
+        except httpx.HTTPError:
+            self.fail(name)
+            raise
+        self.record(name, time.perf_counter() - started_at)
+        if response.status_code >= 400:
+            self.fail(name)
+        return response
+
+async def follow_websocket(url: str, recorder: Recorder, first_token_waiters: deque):
+    '''
+    listens to a conversation and records how long after a query its first streamed token arrives
+    '''
+    async with websockets.connect(url) as websocket:
+        async for raw_frame in websocket:
+            frame = json.loads(raw_frame)
+            if frame.get("delta") and len(first_token_waiters) > 0:
+                recorder.record("ws first token", time.perf_counter() - first_token_waiters.popleft())
+
+async def wait_for_completion(client: httpx.AsyncClient, recorder: Recorder, conversation_id: str, poll_wait: float) -> str:
+    response = await recorder.request(client, "GET /chat-status", "/chat-status", conversation_id=conversation_id)
+    while response.status_code in (200, 304):
+        if response.status_code == 200 and response.json() in ("COMPLETED", "FAILED"):
+            return response.json()
+        version = response.headers["etag"].strip('"')
+        response = await recorder.request(client, "GET /chat-status (long-poll)", "/chat-status", conversation_id=conversation_id, since_version=version, wait=poll_wait)
+    return "ERROR"
+
+CITIES = ["Paris", "Tokyo", "Rome", "Lisbon", "New York", "Bangkok", "Sydney", "Toronto", "Madrid", "Seoul"]
+
+async def virtual_user(base_url: str, recorder: Recorder, args, deadline: float):
+    async with httpx.AsyncClient(base_url=base_url, timeout=args.poll_wait + 30) as client:
+        while time.monotonic() < deadline:
+            response = await recorder.request(client, "GET /create_conversation", "/create_conversation")
+            conversation_id = response.json()["conversation_id"]
+
+            first_token_waiters = deque()
+            listener = None
+            if random.random() < args.websocket_ratio:
+                listener = asyncio.create_task(follow_websocket(base_url.replace("http", "ws", 1) + "/conversation/" + conversation_id, recorder, first_token_waiters))
+                await asyncio.sleep(0.05)
+
+            origin, destination = random.sample(CITIES, 2)
+            for turn in range(args.turns):
+                departure_date = "2027-%02d-%02d" % (random.randint(1, 12), random.randint(1, 28))
+                user_query = f"I want to fly from {origin} to {destination} on {departure_date} with {random.randint(1, 3)} adults, turn {turn}"
+                if random.random() < args.agent_ratio:
+                    user_query += " [agent]"
+
+                started_at = time.perf_counter()
+                first_token_waiters.append(started_at)
+                response = await recorder.request(client, "GET /query", "/query", user_query=user_query, conversation_id=conversation_id)
+                if response.status_code != 200:
+                    first_token_waiters.clear()
+                    await asyncio.sleep(0.5)
+                    continue
+
+                status = await wait_for_completion(client, recorder, conversation_id, args.poll_wait)
+                if status == "COMPLETED":
+                    recorder.record("query end to end", time.perf_counter() - started_at)
+                    recorder.completed_queries += 1
+                else:
+                    recorder.fail("query end to end")
+                await recorder.request(client, "GET /message", "/message", conversation_id=conversation_id)
+
+            if listener is not None:
+                listener.cancel()
+                await asyncio.gather(listener, return_exceptions=True)
+
+def print_report(recorder: Recorder, elapsed: float, loop_lag: dict, upstream_counts: dict):
+    print(f"\n{'step':32} {'count':>7} {'errors':>7} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    for name in sorted(set(recorder.latencies) | set(recorder.errors)):
+        samples = sorted(recorder.latencies.get(name, []))
+        row = [percentile(samples, 0.5), percentile(samples, 0.95), percentile(samples, 0.99), samples[-1] if samples else float("nan")]
+        print(f"{name:32} {len(samples):7d} {recorder.errors.get(name, 0):7d} " + " ".join(f"{value * 1e3:9.1f}" for value in row))
+
+    print(f"\nthroughput: {recorder.completed_queries / elapsed:.2f} queries/s, {recorder.request_count / elapsed:.1f} requests/s over {elapsed:.1f} s")
+    print(f"event loop lag: p50 {loop_lag['p50'] * 1e3:.2f} ms, p99 {loop_lag['p99'] * 1e3:.2f} ms, max {loop_lag['max'] * 1e3:.2f} ms ({loop_lag['count']} samples)")
+    print("upstream calls: " + ", ".join(name + " " + str(count) for name, count in sorted(upstream_counts.items())))
+
+async def run(args, argv: list[str]):
+    stub_port = free_port()
+    app_port = free_port()
+    stub_url = "http://127.0.0.1:" + str(stub_port)
+    app_url = "http://127.0.0.1:" + str(app_port)
+
+    app_env = dict(
+        os.environ,
+        TOGETHER_API_KEY="stub",
+        TOGETHER_API_BASE=stub_url + "/v1",
+        AMADEUS_API_KEY="stub",
+        AMADEUS_API_SECRET="stub",
+        AMADEUS_BASE_URL=stub_url,
+        NO_PROXY="127.0.0.1,localhost",
+        # the summaries of a load test repeat each other, cached ones would hide the LLM path
+        COMPLETION_CACHE_SIZE=os.environ.get("COMPLETION_CACHE_SIZE", "0"),
+    )
+    processes = [start_process("stubs", stub_port, argv), start_process("app", app_port, [], app_env)]
+    try:
+        await wait_until_up(stub_url + "/stats", processes[0])
+        await wait_until_up(app_url + "/", processes[1])
+
+        async with httpx.AsyncClient() as client:
+            await client.get(app_url + "/_load_test/loop-lag", params={"reset": True})
+
+        print(f"{args.users} users for {args.duration:.0f} s, {args.turns} turns per conversation")
+        started_at = time.monotonic()
+        deadline = started_at + args.duration
+        recorder = Recorder()
+        await asyncio.gather(*(virtual_user(app_url, recorder, args, deadline) for _ in range(args.users)))
+        elapsed = time.monotonic() - started_at
+
+        async with httpx.AsyncClient() as client:
+            loop_lag = (await client.get(app_url + "/_load_test/loop-lag")).json()
+            upstream_counts = (await client.get(stub_url + "/stats")).json()
+        print_report(recorder, elapsed, loop_lag, upstream_counts)
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+
+def parse_args(argv: list[str]):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=20, help="concurrent virtual users")
+    parser.add_argument("--duration", type=float, default=30, help="seconds to keep starting new conversations")
+    parser.add_argument("--turns", type=int, default=2, help="queries per conversation")
+    parser.add_argument("--websocket-ratio", type=float, default=0.5, help="share of conversations followed over the websocket")
+    parser.add_argument("--agent-ratio", type=float, default=0.2, help="share of queries that need the agent")
+    parser.add_argument("--poll-wait", type=float, default=20, help="wait parameter of the /chat-status long-poll")
+    parser.add_argument("--llm-latency", type=float, default=0.3, help="stub Together time to first token")
+    parser.add_argument("--tokens-per-second", type=float, default=50, help="stub Together token rate")
+    parser.add_argument("--amadeus-latency", type=float, default=0.2, help="stub Amadeus response time")
+    parser.add_argument("--serve", choices=["stubs", "app"], help=argparse.SUPPRESS)
+    parser.add_argument("--port", type=int, help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+if __name__ == "__main__":
+    argv = sys.argv[1:]
+    args = parse_args(argv)
+    if args.serve == "stubs":
+        serve_stubs(args.port, args)
+    elif args.serve == "app":
+        serve_app(args.port)
+    else:
+        asyncio.run(run(args, argv))
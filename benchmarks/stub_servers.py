@@ -0,0 +1,163 @@
+'''
+local stand-ins for the Together and Amadeus APIs used by the load test
+
+both are served by one FastAPI app: Together under /v1/chat/completions (streamed or not, the
+client treats the model as a chat model), Amadeus under its usual paths. latencies and the token
+rate are configurable so the service can be exercised against slow or fast upstreams without
+spending any quota
+'''
+
+import asyncio
+import json
+import random
+import re
+import time
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+# the query of a load test user that should go through the agent carries this marker
+AGENT_MARKER = "[agent]"
+
+DESTINATIONS = [
+    ("Tokyo", 35.68, 139.69),
+    ("Madrid", 40.42, -3.70),
+    ("Lisbon", 38.72, -9.14),
+    ("New York", 40.71, -74.01),
+]
+
+def summary_text(prompt: str) -> str:
+    '''
+    a summary in the shape the real model writes, with every slot filled so the pre-dispatch stage fires tools
+    '''
+    city, latitude, longitude = random.choice(DESTINATIONS)
+    date = "2025-%02d-%02d" % (random.randint(1, 12), random.randint(1, 28))
+    lines = [
+        "Here is a summary of your trip so far.",
+        "origin: Paris",
+        "destination: " + city,
+        "date: " + date,
+        "adults: " + str(random.randint(1, 3)),
+    ]
+    if AGENT_MARKER in prompt:
+        # no coordinates, only the agent can turn the city of stay into a places search
+        lines.append("city of stay: " + city)
+    else:
+        lines.append("latitude: " + str(latitude))
+        lines.append("longitude: " + str(longitude))
+    return "\n".join(lines)
+
+AGENT_ANSWER = "Thought: I can answer without using any more tools.\nAnswer: Your flights and activities are ready."
+
+def tokenize(text: str) -> list[str]:
+    return re.findall(r"\s*\S+", text)
+
+def stub_flight_offer(offer_id: str, origin: str, destination: str, departure_date: str) -> dict:
+    '''
+    a direct flight or one with up to two connections, so ranking has stops and durations to weigh
+    '''
+    airports = [origin] + random.sample(["CDG", "AMS", "FRA", "MAD", "LHR"], random.randint(0, 2)) + [destination]
+    segments = []
+    for index in range(len(airports) - 1):
+        segments.append({
+            "carrierCode": random.choice(["AF", "JL", "IB", "TP", "DL"]),
+            "number": str(random.randint(10, 9999)),
+            "aircraft": {"code": random.choice(["320", "359", "77W"])},
+            "departure": {"iataCode": airports[index], "at": departure_date + "T%02d:00:00" % random.randint(6, 20)},
+            "arrival": {"iataCode": airports[index + 1], "at": departure_date + "T%02d:30:00" % random.randint(8, 23)}
+        })
+    return {
+        "id": offer_id,
+        "itineraries": [{
+            "duration": "PT%dH%02dM" % (random.randint(2, 8) + 3 * len(segments), random.randint(0, 59)),
+            "segments": segments
+        }],
+        "price": {"currency": "USD", "total": "%.2f" % random.uniform(80, 1500)}
+    }
+
+def create_stub_app(llm_latency: float = 0.3, tokens_per_second: float = 50.0, amadeus_latency: float = 0.2) -> FastAPI:
+    app = FastAPI()
+    app.state.request_counts = {}
+
+    def count(name: str):
+        app.state.request_counts[name] = app.state.request_counts.get(name, 0) + 1
+
+    def chunk(model: str, delta: dict, finish_reason: str = None) -> str:
+        return "data: " + json.dumps({
+            "id": "stub",
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]
+        }) + "\n\n"
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        prompt = " ".join(str(message.get("content", "")) for message in body.get("messages", []))
+        model = body.get("model", "stub")
+        # only the ReAct agent prompt spells out the Thought/Action format
+        is_agent = "Thought:" in prompt
+        text = AGENT_ANSWER if is_agent else summary_text(prompt)
+        count("together_agent" if is_agent else "together_summary")
+        await asyncio.sleep(llm_latency)
+
+        if not body.get("stream"):
+            await asyncio.sleep(len(tokenize(text)) / tokens_per_second)
+            return {
+                "id": "stub",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": len(tokenize(prompt)), "completion_tokens": len(tokenize(text)), "total_tokens": 0}
+            }
+
+        async def stream():
+            yield chunk(model, {"role": "assistant", "content": ""})
+            for token in tokenize(text):
+                await asyncio.sleep(1 / tokens_per_second)
+                yield chunk(model, {"content": token})
+            yield chunk(model, {}, "stop")
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(stream(), media_type="text/event-stream")
+
+    @app.post("/v1/security/oauth2/token")
+    async def amadeus_token():
+        count("amadeus_token")
+        await asyncio.sleep(amadeus_latency)
+        return {"access_token": "stub-token", "token_type": "Bearer", "expires_in": 1799}
+
+    @app.get("/v2/shopping/flight-offers")
+    async def amadeus_flight_offers(request: Request):
+        count("amadeus_flight_offers")
+        if request.headers.get("authorization") != "Bearer stub-token":
+            return JSONResponse(status_code=401, content={"errors": [{"status": 401}]})
+        await asyncio.sleep(amadeus_latency)
+        departure_date = request.query_params.get("departureDate", "2025-01-01")
+        max_offers = int(request.query_params.get("max", "3"))
+        return {"data": [stub_flight_offer(str(index), request.query_params.get("originLocationCode"), request.query_params.get("destinationLocationCode"), departure_date) for index in range(max_offers)]}
+
+    @app.get("/v1/shopping/activities")
+    async def amadeus_activities(request: Request):
+        count("amadeus_activities")
+        if request.headers.get("authorization") != "Bearer stub-token":
+            return JSONResponse(status_code=401, content={"errors": [{"status": 401}]})
+        await asyncio.sleep(amadeus_latency)
+        return {"data": [
+            {
+                "id": str(index),
+                "name": "Stub activity " + str(index),
+                "description": "A short description of a stub activity. " * 4,
+                "price": {"amount": "%.2f" % random.uniform(10, 150), "currencyCode": "EUR"},
+                "pictures": ["https://example.com/" + str(index) + ".jpg"]
+            }
+            for index in range(10)
+        ]}
+
+    @app.get("/stats")
+    def stats():
+        return app.state.request_counts
+
+    return app
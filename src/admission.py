@@ -0,0 +1,184 @@
+'''admission control in front of the LLM so bursts are shed early instead of timing out together'''
+
+import asyncio
+import math
+import os
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+
+from job_queue import JOB_WORKERS
+import metrics
+
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "8"))
+LLM_MAX_WAITING = int(os.getenv("LLM_MAX_WAITING", "32"))
+LLM_MAX_EXPECTED_WAIT = float(os.getenv("LLM_MAX_EXPECTED_WAIT", "20"))
+LLM_EXPECTED_CALL_SECONDS = float(os.getenv("LLM_EXPECTED_CALL_SECONDS", "5"))
+CONVERSATION_LLM_RATE = float(os.getenv("CONVERSATION_LLM_RATE", "0.2"))
+CONVERSATION_LLM_BURST = float(os.getenv("CONVERSATION_LLM_BURST", "5"))
+ADMISSION_MAX_CONVERSATIONS = int(os.getenv("ADMISSION_MAX_CONVERSATIONS", "100000"))
+
+# weight of the newest call in the running average of call durations
+CALL_DURATION_SMOOTHING = 0.2
+# longest Retry-After ever sent, a conversation rate of 0 would otherwise ask the client to wait forever
+MAX_RETRY_AFTER = 3600.0
+
+class OverloadedError(Exception):
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class TokenBucket:
+    '''
+    refills rate tokens per second up to burst
+
+    admission takes one token for the summary call of the query, so queries queued behind each
+    other are paid for before they run. the agent call of a turn is charged when it starts and may
+    take the bucket into debt (down to -burst), so a turn that also runs the agent pays for both
+    calls with a longer wait before the next query
+    '''
+    __slots__ = ("rate", "burst", "tokens", "updated_at")
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def available(self) -> float:
+        self._refill()
+        return self.tokens
+
+    def charge(self, cost: float = 1):
+        self._refill()
+        self.tokens = max(self.tokens - cost, -self.burst)
+
+    def retry_after(self) -> float:
+        '''
+        seconds until a token is available again
+        '''
+        return max(1 - self.available(), 0) / self.rate if self.rate > 0 else math.inf
+
+class AdmissionController:
+    '''
+    decides whether a query may start and paces the LLM calls of the admitted ones
+
+    - a global limit of max_concurrency LLM calls in flight, the calls of the other admitted queries wait for a slot.
+      queries only run on the max_workers job workers, so at most min(max_workers, max_concurrency) of them make progress
+    - a token bucket per conversation so one client cannot take every slot
+    - a query is refused right away (OverloadedError, answered with 429) when its conversation has
+      no token left, when max_waiting admitted queries are already queued behind the running ones,
+      or when the expected wait for a slot exceeds max_expected_wait. the expected wait comes from
+      a running average of how long calls hold their slot
+
+    the whole decision is taken on admission, an admitted query is never refused halfway through its
+    turn. refusing early keeps the queue short, so the admitted queries keep a steady latency
+    '''
+    def __init__(self, max_concurrency: int = LLM_MAX_CONCURRENCY, max_workers: int = JOB_WORKERS, max_waiting: int = LLM_MAX_WAITING, max_expected_wait: float = LLM_MAX_EXPECTED_WAIT, rate: float = CONVERSATION_LLM_RATE, burst: float = CONVERSATION_LLM_BURST, max_conversations: int = ADMISSION_MAX_CONVERSATIONS):
+        self.max_concurrency = max_concurrency
+        # queries running at once, the rest of the admitted ones are queued for a worker or a slot
+        self.max_running = min(max_workers, max_concurrency)
+        self.max_waiting = max_waiting
+        self.max_expected_wait = max_expected_wait
+        self.rate = rate
+        self.burst = burst
+        self.max_conversations = max_conversations
+        self.admitted = 0 # queries admitted and not finished yet
+        self.in_flight = 0
+        self.waiting = 0
+        self.average_call_seconds = LLM_EXPECTED_CALL_SECONDS
+        self.rejections = {}
+        self._slots = asyncio.Semaphore(max_concurrency)
+        self._buckets: OrderedDict[str, TokenBucket] = OrderedDict()
+
+    def get_bucket(self, conversation_id: str) -> TokenBucket:
+        bucket = self._buckets.get(conversation_id)
+        if bucket is None:
+            bucket = self._buckets[conversation_id] = TokenBucket(self.rate, self.burst)
+            # the least recently used conversations go first, a forgotten bucket just starts full again
+            while len(self._buckets) > self.max_conversations:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(conversation_id)
+        return bucket
+
+    def queued(self) -> int:
+        '''
+        admitted queries that will have to wait for one of the running ones to finish
+        '''
+        return max(self.admitted - self.max_running, 0)
+
+    def expected_wait(self) -> float:
+        '''
+        seconds a query admitted now is expected to wait for a slot
+        '''
+        if self.admitted < self.max_running:
+            return 0.0
+        return math.ceil((self.queued() + 1) / self.max_running) * self.average_call_seconds
+
+    def _reject(self, reason: str, message: str, retry_after: float):
+        self.rejections[reason] = self.rejections.get(reason, 0) + 1
+        raise OverloadedError(message, min(retry_after, MAX_RETRY_AFTER))
+
+    def admit(self, conversation_id: str):
+        '''
+        raises OverloadedError if a new query of the conversation should be refused right now,
+        otherwise charges the conversation for the summary call and counts the query as admitted until release is called
+        '''
+        bucket = self.get_bucket(conversation_id)
+        if bucket.available() < 1:
+            self._reject("conversation_rate", "Too many queries in this conversation, slow down", bucket.retry_after())
+        if self.queued() >= self.max_waiting:
+            self._reject("queue_full", "The server is overloaded, try again later", self.average_call_seconds)
+        expected_wait = self.expected_wait()
+        if expected_wait > self.max_expected_wait:
+            self._reject("expected_wait", "The server is overloaded, try again later", expected_wait - self.max_expected_wait)
+        bucket.charge()
+        self.admitted += 1
+
+    def release(self):
+        '''
+        called once an admitted query is done, whether it succeeded or not
+        '''
+        self.admitted -= 1
+
+    @asynccontextmanager
+    async def llm_call(self, conversation_id: str, cost: float = 1):
+        '''
+        holds one of the global LLM slots for the duration of a call, charging the conversation cost tokens for it
+        '''
+        if cost > 0:
+            self.get_bucket(conversation_id).charge(cost)
+        self.waiting += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self.waiting -= 1
+
+        self.in_flight += 1
+        started_at = time.monotonic()
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            self._slots.release()
+            duration = time.monotonic() - started_at
+            self.average_call_seconds += CALL_DURATION_SMOOTHING * (duration - self.average_call_seconds)
+
+# Create a global instance of AdmissionController shared by every LLM call of this process
+admission_controller = AdmissionController()
+
+metrics.registry.register(metrics.Gauge("yume_admitted_queries", "Queries admitted and not finished yet", lambda: admission_controller.admitted))
+metrics.registry.register(metrics.Gauge("yume_llm_calls_in_flight", "LLM calls holding a slot", lambda: admission_controller.in_flight))
+metrics.registry.register(metrics.Gauge("yume_llm_calls_waiting", "LLM calls waiting for a slot", lambda: admission_controller.waiting))
+metrics.registry.register(metrics.CallbackCounter(
+    "yume_admission_rejections_total",
+    "Queries and LLM calls refused by admission control",
+    lambda: {(reason,): count for reason, count in admission_controller.rejections.items()},
+    ("reason",)
+))
@@ -0,0 +1,150 @@
+'''builds the ReAct agent's tools and prompts once and hands out a cheap agent per query'''
+
+import functools
+import os
+
+from llama_index.core import ChatPromptTemplate
+from llama_index.core.agent import AgentRunner, ReActAgentWorker, ReActChatFormatter
+from llama_index.core.agent.react.formatter import get_react_tool_descriptions
+from llama_index.core.agent.react.prompts import CONTEXT_REACT_CHAT_SYSTEM_HEADER, REACT_CHAT_SYSTEM_HEADER
+from llama_index.core.agent.react.types import ObservationReasoningStep
+from llama_index.core.llms import ChatMessage, MessageRole
+from llama_index.core.memory import ChatMemoryBuffer
+from llama_index.core.storage.chat_store import SimpleChatStore
+from llama_index.core.utils import get_tokenizer
+
+import aitools
+import llm
+
+AGENT_MAX_ITERATIONS = int(os.getenv("AGENT_MAX_ITERATIONS", "20"))
+AGENT_PROMPT_CACHE_SIZE = int(os.getenv("AGENT_PROMPT_CACHE_SIZE", "1024"))
+
+# the tools the agent may call, in the order they are described to the model
+AGENT_TOOL_NAMES = (
+    "add_possible_flights_tool",
+    "add_possible_places_tool",
+    "add_possible_flights_and_places_tool",
+    "search_flexible_flights_tool",
+    "refine_flights_tool",
+    "locate_city_tool",
+    "find_nearby_airports_tool",
+    "get_today_tool",
+    "end_message_tool",
+    "update_context_tool",
+)
+
+# built once, the summary and the query are template variables so braces in them are never parsed
+AGENT_PROMPT = ChatPromptTemplate([
+    ChatMessage(
+        role=MessageRole.SYSTEM,
+        content=(
+            """You are a reAct Agent that augments the generated response of a NLP Agent that generates questions or recommendations. Your job is to use tools/functions at your disposal to.\n
+            1. Look at the summary text
+            2. Use the tools that you find that will augment the summary text
+
+            The Conversation ID is {conversation_id}.\n
+
+            End the session if you find no relevant tools to use.
+
+            DO NOT EXECUTE ANY TOOLS MORE THAN ONCE\n
+
+            CONTEXT: \n{context}
+            """
+        ),
+    ),
+    ChatMessage(role=MessageRole.CHATBOT, content="""
+                Summary:
+
+                {summary_text}"""),
+    ChatMessage(role=MessageRole.USER, content="{user_query}"),
+])
+
+# tool names -> (tool descriptions, tool names) as rendered in the system prompt
+tool_descriptions = {}
+
+def render_tool_descriptions(tools: list) -> tuple[str, str]:
+    '''
+    the tool part of the system prompt, rendering it builds a json schema per tool so it is done once
+    per tool set. the registry hands out one tool object per name, so the names identify the set
+    '''
+    key = tuple(tool.metadata.name for tool in tools)
+    rendered = tool_descriptions.get(key)
+    if rendered is None:
+        rendered = tool_descriptions[key] = ("\n".join(get_react_tool_descriptions(tools)), ", ".join(tool.metadata.get_name() for tool in tools))
+    return rendered
+
+@functools.lru_cache(maxsize=AGENT_PROMPT_CACHE_SIZE)
+def render_system_header(system_header: str, tool_desc: str, tool_names: str, context: str) -> str:
+    format_args = {"tool_desc": tool_desc, "tool_names": tool_names}
+    if context:
+        format_args["context"] = context
+    return system_header.format(**format_args)
+
+class CachedReActChatFormatter(ReActChatFormatter):
+    '''
+    a ReActChatFormatter that renders the system header once per tool set and context
+
+    the stock formatter rebuilds every tool schema on every reasoning step of every query
+    '''
+    def format(self, tools, chat_history, current_reasoning=None):
+        system_header = render_system_header(self.system_header, *render_tool_descriptions(tools), self.context)
+        reasoning_history = [
+            ChatMessage(
+                role=MessageRole.USER if isinstance(reasoning_step, ObservationReasoningStep) else MessageRole.ASSISTANT,
+                content=reasoning_step.get_content()
+            )
+            for reasoning_step in current_reasoning or []
+        ]
+        return [ChatMessage(role=MessageRole.SYSTEM, content=system_header), *chat_history, *reasoning_history]
+
+class AgentFactory:
+    '''
+    builds the agent's tools once and creates an agent per query on top of them
+
+    ReActAgent.from_tools sizes a memory from the llm metadata, looks up the tokenizer and goes
+    through a deprecated formatter constructor that logs a warning on every call. here all of that
+    is resolved on first use, a query only pays for its own formatter (which carries the session's
+    context), a worker holding the shared tools and an empty memory
+    '''
+    def __init__(self, tool_names: tuple = AGENT_TOOL_NAMES, max_iterations: int = AGENT_MAX_ITERATIONS, verbose: bool = True):
+        self.tool_names = tool_names
+        self.max_iterations = max_iterations
+        self.verbose = verbose
+        self._tools = None
+        self._token_limit = None
+
+    def get_tools(self) -> list:
+        if self._tools is None:
+            self._tools = [aitools.get_tool(name) for name in self.tool_names]
+            # rendered now so the first query does not pay for the schemas
+            render_tool_descriptions(self._tools)
+        return self._tools
+
+    def create_agent(self, context: str = "") -> AgentRunner:
+        '''
+        a ReAct agent over the shared tools for one query of a session
+        '''
+        llm_instance = llm.get_llm()
+        if self._token_limit is None:
+            self._token_limit = ChatMemoryBuffer.from_defaults(llm=llm_instance).token_limit
+
+        formatter = CachedReActChatFormatter(
+            system_header=CONTEXT_REACT_CHAT_SYSTEM_HEADER if context else REACT_CHAT_SYSTEM_HEADER,
+            context=context or ""
+        )
+        worker = ReActAgentWorker(
+            tools=self.get_tools(),
+            llm=llm_instance,
+            max_iterations=self.max_iterations,
+            react_chat_formatter=formatter,
+            callback_manager=llm_instance.callback_manager,
+            verbose=self.verbose
+        )
+        memory = ChatMemoryBuffer(token_limit=self._token_limit, tokenizer_fn=get_tokenizer(), chat_store=SimpleChatStore())
+        return AgentRunner(worker, memory=memory, llm=llm_instance, callback_manager=llm_instance.callback_manager, verbose=self.verbose)
+
+    def render_prompt(self, conversation_id: str, context: str, summary_text: str, user_query: str) -> str:
+        return AGENT_PROMPT.format(conversation_id=conversation_id, context=context, summary_text=summary_text, user_query=user_query)
+
+# Create a global instance of AgentFactory shared by every query
+agent_factory = AgentFactory()
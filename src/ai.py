@@ -1,102 +1,79 @@
 '''the script that handles the interaction with ai'''
 
-import os
-
-from llama_cloud import MessageRole
-from llama_index.core import VectorStoreIndex,  Settings
-from llama_index.llms.together import TogetherLLM
-from llama_index.core.agent import ReActAgent
-from llama_index.core.llms import ChatMessage
-from llama_index.core.tools import BaseTool, FunctionTool
-from llama_index.core import ChatPromptTemplate
-from dotenv import load_dotenv
+import asyncio
 
 import session_manager
+from admission import admission_controller
+from agent_factory import agent_factory
 import aitools
-
-load_dotenv()
-
-TOGETHER_API_KEY = os.getenv("TOGETHER_API_KEY")
-
-print("TOGETHER_API_KEY is " + TOGETHER_API_KEY)
-
-llama3 = TogetherLLM(
-    model="meta-llama/Meta-Llama-3-70B-Instruct-Turbo", api_key=TOGETHER_API_KEY
-)
+import dispatch
+import metrics
 
 async def handle_query(current_session: session_manager.Session, user_query: str):
     # TO BE IMPLEMENTED
     #await current_session.emit_message(
     #    session_manager.YumeTravelResponse(session_manager.YumeConversationResponseTypes.ON_LOADING, "Trying to load result right now")
     #    )
-    current_session.status = session_manager.SessionStatus.LOADING
+    current_session.set_status(session_manager.SessionStatus.LOADING)
 
     #current_session.messages.append(session_manager.Message("User", user_query))
 
     #summary_text = aitools.generate_summary_text(user_query, current_session.conversation_id)
     #current_session.messages.append(session_manager.Message("AI", ""))
 
-    summary_text = aitools.generate_summary_text(user_query, current_session.conversation_id)
-    print("The summary text is: " + summary_text)
-    aitools.add_summary_text(conversation_id=current_session.conversation_id, text=summary_text)
-
-    function_call_msgs = [
-        ChatMessage(
-            role=MessageRole.SYSTEM,
-            content=(
-                """You are a reAct Agent that augments the generated response of a NLP Agent that generates questions or recommendations. Your job is to use tools/functions at your disposal to.\n
-                1. Look at the summary text
-                2. Use the tools that you find that will augment the summary text
-
-                The Conversation ID is {conversation_id}.\n
-
-                End the session if you find no relevant tools to use.
-
-                DO NOT EXECUTE ANY TOOLS MORE THAN ONCE\n
-
-                CONTEXT: \n{context}
-                """
-            ),
-        ),
-        ChatMessage(role=MessageRole.CHATBOT, content="""
-                    Summary:
-                    
-                    """ + summary_text),
-        ChatMessage(role=MessageRole.USER, content=user_query),
-    ]
-
-    message_template = ChatPromptTemplate(function_call_msgs)
-    
-    #print("Conversation ID: " + current_session.conversation_id)
-    #print("User Query: " + user_query)
-
-    """llama3.chat_with_tools(
-        tools=[
-            aitools.add_possible_flights_tool,
-            aitools.airport_iana_tool,
-            aitools.get_today_tool,
-            aitools.end_message_tool
-        ],
-        user_msg=message_template.format(conversation_id = current_session.conversation_id),
-        
-        )
-        """
-
-    result_formatter_agent = ReActAgent.from_tools([
-        aitools.add_possible_flights_tool,
-        aitools.add_possible_places_tool,
-        #aitools.airport_iata_tool,
-        aitools.get_today_tool,
-        aitools.end_message_tool,
-        aitools.update_context_tool
-        ], 
-        llm=llama3,
-        verbose=True,
-        context=current_session.context,
-        max_iterations=20
-        )
-    
-    result_agent_response = result_formatter_agent.chat(message_template.format(conversation_id = current_session.conversation_id, context = current_session.context))
+    status = session_manager.SessionStatus.FAILED
+    try:
+        with metrics.span("query"):
+            with metrics.span("summary"):
+                summary_text = await aitools.generate_summary_text(user_query, current_session.conversation_id)
+            print("The summary text is: " + summary_text)
+            aitools.add_summary_text(conversation_id=current_session.conversation_id, text=summary_text)
+
+            # most turns are clarifying questions where no tool can fire, those skip the agent entirely
+            with metrics.span("dispatch"):
+                plan = dispatch.plan_turn(current_session, summary_text, user_query)
+                current_session.set_context(dispatch.merge_context(current_session.context, plan.slots))
+            with metrics.span("tool_calls"):
+                await run_tool_calls(current_session, plan.tool_calls)
+
+            if plan.needs_agent:
+                current_session.set_agent_slots(plan.slots)
+                with metrics.span("agent"):
+                    await run_agent(current_session, user_query, summary_text)
+        status = session_manager.SessionStatus.COMPLETED
+    finally:
+        # the turn always ends with a terminal frame, subscribers would otherwise wait for it forever
+        await on_generation_complete(current_session.conversation_id, status)
+
+async def run_tool_calls(current_session: session_manager.Session, tool_calls: list[dispatch.ToolCall]):
+    '''
+    runs the independent tool calls of a plan concurrently and appends their results in plan order
+    '''
+    latest_message_index = len(current_session.messages) - 1
+    results = await asyncio.gather(
+        *(aitools.tool_fetchers[tool_call.name](**tool_call.arguments) for tool_call in tool_calls),
+        return_exceptions=True
+    )
+    for tool_call, result in zip(tool_calls, results):
+        if isinstance(result, Exception):
+            print("Tool " + tool_call.name + " failed: " + repr(result))
+            continue
+        # nothing matched (e.g. a refinement filtering out every offer), an empty card would only confuse the user
+        if len(result.content) > 0:
+            current_session.add_response(result, latest_message_index)
+        current_session.add_dispatched_tool_call(tool_call.key())
+        if tool_call.name == "add_possible_flights_text":
+            current_session.set_flight_search(dict(tool_call.arguments))
+
+async def run_agent(current_session: session_manager.Session, user_query: str, summary_text: str):
+    result_formatter_agent = agent_factory.create_agent(current_session.context)
+    agent_input = agent_factory.render_prompt(current_session.conversation_id, current_session.context, summary_text, user_query)
+
+    async with admission_controller.llm_call(current_session.conversation_id):
+        result_agent_response = await result_formatter_agent.achat(agent_input)
+    # every tool call is one reasoning step, the final answer is one more
+    metrics.agent_runs.inc()
+    metrics.agent_iterations.inc(len(result_agent_response.sources) + 1)
     #agent = ReActAgent.from_tools([aitools.add_summary_tool], llm=Settings.llm, verbose=True)
     #current_session.messages.append(session_manager.Message("AI", ""))
     #agent_response = agent.chat(message_template.format(history=current_session.get_chat_history(), query=user_query, conversation_id = current_session.conversation_id))
@@ -108,13 +85,13 @@ async def handle_query(current_session: session_manager.Session, user_query: str
 
     #current_session.messages.append(session_manager.Message("AI", full_response))
 
-    await on_generation_complete(current_session.conversation_id, current_session.messages[-1].content)
-    
-    print("Hello World")
-
-async def on_generation_complete(conversation_id: str, response: str):
+async def on_generation_complete(conversation_id: str, status: session_manager.SessionStatus = session_manager.SessionStatus.COMPLETED):
     current_session = session_manager.session_controller.get_session(conversation_id)
     if current_session == None:
         return
-    current_session.status = session_manager.SessionStatus.COMPLETED
-    #await current_session.emit_message(session_manager.YumeTravelResponse(session_manager.YumeConversationResponseTypes.ON_RESPONSE, response))
\ No newline at end of file
+    current_session.finish_turn(status)
+    if status == session_manager.SessionStatus.FAILED:
+        current_session.emit_message(session_manager.YumeTravelResponse(session_manager.YumeConversationResponseTypes.ON_FAILED, "The query failed, please try again"))
+        return
+    # the summary already went out in its final on_response frame, this only marks the end of the turn
+    current_session.emit_message(session_manager.YumeTravelResponse(session_manager.YumeConversationResponseTypes.ON_COMPLETED))
\ No newline at end of file
@@ -0,0 +1,117 @@
+'''search index over the compiled airport table'''
+
+import bisect
+import functools
+
+import numpy as np
+
+from airport_table import AirportTable, get_airport_table, normalize, trigrams
+
+# bonus added to airports whose name says international, so "tokyo" ranks Haneda/Narita above heliports
+INTERNATIONAL_BONUS = 0.02
+
+class AirportIndex:
+    '''
+    search over the lookup structures compiled into the airport table
+
+    IATA and ICAO codes, normalized airport names and normalized city names are all searchable.
+    exact codes and keys are found by binary search in sorted columns, partial input through the
+    sorted word suffixes of the keys (prefix matches) and misspelled input through the trigram
+    postings. candidates are ranked by score. nothing is built per process, the table is read in place
+    '''
+    def __init__(self, table: AirportTable):
+        self.table = table
+        # the records by IATA code, for callers that want more than a search result
+        self.airports = table
+
+    def __len__(self) -> int:
+        return len(self.table)
+
+    def search(self, query: str, limit: int = 5, min_score: float = 0.35) -> list[dict]:
+        '''
+        returns up to limit candidates as {"iata", "name", "city", "subd", "country", "score"}, best first
+        '''
+        table = self.table
+        scores: dict[int, float] = {}
+
+        def add(index: int, score: float):
+            if score > scores.get(index, 0.0):
+                scores[index] = score
+
+        index = table.find_code(query.strip().upper())
+        if index is not None:
+            add(index, 1.0)
+
+        key = normalize(query)
+        if key:
+            key_id = table.find_key(key)
+            if key_id is not None:
+                for index in table.key_airports[key_id].tolist():
+                    add(index, 0.95)
+
+            # prefix matches, keys the query covers more of rank higher
+            position = bisect.bisect_left(table.suffixes, key)
+            for suffix_position in range(position, min(position + 50, len(table.suffixes))):
+                if not table.suffixes[suffix_position].startswith(key):
+                    break
+                candidate_key_id = int(table.suffix_keys[suffix_position])
+                candidate_length = len(table.keys[candidate_key_id])
+                for index in table.key_airports[candidate_key_id].tolist():
+                    add(index, 0.7 + 0.2 * len(key) / candidate_length)
+
+            for candidate_key_id, similarity in self._trigram_candidates(key):
+                if similarity >= min_score:
+                    for index in table.key_airports[candidate_key_id].tolist():
+                        add(index, 0.9 * similarity)
+
+        ranked = []
+        for index, score in scores.items():
+            if "international" in table.field("name", index).lower():
+                score += INTERNATIONAL_BONUS
+            ranked.append((score, table.code(index), index))
+        ranked.sort(key=lambda candidate: (-candidate[0], candidate[1]))
+
+        return [
+            {
+                "iata": iata_code,
+                "name": table.field("name", index),
+                "city": table.field("city", index),
+                "subd": table.field("subd", index),
+                "country": table.field("country", index),
+                "score": round(min(score, 1.0), 3)
+            }
+            for score, iata_code, index in ranked[:limit]
+        ]
+
+    def _trigram_candidates(self, key: str, max_candidates: int = 200) -> list[tuple[int, float]]:
+        '''
+        collects candidate keys from the rarest trigrams of the query and scores them with the dice coefficient
+
+        a key appears at most once in each trigram posting, so the trigrams it shares with the query
+        are counted with one bincount over the postings of the query's trigrams
+        '''
+        query_trigrams = trigrams(key)
+        postings = sorted(
+            (posting for posting in map(self.table.trigram_key_ids, query_trigrams) if posting is not None),
+            key=len
+        )
+        if len(postings) == 0:
+            return []
+        candidates = set()
+        # a key that shares enough trigrams with the query must appear in at least one of the rarest postings
+        for posting in postings[:max(1, len(query_trigrams) // 2)]:
+            candidates.update(posting.tolist())
+            if len(candidates) >= max_candidates:
+                break
+
+        candidate_ids = np.fromiter(candidates, dtype=np.int64, count=len(candidates))
+        shared = np.bincount(np.concatenate(postings), minlength=len(self.table.keys))[candidate_ids]
+        similarities = 2 * shared / (len(query_trigrams) + self.table.key_trigram_counts[candidate_ids])
+        return list(zip(candidate_ids.tolist(), similarities.tolist()))
+
+@functools.cache
+def get_airport_index() -> AirportIndex:
+    '''
+    the index over the shared airport table, later calls share the same instance
+    '''
+    return AirportIndex(get_airport_table())
@@ -0,0 +1,379 @@
+'''
+the airportsdata table and its search keys compiled into one read-only file that every worker maps
+
+build it ahead of the workers (it is also built on first use if missing or stale):
+    python src/airport_table.py [path]
+'''
+
+import bisect
+import csv
+import functools
+import importlib.metadata
+import json
+import mmap
+import os
+import re
+import struct
+import sys
+import tempfile
+import unicodedata
+from collections.abc import Mapping
+
+import numpy as np
+
+# next to this module by default so the workers find the same table whatever directory they start in
+AIRPORT_TABLE_PATH = os.getenv("AIRPORT_TABLE_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "airports.table"))
+
+TABLE_MAGIC = b"YUMEAPT\x00"
+TABLE_FORMAT = 2
+# magic, header length, padding
+PREAMBLE = struct.Struct("<8sII")
+# every section starts on this boundary so the numpy views over it are aligned
+ALIGNMENT = 8
+
+STRING_FIELDS = ("icao", "name", "city", "subd", "country", "tz", "lid")
+
+# words that appear in so many airport names that they carry no signal for matching
+STOPWORDS = {"airport", "international", "intl", "regional", "municipal", "airfield", "airstrip", "aerodrome", "field", "the", "of"}
+
+def normalize(text: str) -> str:
+    '''
+    lowercases, strips accents and punctuation and removes the stopwords
+    '''
+    text = unicodedata.normalize("NFKD", text)
+    text = "".join(character for character in text if not unicodedata.combining(character))
+    words = re.sub(r"[^a-z0-9]+", " ", text.lower()).split()
+    return " ".join(word for word in words if word not in STOPWORDS)
+
+@functools.lru_cache(maxsize=16384)
+def trigrams(text: str) -> frozenset:
+    padded = "  " + text + " "
+    return frozenset(padded[i:i + 3] for i in range(len(padded) - 2))
+
+def source_version() -> str:
+    '''
+    the airportsdata release a table is compiled from, read without loading the data
+    '''
+    return "airportsdata " + importlib.metadata.version("airportsdata")
+
+class StringColumn:
+    '''
+    strings stored as one utf-8 blob and an offsets array, decoded one at a time on access
+
+    supports len, indexing and iteration, so bisect works on a sorted column without decoding it
+    '''
+    __slots__ = ("offsets", "data")
+
+    def __init__(self, offsets: np.ndarray, data: memoryview):
+        self.offsets = offsets
+        self.data = data
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index: int) -> str:
+        if index < 0 or index >= len(self.offsets) - 1:
+            raise IndexError(index)
+        return str(self.data[int(self.offsets[index]):int(self.offsets[index + 1])], "utf-8")
+
+    def __iter__(self):
+        offsets = self.offsets.tolist()
+        for start, end in zip(offsets, offsets[1:]):
+            yield str(self.data[start:end], "utf-8")
+
+class Postings:
+    '''
+    one int32 list per entry (compressed sparse rows), an entry is a zero copy slice of the values
+    '''
+    __slots__ = ("offsets", "values")
+
+    def __init__(self, offsets: np.ndarray, values: np.ndarray):
+        self.offsets = offsets
+        self.values = values
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index: int) -> np.ndarray:
+        return self.values[self.offsets[index]:self.offsets[index + 1]]
+
+class TableWriter:
+    '''
+    lays out named numpy arrays one after another behind a json header describing them
+    '''
+    def __init__(self):
+        self.sections: dict[str, np.ndarray] = {}
+
+    def add(self, name: str, array: np.ndarray):
+        self.sections[name] = np.ascontiguousarray(array)
+
+    def add_strings(self, name: str, strings: list[str]):
+        encoded = [string.encode("utf-8") for string in strings]
+        offsets = np.zeros(len(encoded) + 1, dtype="<u4")
+        offsets[1:] = np.cumsum([len(value) for value in encoded])
+        self.add(name + ".offsets", offsets)
+        self.add(name + ".data", np.frombuffer(b"".join(encoded), dtype=np.uint8))
+
+    def add_postings(self, name: str, lists: list[list[int]]):
+        offsets = np.zeros(len(lists) + 1, dtype="<u4")
+        offsets[1:] = np.cumsum([len(values) for values in lists])
+        self.add(name + ".offsets", offsets)
+        self.add(name + ".values", np.array([value for values in lists for value in values], dtype="<i4"))
+
+    def to_bytes(self, metadata: dict) -> bytes:
+        layout = {}
+        body = bytearray()
+        for name, array in self.sections.items():
+            body.extend(b"\x00" * (-len(body) % ALIGNMENT))
+            layout[name] = [len(body), array.dtype.str, len(array)]
+            body.extend(array.tobytes())
+
+        header = json.dumps(dict(metadata, sections=layout)).encode()
+        header += b" " * (-(PREAMBLE.size + len(header)) % ALIGNMENT)
+        return PREAMBLE.pack(TABLE_MAGIC, len(header), 0) + header + bytes(body)
+
+def load_metro_codes() -> dict:
+    '''
+    IATA's multi airport city codes (TYO, LON, NYC) as {country: {normalized city: city code}}
+
+    read from the csv shipped with airportsdata, its load_iata_macs loads every airport along with them
+    '''
+    import airportsdata
+
+    metro_codes = {}
+    with open(os.path.join(os.path.dirname(airportsdata.__file__), "iata_macs.csv"), encoding="utf-8", newline="") as file:
+        for row in csv.DictReader(file):
+            metro_codes.setdefault(row["Country"], {})[normalize(row["City Name"])] = row["City Code"]
+    return metro_codes
+
+def compile_airport_table(airports: dict, metro_codes: dict = None) -> bytes:
+    '''
+    the airports sorted by IATA code in columns, plus the sorted lookup structures of the search:
+    ICAO codes, normalized name and city keys with their airports, every word suffix of the keys
+    (prefix search) and the trigram postings of the keys (misspelled input). the few metro codes
+    go into the header
+    '''
+    codes = sorted(airports)
+    writer = TableWriter()
+    writer.add("iata", np.array([code.encode("ascii") for code in codes], dtype="S3"))
+    writer.add("lat", np.array([airports[code]["lat"] for code in codes], dtype="<f8"))
+    writer.add("lon", np.array([airports[code]["lon"] for code in codes], dtype="<f8"))
+    writer.add("elevation", np.array([airports[code].get("elevation") or 0.0 for code in codes], dtype="<f8"))
+    for field in STRING_FIELDS:
+        writer.add_strings(field, [airports[code].get(field) or "" for code in codes])
+
+    icao_codes = sorted((airports[code]["icao"].upper(), index) for index, code in enumerate(codes) if airports[code].get("icao"))
+    writer.add("icao_codes", np.array([icao.encode("ascii") for icao, _ in icao_codes], dtype="S4"))
+    writer.add("icao_airports", np.array([index for _, index in icao_codes], dtype="<i4"))
+
+    airports_by_key: dict[str, list[int]] = {}
+    for index, code in enumerate(codes):
+        for key in (normalize(airports[code]["name"]), normalize(airports[code].get("city", ""))):
+            if key and index not in airports_by_key.setdefault(key, []):
+                airports_by_key[key].append(index)
+    keys = sorted(airports_by_key)
+    writer.add_strings("keys", keys)
+    writer.add_postings("key_airports", [airports_by_key[key] for key in keys])
+
+    # every word boundary of a key is a prefix entry point, so "heathrow" finds "london heathrow"
+    suffixes = sorted((" ".join(words[i:]), key_id) for key_id, key in enumerate(keys) for words in (key.split(),) for i in range(len(words)))
+    writer.add_strings("suffixes", [suffix for suffix, _ in suffixes])
+    writer.add("suffix_keys", np.array([key_id for _, key_id in suffixes], dtype="<i4"))
+
+    keys_by_trigram: dict[str, list[int]] = {}
+    for key_id, key in enumerate(keys):
+        for trigram in trigrams(key):
+            keys_by_trigram.setdefault(trigram, []).append(key_id)
+    sorted_trigrams = sorted(keys_by_trigram)
+    writer.add("trigrams", np.array([trigram.encode("ascii") for trigram in sorted_trigrams], dtype="S3"))
+    writer.add_postings("trigram_keys", [keys_by_trigram[trigram] for trigram in sorted_trigrams])
+    writer.add("key_trigram_counts", np.array([len(trigrams(key)) for key in keys], dtype="<i4"))
+
+    return writer.to_bytes({"format": TABLE_FORMAT, "source": source_version(), "count": len(codes), "metro_codes": metro_codes or {}})
+
+class AirportTable(Mapping):
+    '''
+    read-only view over a compiled table, a mapping from IATA code to an airportsdata style record
+
+    nothing is parsed or copied when it is opened: every column is a numpy view over the buffer.
+    over a mapped file the pages are shared by every process reading the same file through the
+    page cache, so workers add almost nothing to each other's resident memory
+    '''
+    def __init__(self, buffer):
+        self.buffer = buffer
+        magic, header_length, _ = PREAMBLE.unpack_from(buffer, 0)
+        if magic != TABLE_MAGIC:
+            raise ValueError("Not an airport table")
+        self.header = json.loads(bytes(buffer[PREAMBLE.size:PREAMBLE.size + header_length]))
+        self.body_offset = PREAMBLE.size + header_length
+        self.data = memoryview(buffer)
+
+        self.iata = self.section("iata")
+        self.latitudes = self.section("lat")
+        self.longitudes = self.section("lon")
+        self.elevations = self.section("elevation")
+        self.columns = {field: self.strings(field) for field in STRING_FIELDS}
+        self.icao_codes = self.section("icao_codes")
+        self.icao_airports = self.section("icao_airports")
+        self.keys = self.strings("keys")
+        self.key_airports = self.postings("key_airports")
+        self.suffixes = self.strings("suffixes")
+        self.suffix_keys = self.section("suffix_keys")
+        self.trigrams = self.section("trigrams")
+        self.trigram_keys = self.postings("trigram_keys")
+        self.key_trigram_counts = self.section("key_trigram_counts")
+        # missing from tables of an older format, open_airport_table rejects those after construction
+        self.metro_codes = self.header.get("metro_codes", {})
+
+    def section(self, name: str) -> np.ndarray:
+        offset, dtype, count = self.header["sections"][name]
+        return np.frombuffer(self.buffer, dtype=np.dtype(dtype), count=count, offset=self.body_offset + offset)
+
+    def strings(self, name: str) -> StringColumn:
+        offsets = self.section(name + ".offsets")
+        offset = self.header["sections"][name + ".data"][0]
+        return StringColumn(offsets, self.data[self.body_offset + offset:self.body_offset + offset + int(offsets[-1])])
+
+    def postings(self, name: str) -> Postings:
+        return Postings(self.section(name + ".offsets"), self.section(name + ".values"))
+
+    def __len__(self) -> int:
+        return len(self.iata)
+
+    def __iter__(self):
+        for code in self.iata.tolist():
+            yield code.decode("ascii")
+
+    def __getitem__(self, code: str) -> dict:
+        index = self.index_of(code)
+        if index is None:
+            raise KeyError(code)
+        return self.record(index)
+
+    def index_of(self, code: str) -> int:
+        '''
+        the row of an IATA code, or None
+        '''
+        return sorted_position(self.iata, code)
+
+    def find_code(self, code: str) -> int:
+        '''
+        the row of an airport by IATA or ICAO code, or None
+        '''
+        index = sorted_position(self.iata, code)
+        if index is None:
+            position = sorted_position(self.icao_codes, code)
+            index = int(self.icao_airports[position]) if position is not None else None
+        return index
+
+    def code(self, index: int) -> str:
+        return self.iata[index].decode("ascii")
+
+    def field(self, name: str, index: int) -> str:
+        return self.columns[name][index]
+
+    def record(self, index: int) -> dict:
+        record = {field: self.columns[field][index] for field in STRING_FIELDS}
+        record.update(
+            iata=self.code(index),
+            lat=float(self.latitudes[index]),
+            lon=float(self.longitudes[index]),
+            elevation=float(self.elevations[index])
+        )
+        return record
+
+    def find_key(self, key: str) -> int:
+        '''
+        the id of a normalized name or city key, or None
+        '''
+        position = bisect.bisect_left(self.keys, key)
+        if position < len(self.keys) and self.keys[position] == key:
+            return position
+        return None
+
+    def metro_code(self, city: str, country: str) -> str:
+        '''
+        the IATA code covering every airport of a multi airport city (Tokyo, JP is TYO), or None
+        '''
+        return self.metro_codes.get(country, {}).get(normalize(city))
+
+    def trigram_key_ids(self, trigram: str) -> np.ndarray:
+        position = sorted_position(self.trigrams, trigram)
+        return self.trigram_keys[position] if position is not None else None
+
+def sorted_position(column: np.ndarray, value: str) -> int:
+    '''
+    the position of value in a sorted fixed width bytes column, or None
+    '''
+    try:
+        encoded = value.encode("ascii")
+    except UnicodeEncodeError:
+        return None
+    if len(encoded) == 0 or len(encoded) > column.dtype.itemsize:
+        return None
+    position = int(np.searchsorted(column, encoded))
+    if position < len(column) and column[position] == encoded:
+        return position
+    return None
+
+def build_airport_table(path: str = AIRPORT_TABLE_PATH) -> str:
+    '''
+    compiles airportsdata into path, written to a temporary file first and renamed into place so a
+    worker never maps a half written table and the workers already mapping the old one keep it
+    '''
+    import airportsdata
+
+    table = compile_airport_table(airportsdata.load('IATA'), load_metro_codes())
+    directory = os.path.dirname(os.path.abspath(path))
+    file_descriptor, temporary_path = tempfile.mkstemp(dir=directory, prefix=".airports-")
+    try:
+        with os.fdopen(file_descriptor, "wb") as file:
+            file.write(table)
+        # mkstemp creates the file private, the workers may run as another user
+        os.chmod(temporary_path, 0o644)
+        os.replace(temporary_path, path)
+    except BaseException:
+        os.unlink(temporary_path)
+        raise
+    return path
+
+def open_airport_table(path: str = AIRPORT_TABLE_PATH) -> AirportTable:
+    '''
+    maps a compiled table read-only, None if it is missing, unreadable or compiled from another airportsdata release
+    '''
+    try:
+        with open(path, "rb") as file:
+            mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        table = AirportTable(mapped)
+    except (OSError, ValueError, struct.error):
+        return None
+    if table.header.get("format") != TABLE_FORMAT or table.header.get("source") != source_version():
+        return None
+    return table
+
+@functools.cache
+def get_airport_table() -> AirportTable:
+    '''
+    maps the table at AIRPORT_TABLE_PATH on first use, compiling it first if it is missing or stale
+
+    if it can't be written there (e.g. a read-only install) the table is compiled into memory for this worker only
+    '''
+    table = open_airport_table(AIRPORT_TABLE_PATH)
+    if table is not None:
+        return table
+    try:
+        build_airport_table(AIRPORT_TABLE_PATH)
+    except OSError as error:
+        import airportsdata
+
+        print(f"Could not write the airport table at {AIRPORT_TABLE_PATH} ({error}), compiling it in memory instead")
+        return AirportTable(compile_airport_table(airportsdata.load('IATA'), load_metro_codes()))
+    table = open_airport_table(AIRPORT_TABLE_PATH)
+    if table is None:
+        raise RuntimeError("Could not open the airport table at " + AIRPORT_TABLE_PATH)
+    return table
+
+if __name__ == "__main__":
+    path = build_airport_table(sys.argv[1] if len(sys.argv) > 1 else AIRPORT_TABLE_PATH)
+    table = open_airport_table(path)
+    print(f"{path}: {len(table)} airports, {len(table.keys)} keys, {len(table.trigrams)} trigrams, {os.path.getsize(path) / 1e6:.2f} MB ({table.header['source']})")
@@ -1,49 +1,34 @@
-import json
+import asyncio
+import datetime
+import functools
 import os
-import requests
+import time
 
 from dotenv import load_dotenv
-from llama_cloud import ChatMessage, MessageRole
+from llama_index.core.llms import ChatMessage, MessageRole
 from llama_index.core.tools import FunctionTool
 from llama_index.core import ChatPromptTemplate
-from llama_index.llms.together import TogetherLLM
-import airportsdata
 
 import utilities
 import session_manager
+from admission import admission_controller
+from amadeus_client import amadeus_client
+from completion_cache import completion_cache
+from flight_offers import get_flight_offer_table, FLIGHT_OFFERS_SHOWN
+from airport_index import get_airport_index
+from geo_index import get_geo_index
+import llm
+import metrics
+import prefetch
+from chat_history import estimate_tokens
 
 load_dotenv()
 
-TOGETHER_API_KEY = os.getenv("TOGETHER_API_KEY")
-AMADEUS_API_URL = os.getenv("AMADEUS_API_URL")
-AMADEUS_API_KEY = os.getenv("AMADEUS_API_KEY")
-AMADEUS_API_SECRET = os.getenv("AMADEUS_API_SECRET")
+FLEXIBLE_SEARCH_CONCURRENCY = int(os.getenv("FLEXIBLE_SEARCH_CONCURRENCY", "4"))
+FLEXIBLE_SEARCH_MAX_SEARCHES = int(os.getenv("FLEXIBLE_SEARCH_MAX_SEARCHES", "30"))
+FLEXIBLE_SEARCH_RESULTS = int(os.getenv("FLEXIBLE_SEARCH_RESULTS", "5"))
 
-airports = airportsdata.load('IATA')
-llama3 = TogetherLLM(
-    model="meta-llama/Meta-Llama-3-70B-Instruct-Turbo", api_key=TOGETHER_API_KEY
-)
-
-amadeus_token_url = "https://test.api.amadeus.com/v1/security/oauth2/token"
-token_request_headers = {
-    "Content-Type": "application/x-www-form-urlencoded"
-}
-token_request_data = {
-    "grant_type": "client_credentials",
-    "client_id": AMADEUS_API_KEY,
-    "client_secret": AMADEUS_API_SECRET
-}
-
-response = requests.post(amadeus_token_url, headers=token_request_headers, data=token_request_data)
-print(response.json())
-amadeus_access_token = response.json()["access_token"]
-
-authorization_header = {
-    "Authorization": "Bearer " + amadeus_access_token
-}
-
-amadeus_flight_offers_url = "https://test.api.amadeus.com/v2/shopping/flight-offers"
-amadeus_activities_url = "https://test.api.amadeus.com/v1/shopping/activities"
+WEEKDAYS = {"mon": 0, "tue": 1, "wed": 2, "thu": 3, "fri": 4, "sat": 5, "sun": 6}
 
 def get_today() -> str:
     '''
@@ -56,19 +41,69 @@ def get_today() -> str:
 def get_airport_iata(airport_name: str) -> str:
     '''
     parameter:\n
-    airport_name: the full name of the airport\n
+    airport_name: the name of the airport, the city it serves, or its IATA/ICAO code\n
 
     uses this function if you want to make certain of airport code
-    returns the airport IATA code from the full airport name
-
-    Ensures that you convert city name to their international airports for this function to work
+    returns the airport IATA code, or a ranked list of candidate airports if the input is ambiguous
     '''
-    for code, airport in airports.items():
-        if airport['name'] == airport_name:
-            return code
-    return "Your input is not a valid airport name. End the conversation and ask it from the user.     if you already knows which airport the user is most likely heading to, input the full airport name instead"
+    candidates = get_airport_index().search(airport_name, limit=5)
+    if len(candidates) == 0:
+        return "Your input is not a valid airport name. End the conversation and ask it from the user.     if you already knows which airport the user is most likely heading to, input the full airport name instead"
+
+    best_candidate = candidates[0]
+    if best_candidate["score"] >= 0.9 and (len(candidates) == 1 or best_candidate["score"] - candidates[1]["score"] >= 0.1):
+        return best_candidate["iata"]
 
-def generate_summary_text(user_query: str, conversation_id: str) -> str:
+    return "Possible airports (best match first): " + "; ".join(
+        candidate["iata"] + " - " + candidate["name"] + ", " + candidate["city"] + ", " + candidate["country"]
+        for candidate in candidates
+    )
+
+def locate_city(city: str) -> str:
+    '''
+    This tool finds a city and the IATA codes of its airports, with the coordinate they are around. Use it instead of working them out yourself.
+    city: the name of the city, optionally followed by its two letter country code, e.g. "Paris" or "Paris, FR" (this will be a string)
+    '''
+    name, _, country = city.rpartition(",")
+    if len(country.strip()) != 2:
+        name, country = city, ""
+    candidates = get_geo_index().locate_city(name, country.strip(), limit=3)
+    if len(candidates) == 0:
+        return "No city called " + city + " has an airport. Ask the user for a nearby larger city, or use find_nearby_airports if you know its coordinates"
+
+    return "Cities (most likely first): " + "; ".join(
+        ", ".join(part for part in (candidate["city"], candidate["subd"], candidate["country"]) if part)
+        + ": its airports are around latitude " + str(candidate["latitude"]) + ", longitude " + str(candidate["longitude"])
+        + ", airports " + ", ".join(airport["iata"] + " (" + airport["name"] + ")" for airport in candidate["airports"][:4])
+        + metro_code_text(candidate["city"], candidate["country"])
+        for candidate in candidates
+    )
+
+def metro_code_text(city: str, country: str) -> str:
+    metro_code = get_airport_index().table.metro_code(city, country)
+    if metro_code is None:
+        return ""
+    return ", city code " + metro_code + " (searches all of its airports)"
+
+def find_nearby_airports(latitude: float, longitude: float, radius_km: float = 0) -> str:
+    '''
+    This tool lists the airports closest to a coordinate, e.g. to fly to a place that has no airport of its own.
+    latitude, longitude: the coordinate (floats)\n
+    radius_km: list every airport within this many kilometers, 0 for the five closest airports (this will be a float)
+    '''
+    if radius_km and radius_km > 0:
+        airports = get_geo_index().within(latitude, longitude, radius_km)
+    else:
+        airports = get_geo_index().nearest(latitude, longitude)
+    if len(airports) == 0:
+        return "There is no airport within " + str(radius_km) + " km. Try a larger radius"
+
+    return "Airports (closest first): " + "; ".join(
+        airport["iata"] + " - " + airport["name"] + ", " + airport["city"] + ", " + airport["country"] + " (" + str(airport["distance_km"]) + " km)"
+        for airport in airports
+    )
+
+async def generate_summary_text(user_query: str, conversation_id: str) -> str:
     '''
     generates a summary text from the user query
     '''
@@ -77,7 +112,7 @@ def generate_summary_text(user_query: str, conversation_id: str) -> str:
     if current_session == None:
         return {"error": "No such conversation exists"}
     
-    current_session.messages.append(session_manager.Message("User", user_query))
+    current_session.add_message(session_manager.Message("User", user_query))
 
     #summary_text = aitools.generate_summary_text(user_query, current_session.conversation_id)
 
@@ -145,16 +180,44 @@ def generate_summary_text(user_query: str, conversation_id: str) -> str:
     
     message_template = ChatPromptTemplate(message_templates = message_construct)
 
-    current_session.messages.append(session_manager.Message("AI", ""))
+    current_session.add_message(session_manager.Message("AI", ""))
     #message_template = ChatPromptTemplate(message_construct)
 
-    #print(message_template.format(history=current_session.get_chat_history(), query=user_query))
-    llm_response = llama3.complete(
-    message_template.format( history=current_session.get_chat_history(), query=user_query))
-    #full_response = ""
-    #for message in llm_response_stream:
-    #    full_response += message.delta
-    return llm_response.text
+    # stream the reply so the user sees the first tokens while the rest is still being generated
+    prompt = message_template.format( history=current_session.get_chat_history(), query=user_query)
+
+    # the same opener with the same history always gets the same summary, don't pay the model for it twice
+    cache_key = completion_cache.key(llm.TOGETHER_MODEL, prompt)
+    cached_response = completion_cache.get(cache_key)
+    if cached_response is not None:
+        metrics.llm_tokens.inc(estimate_tokens(cached_response), "summary", "cached")
+        current_session.emit_message(session_manager.YumeTravelResponse(session_manager.YumeConversationResponseTypes.ON_RESPONSE, cached_response, is_delta=True))
+        current_session.emit_message(session_manager.YumeTravelResponse(session_manager.YumeConversationResponseTypes.ON_RESPONSE, cached_response))
+        prefetch.prefetch_from_text(current_session, cached_response)
+        return cached_response
+
+    metrics.llm_tokens.inc(estimate_tokens(prompt), "summary", "prompt")
+    started_at = time.perf_counter()
+    full_response = ""
+    # the summary call was already charged when the query was admitted
+    async with admission_controller.llm_call(conversation_id, cost=0):
+        llm_response_stream = await llm.get_llm().astream_complete(prompt)
+        async for message in llm_response_stream:
+            if not message.delta:
+                continue
+            if full_response == "":
+                metrics.stage_seconds.observe(time.perf_counter() - started_at, "summary_first_token")
+            metrics.llm_tokens.inc(1, "summary", "completion") # the stream yields about one token per delta
+            full_response += message.delta
+            current_session.emit_message(session_manager.YumeTravelResponse(session_manager.YumeConversationResponseTypes.ON_RESPONSE, message.delta, is_delta=True))
+            # the slots are one per line, once a line is complete the flight search may start while the rest streams in
+            if "\n" in message.delta:
+                prefetch.prefetch_from_text(current_session, full_response[:full_response.rfind("\n")], partial=True)
+    current_session.emit_message(session_manager.YumeTravelResponse(session_manager.YumeConversationResponseTypes.ON_RESPONSE, full_response))
+    prefetch.prefetch_from_text(current_session, full_response)
+    if full_response:
+        completion_cache.set(cache_key, full_response)
+    return full_response
 
 def add_summary_text(conversation_id: str, text: str):
     '''
@@ -166,10 +229,10 @@ def add_summary_text(conversation_id: str, text: str):
     if len(current_session.messages) == 0:
         return "There is no messages!"
     
-    current_session.messages[-1].content += text
-    current_session.messages[-1].responses.append(utilities.SummaryMessage(text).construct())
+    current_session.append_to_latest_message(text)
+    current_session.add_response(utilities.SummaryMessage(text))
 
-def add_possible_places_text(conversation_id: str, latitude: float, longitude: float):
+async def add_possible_places_text(conversation_id: str, latitude: float, longitude: float):
     '''
     This tool is for finding possible activities to do around a particular coordinate which is in latitude and longitude.
     Before you call this tool ensure you have the following information:
@@ -179,21 +242,25 @@ def add_possible_places_text(conversation_id: str, latitude: float, longitude: f
     longitude: This is a float as well
 
     Important Notes:
-    If you have a city name instead convert it to its latitude and longitude coordinates which are the actual arguments to the tool.
+    If you have a city name instead, use the latitude and longitude of its centre (or of the area the user stays in), they are the actual arguments to the tool. locate_city only gives where the airports of a city are, which can be far out of its centre.
     '''
     current_session = session_manager.session_controller.get_session(conversation_id)
     if current_session == None:
         return "The conversation is invalid! It is impossible to do anything. Quit the conversation"
-    
-    search_place_request_params = {
-        "latitude": latitude,
-        "longitude": longitude
-    }
-    activities_response = requests.get(amadeus_activities_url, headers=authorization_header, params = search_place_request_params)
+
+    current_session.add_response(await fetch_possible_places(latitude, longitude))
+    # 1. Search for Places to Visit
+    return "Great! Possible activities to do in a particular place have been added to the latest message."
+
+async def fetch_possible_places(latitude: float, longitude: float) -> utilities.PossiblePlacesMessage:
+    '''
+    looks up activities around a coordinate without touching any session
+    '''
+    activities_response = await amadeus_client.search_activities(latitude, longitude)
     places = []
-    print(activities_response.json())
+    print(activities_response)
     i = 0
-    for activity in activities_response.json()["data"]:
+    for activity in activities_response.get("data", []):
         if i == 3:
             break
         places.append({
@@ -207,11 +274,9 @@ def add_possible_places_text(conversation_id: str, latitude: float, longitude: f
         })
         i += 1
 
-    current_session.messages[-1].responses.append(utilities.PossiblePlacesMessage(places).construct())
-    # 1. Search for Places to Visit
-    return "Great! Possible activities to do in a particular place have been added to the latest message."
+    return utilities.PossiblePlacesMessage(places)
 
-def add_possible_flights_text(conversation_id: str, originLocationCode: str, destinationLocationCode: str, departureDate: str, adults: int = 1):
+async def add_possible_flights_text(conversation_id: str, originLocationCode: str, destinationLocationCode: str, departureDate: str, adults: int = 1):
     '''
     This tool is for booking flights.
     Before you call this tool ensure you have the following information since these are the arguments needed for the tool:
@@ -221,7 +286,8 @@ def add_possible_flights_text(conversation_id: str, originLocationCode: str, des
     adults: the number of adults (this will be an integer)
 
     Important Notes:
-    make sure you convert city names to their relevant international airport IATA code.
+    make sure you convert city names to their relevant international airport IATA code, locate_city gives the airports of a city.
+    For a city with several airports use its city code if locate_city gives one (TYO for Tokyo), it searches all of them.
     '''
 
     # 1. Search for Available Flights to a particular place and their pricing
@@ -237,42 +303,185 @@ def add_possible_flights_text(conversation_id: str, originLocationCode: str, des
     if len(originLocationCode) == 0 or len(destinationLocationCode) == 0 or len(departureDate) == 0 or adults == -1 :
         return "There isn't enough detail to use this tool yet. Try using other tools like get_today and revisit this tool"
 
-    flight_offers_request_data = {
-        "originLocationCode": originLocationCode,
-        "destinationLocationCode": destinationLocationCode,
-        "departureDate": departureDate,
-        "adults": adults,
-        "max": 3,
-        "currencyCode": "USD"
-    }
-    flight_offers_response = requests.get(amadeus_flight_offers_url, headers=authorization_header, params = flight_offers_request_data)
-    
-    flight_offers = []
-    i = 0
-    print(flight_offers_response.json())
-    for flight_offer in flight_offers_response.json()["data"]:
-        if i == 3:
-            break
-        flight_offer = {
-            "AircraftType": flight_offer["itineraries"][0]["segments"][0]["aircraft"]["code"],
-            "Airline": flight_offer["itineraries"][0]["segments"][0]["carrierCode"],
-            "DepartureTime": departureDate,
-            "ArrivalTime": flight_offer["itineraries"][0]["segments"][-1]["arrival"]["at"],
-            "Price": flight_offer["price"]["total"]
-        }
-        i += 1
-    flight_offers.append(flight_offer)
+    current_session.add_response(await fetch_possible_flights(originLocationCode, destinationLocationCode, departureDate, adults))
+    current_session.set_flight_search({"originLocationCode": originLocationCode, "destinationLocationCode": destinationLocationCode, "departureDate": departureDate, "adults": adults})
+    return "Great! The possible flights have been added to the latest message!"
 
-    current_session.messages[-1].responses.append(utilities.PossibleFlightsMessage(flight_offers).construct())
+async def fetch_possible_flights(originLocationCode: str, destinationLocationCode: str, departureDate: str, adults: int = 1) -> utilities.PossibleFlightsMessage:
+    '''
+    looks up flight offers without touching any session, the whole offer set stays cached for refine_flights_text
+    '''
+    table = await get_flight_offer_table(originLocationCode, destinationLocationCode, departureDate, adults)
+    return utilities.PossibleFlightsMessage(table.rank(FLIGHT_OFFERS_SHOWN))
 
-    print(json.dumps(flight_offers))
-    return "Great! The possible flights have been added to the latest message!"
+async def refine_flights_text(conversation_id: str, sort_by: str = "balanced", max_price: float = 0, max_duration_hours: float = 0, max_stops: int = -1, airline: str = ""):
+    '''
+    This tool is for follow-ups on the flights already shown, like "anything cheaper?", "anything shorter?", "only direct flights" or "only with Air France".
+    It re-ranks every offer of the latest flight search, so use it instead of searching the same flights again.
+    sort_by: one of "price", "duration", "stops" or "balanced" (this will be a string)\n
+    max_price: the highest acceptable price, 0 for no limit (this will be a float)\n
+    max_duration_hours: the longest acceptable travel time in hours, 0 for no limit (this will be a float)\n
+    max_stops: the most stops acceptable, 0 for direct flights only, -1 for no limit (this will be an integer)\n
+    airline: only flights with this airline's IATA code, e.g. "AF", empty for any airline (this will be a string)
+    '''
+    current_session = session_manager.session_controller.get_session(conversation_id)
+    if current_session == None:
+        return "The conversation is invalid! It is impossible to do anything. Quit the conversation"
+    if current_session.flight_search is None:
+        return "No flights were searched in this conversation yet. Use add_possible_flights_text first"
+
+    flights = await fetch_refined_flights(**current_session.flight_search, sort_by=sort_by, max_price=max_price, max_duration_hours=max_duration_hours, max_stops=max_stops, airline=airline)
+    offer_count = len(await get_flight_offer_table(**current_session.flight_search))
+    if len(flights.content) == 0:
+        return "None of the " + str(offer_count) + " offers of the latest search match. Tell the user and suggest relaxing a limit"
+    current_session.add_response(flights)
+    return "Great! The best matching flights out of " + str(offer_count) + " offers have been added to the latest message!"
+
+async def fetch_refined_flights(originLocationCode: str, destinationLocationCode: str, departureDate: str, adults: int = 1, sort_by: str = "balanced", max_price: float = 0, max_duration_hours: float = 0, max_stops: int = -1, airline: str = "") -> utilities.PossibleFlightsMessage:
+    '''
+    re-ranks the cached offers of a flight search for a follow-up without touching any session, empty if none match
+    '''
+    table = await get_flight_offer_table(originLocationCode, destinationLocationCode, departureDate, adults)
+    return utilities.PossibleFlightsMessage(table.rank(
+        FLIGHT_OFFERS_SHOWN,
+        sort_by=sort_by.strip().lower(),
+        max_price=max_price if max_price and max_price > 0 else None,
+        max_duration_minutes=int(max_duration_hours * 60) if max_duration_hours and max_duration_hours > 0 else None,
+        max_stops=max_stops if max_stops is not None and max_stops >= 0 else None,
+        airline=airline
+    ))
+
+async def add_possible_flights_and_places_text(conversation_id: str, originLocationCode: str, destinationLocationCode: str, departureDate: str, adults: int, latitude: float, longitude: float):
+    '''
+    This tool is for when the user wants both flights and things to do at the destination.
+    It searches flights and activities at the same time, which is faster than calling add_possible_flights_text and add_possible_places_text one after another.
+    Before you call this tool ensure you have all the arguments of both of those tools:
+    originLocationCode, destinationLocationCode: IATA codes (strings)\n
+    departureDate: the date of departure in the format YYYY-MM-DD (this will be a string)\n
+    adults: the number of adults (this will be an integer)\n
+    latitude, longitude: the coordinates of the destination city (floats)
+    '''
+    current_session = session_manager.session_controller.get_session(conversation_id)
+    if current_session == None:
+        return "The conversation is invalid! It is impossible to do anything. Quit the conversation"
+
+    latest_message_index = len(current_session.messages) - 1
+    flights, places = await asyncio.gather(
+        fetch_possible_flights(originLocationCode, destinationLocationCode, departureDate, adults),
+        fetch_possible_places(latitude, longitude)
+    )
+    current_session.add_response(flights, latest_message_index)
+    current_session.add_response(places, latest_message_index)
+    current_session.set_flight_search({"originLocationCode": originLocationCode, "destinationLocationCode": destinationLocationCode, "departureDate": departureDate, "adults": adults})
+    return "Great! The possible flights and activities have been added to the latest message!"
+
+def rank_flights(flights: list[dict], limit: int) -> list[dict]:
+    '''
+    cheapest first, earlier departures first among equal prices
+    '''
+    return sorted(flights, key=lambda flight: (float(flight["Price"]), flight["DepartureTime"]))[:limit]
+
+def expand_dates(departureDateFrom: str, departureDateTo: str, weekdays: str = "") -> list[str]:
+    '''
+    every date of the range (both ends included), optionally only the given weekdays, e.g. "fri,sat"
+    '''
+    start = datetime.date.fromisoformat(departureDateFrom.strip())
+    end = datetime.date.fromisoformat((departureDateTo or departureDateFrom).strip())
+    allowed_weekdays = {WEEKDAYS[day.strip().lower()[:3]] for day in weekdays.split(",") if day.strip()}
+    dates = []
+    day = start
+    while day <= end:
+        if len(allowed_weekdays) == 0 or day.weekday() in allowed_weekdays:
+            dates.append(day.isoformat())
+        day += datetime.timedelta(days=1)
+    return dates
+
+async def fetch_flexible_flights(originLocationCode: str, destinationLocationCodes: list[str], departureDates: list[str], adults: int = 1, on_partial_result=None) -> utilities.PossibleFlightsMessage:
+    '''
+    searches every destination on every date, at most FLEXIBLE_SEARCH_CONCURRENCY searches at a time
+
+    on_partial_result is called with the best flights found so far every time a search comes back,
+    searches that fail are skipped so one bad date does not lose the others
+    '''
+    semaphore = asyncio.Semaphore(FLEXIBLE_SEARCH_CONCURRENCY)
+    flights = []
+
+    async def search(destinationLocationCode: str, departureDate: str):
+        async with semaphore:
+            table = await get_flight_offer_table(originLocationCode, destinationLocationCode, departureDate, adults)
+        for offer in table.rank(FLEXIBLE_SEARCH_RESULTS, sort_by="price"):
+            flights.append(dict(offer, Destination=destinationLocationCode, DepartureDate=departureDate))
+        if on_partial_result is not None:
+            on_partial_result(rank_flights(flights, FLEXIBLE_SEARCH_RESULTS))
+
+    results = await asyncio.gather(
+        *(search(destinationLocationCode, departureDate) for destinationLocationCode in destinationLocationCodes for departureDate in departureDates),
+        return_exceptions=True
+    )
+    for result in results:
+        if isinstance(result, Exception):
+            print("Flight search failed: " + repr(result))
+    return utilities.PossibleFlightsMessage(rank_flights(flights, FLEXIBLE_SEARCH_RESULTS))
+
+async def search_flexible_flights_text(conversation_id: str, originLocationCode: str, destinationLocationCodes: str, departureDateFrom: str, departureDateTo: str, adults: int = 1, weekdays: str = ""):
+    '''
+    This tool is for finding the cheapest flights when the user is flexible about the date or the destination,
+    e.g. "the cheapest weekend in May to Tokyo or Osaka". Use it instead of calling add_possible_flights_text once per date or city.
+    originLocationCode: the IATA code of the origin location (this will be a string)\n
+    destinationLocationCodes: the IATA codes of every destination to consider, separated by commas, e.g. "HND,KIX" (this will be a string)\n
+    departureDateFrom: the first possible departure date in the format YYYY-MM-DD (this will be a string)\n
+    departureDateTo: the last possible departure date in the format YYYY-MM-DD, the same as departureDateFrom for a single day (this will be a string)\n
+    adults: the number of adults (this will be an integer)\n
+    weekdays: only depart on these days of the week, separated by commas, e.g. "fri,sat" for weekends, empty for any day (this will be a string)
+    '''
+    current_session = session_manager.session_controller.get_session(conversation_id)
+    if current_session == None:
+        return "The conversation is invalid! It is impossible to do anything. Quit the conversation"
+
+    destinationLocationCodes = [code.strip().upper() for code in destinationLocationCodes.split(",") if code.strip()]
+    try:
+        departureDates = expand_dates(departureDateFrom, departureDateTo, weekdays)
+    except (ValueError, KeyError):
+        return "The dates must be in the format YYYY-MM-DD and the weekdays like mon,tue,wed. Fix the arguments and try again"
+    if len(destinationLocationCodes) == 0 or len(departureDates) == 0:
+        return "There isn't enough detail to use this tool yet. Try using other tools like get_today and revisit this tool"
+    search_count = len(destinationLocationCodes) * len(departureDates)
+    if search_count > FLEXIBLE_SEARCH_MAX_SEARCHES:
+        return "That is " + str(search_count) + " searches, at most " + str(FLEXIBLE_SEARCH_MAX_SEARCHES) + " are allowed. Narrow the dates (e.g. with weekdays) or the destinations and try again"
+
+    latest_message_index = len(current_session.messages) - 1
+    response_index = None
+
+    def show_flights(flights: utilities.PossibleFlightsMessage):
+        # the first ranking is added to the message and every later one replaces it, so pollers see it fill in too
+        nonlocal response_index
+        if response_index is None:
+            current_session.add_response(flights, latest_message_index)
+            response_index = len(current_session.messages[latest_message_index].responses) - 1
+        else:
+            current_session.replace_response(flights, latest_message_index, response_index)
+
+    def on_partial_result(flights: list[dict]):
+        if len(flights) == 0:
+            return
+        partial_flights = utilities.PossibleFlightsMessage(flights)
+        show_flights(partial_flights)
+        current_session.emit_message(session_manager.YumeTravelResponse(
+            session_manager.YumeConversationResponseTypes.ON_PARTIAL_RESULT,
+            partial_flights.construct()
+        ))
+
+    flights = await fetch_flexible_flights(originLocationCode, destinationLocationCodes, departureDates, adults, on_partial_result)
+    if len(flights.content) == 0:
+        return "No flights were found for these dates and destinations"
+    show_flights(flights)
+    return "Great! The cheapest flights over " + str(search_count) + " date and destination combinations have been added to the latest message!"
 
 def add_possible_places_to_stay_text(places: list[str]):
     '''
     adds a list of possible places to stay to the latest message that will be displayed to the user
     '''
-    return utilities.PossiblePlacesToStayMessage(places).to_json()
+    return utilities.PossiblePlacesToStayMessage(places).construct()
 
 def emit_message_generation_completed(conversation_id: str):
     '''
@@ -289,7 +498,7 @@ def end_message():
     '''
     return "Cool! You have done what you could do! Thank you"
 
-def update_context(conversation_id: str, total_context: str):
+async def update_context(conversation_id: str, total_context: str):
     '''
     updates the context string of the entire session
 
@@ -301,21 +510,53 @@ def update_context(conversation_id: str, total_context: str):
     current_session = session_manager.session_controller.get_session(conversation_id)
     if current_session == None:
         return "A session with the given conversation id does not exist"
-    current_session.context = total_context
+    current_session.set_context(total_context)
+    prefetch.prefetch_from_text(current_session, "")
     return "Nice! You have updated the context. You can move onto other parts using the initial input as the context"
 
-get_today_tool = FunctionTool.from_defaults(get_today)
-generate_summary_text_tool = FunctionTool.from_defaults(generate_summary_text)
-airport_iata_tool = FunctionTool.from_defaults(get_airport_iata)
-add_summary_tool = FunctionTool.from_defaults(add_summary_text)
-add_possible_places_tool = FunctionTool.from_defaults(add_possible_places_text)
-add_possible_flights_tool = FunctionTool.from_defaults(add_possible_flights_text)
-add_possible_places_to_stay_tool = FunctionTool.from_defaults(add_possible_places_to_stay_text)
-emit_message_generation_completed_tool = FunctionTool.from_defaults(emit_message_generation_completed)
-update_context_tool = FunctionTool.from_defaults(update_context)
-end_message_tool = FunctionTool.from_defaults(end_message)
+# session free lookups behind the tools, used to run several tool calls of one plan concurrently
+tool_fetchers = {
+    name: metrics.instrument_tool(name, fetcher) for name, fetcher in {
+        "add_possible_flights_text": fetch_possible_flights,
+        "add_possible_places_text": fetch_possible_places,
+        "refine_flights_text": fetch_refined_flights,
+    }.items()
+}
+
+# tools are built on first use, creating their schemas at import time slows down every worker boot
+tool_functions = {
+    "get_today_tool": (get_today, None),
+    "generate_summary_text_tool": (generate_summary_text, generate_summary_text),
+    "airport_iata_tool": (get_airport_iata, None),
+    "add_summary_tool": (add_summary_text, None),
+    "add_possible_places_tool": (add_possible_places_text, add_possible_places_text),
+    "add_possible_flights_tool": (add_possible_flights_text, add_possible_flights_text),
+    "add_possible_flights_and_places_tool": (add_possible_flights_and_places_text, add_possible_flights_and_places_text),
+    "search_flexible_flights_tool": (search_flexible_flights_text, search_flexible_flights_text),
+    "refine_flights_tool": (refine_flights_text, refine_flights_text),
+    "add_possible_places_to_stay_tool": (add_possible_places_to_stay_text, None),
+    "emit_message_generation_completed_tool": (emit_message_generation_completed, None),
+    # async so it runs on the event loop, it wakes the session's long-polls and may start a flight prefetch
+    "update_context_tool": (update_context, update_context),
+    "locate_city_tool": (locate_city, None),
+    "find_nearby_airports_tool": (find_nearby_airports, None),
+    "end_message_tool": (end_message, None),
+}
+
+@functools.cache
+def get_tool(name: str) -> FunctionTool:
+    fn, async_fn = tool_functions[name]
+    # labelled with the name the agent calls the tool by, pre-dispatched calls of the same tool share it
+    return FunctionTool.from_defaults(metrics.instrument_tool(fn.__name__, fn), async_fn=metrics.instrument_tool(fn.__name__, async_fn))
+
+def __getattr__(name: str):
+    # keeps aitools.<name>_tool working while building the tool lazily
+    if name in tool_functions:
+        return get_tool(name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 if __name__ == "__main__":
     #print(get_airport_iana("John F Kennedy International Airport"))
     #add_possible_flights_text("JFK", "LAX", "2024-07-25", 1)
-    add_possible_places_text("35.6764", 35.6764, 139.6500)
\ No newline at end of file
+    import asyncio
+    asyncio.run(add_possible_places_text("35.6764", 35.6764, 139.6500))
\ No newline at end of file
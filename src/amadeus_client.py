@@ -0,0 +1,190 @@
+'''async client for the Amadeus self-service APIs'''
+
+import asyncio
+import os
+import re
+import time
+
+import httpx
+from dotenv import load_dotenv
+
+from cache import GeoCache, SingleFlight
+import metrics
+
+load_dotenv()
+
+AMADEUS_API_KEY = os.getenv("AMADEUS_API_KEY")
+AMADEUS_API_SECRET = os.getenv("AMADEUS_API_SECRET")
+# AMADEUS_API_URL is the older setting and carries an API version, e.g. https://test.api.amadeus.com/v2
+AMADEUS_API_URL = os.getenv("AMADEUS_API_URL", "")
+AMADEUS_BASE_URL = (os.getenv("AMADEUS_BASE_URL") or re.sub(r"/v\d+/?$", "", AMADEUS_API_URL.rstrip("/")) or "https://test.api.amadeus.com").rstrip("/")
+
+AMADEUS_TIMEOUT = float(os.getenv("AMADEUS_TIMEOUT", "10"))
+AMADEUS_CONNECT_TIMEOUT = float(os.getenv("AMADEUS_CONNECT_TIMEOUT", "5"))
+AMADEUS_MAX_CONNECTIONS = int(os.getenv("AMADEUS_MAX_CONNECTIONS", "20"))
+AMADEUS_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("AMADEUS_MAX_KEEPALIVE_CONNECTIONS", "10"))
+AMADEUS_KEEPALIVE_EXPIRY = float(os.getenv("AMADEUS_KEEPALIVE_EXPIRY", "30"))
+
+ACTIVITIES_CACHE_CELL_DEGREES = float(os.getenv("ACTIVITIES_CACHE_CELL_DEGREES", "0.05"))
+ACTIVITIES_CACHE_RADIUS_KM = float(os.getenv("ACTIVITIES_CACHE_RADIUS_KM", "5"))
+ACTIVITIES_CACHE_TTL = float(os.getenv("ACTIVITIES_CACHE_TTL", "86400"))
+ACTIVITIES_CACHE_SIZE = int(os.getenv("ACTIVITIES_CACHE_SIZE", "4096"))
+ACTIVITIES_CACHE_MAX_BYTES = int(os.getenv("ACTIVITIES_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+# Amadeus searches 1 km around the coordinate by default and at most 20 km
+ACTIVITIES_SEARCH_RADIUS_KM = int(os.getenv("ACTIVITIES_SEARCH_RADIUS_KM", "10"))
+
+amadeus_token_url = AMADEUS_BASE_URL + "/v1/security/oauth2/token"
+amadeus_flight_offers_url = AMADEUS_BASE_URL + "/v2/shopping/flight-offers"
+amadeus_activities_url = AMADEUS_BASE_URL + "/v1/shopping/activities"
+
+class AmadeusError(Exception):
+    '''
+    raised when Amadeus answers with an error status or a body that is not JSON
+    '''
+    def __init__(self, status_code: int, detail: str):
+        super().__init__(f"Amadeus answered {status_code}: {detail}")
+        self.status_code = status_code
+        self.detail = detail
+
+class AmadeusClient:
+    '''
+    keeps a pooled keep-alive connection to Amadeus and the OAuth token needed to talk to it
+
+    every upstream call goes through the same httpx.AsyncClient, so repeated calls reuse warm
+    TLS connections instead of opening a fresh one each time. AMADEUS_MAX_CONNECTIONS caps the
+    number of connections per host (everything lives on one host)
+    '''
+    def __init__(self, api_key: str = AMADEUS_API_KEY, api_secret: str = AMADEUS_API_SECRET):
+        self.api_key = api_key
+        self.api_secret = api_secret
+        self.timeout = httpx.Timeout(AMADEUS_TIMEOUT, connect=AMADEUS_CONNECT_TIMEOUT)
+        self.limits = httpx.Limits(
+            max_connections=AMADEUS_MAX_CONNECTIONS,
+            max_keepalive_connections=AMADEUS_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=AMADEUS_KEEPALIVE_EXPIRY
+        )
+        self._http_client = None
+        self._access_token = None
+        self._token_expires_at = 0.0
+        self._token_lock = asyncio.Lock()
+        self.activities_cache = GeoCache(
+            ACTIVITIES_CACHE_CELL_DEGREES,
+            ACTIVITIES_CACHE_RADIUS_KM,
+            ACTIVITIES_CACHE_SIZE,
+            ACTIVITIES_CACHE_TTL,
+            ACTIVITIES_CACHE_MAX_BYTES
+        )
+        self._activities_coalescer = SingleFlight(self.activities_cache.stats)
+
+    def get_http_client(self) -> httpx.AsyncClient:
+        if self._http_client is None or self._http_client.is_closed:
+            self._http_client = httpx.AsyncClient(timeout=self.timeout, limits=self.limits, event_hooks=metrics.http_event_hooks("amadeus"))
+        return self._http_client
+
+    async def get_access_token(self) -> str:
+        '''
+        returns a valid access token, fetching a new one when the cached token is about to expire
+        '''
+        if self._access_token and time.monotonic() < self._token_expires_at:
+            return self._access_token
+
+        async with self._token_lock:
+            if self._access_token and time.monotonic() < self._token_expires_at:
+                return self._access_token
+
+            response = await self.get_http_client().post(
+                amadeus_token_url,
+                headers={"Content-Type": "application/x-www-form-urlencoded"},
+                data={
+                    "grant_type": "client_credentials",
+                    "client_id": self.api_key,
+                    "client_secret": self.api_secret
+                }
+            )
+            response.raise_for_status()
+            token_response = response.json()
+            self._access_token = token_response["access_token"]
+            # refresh a little early so requests in flight never carry an expired token
+            self._token_expires_at = time.monotonic() + max(token_response.get("expires_in", 1799) - 60, 0)
+            return self._access_token
+
+    async def get(self, url: str, params: dict) -> dict:
+        access_token = await self.get_access_token()
+        response = await self.get_http_client().get(
+            url,
+            headers={"Authorization": "Bearer " + access_token},
+            params=params
+        )
+        if response.status_code == 401:
+            # the token was revoked before its expiry, get a fresh one and try once more
+            self._access_token = None
+            access_token = await self.get_access_token()
+            response = await self.get_http_client().get(
+                url,
+                headers={"Authorization": "Bearer " + access_token},
+                params=params
+            )
+        try:
+            body = response.json()
+        except ValueError:
+            raise AmadeusError(response.status_code, "the response is not JSON: " + response.text[:200])
+        if not response.is_success:
+            errors = body.get("errors") if isinstance(body, dict) else None
+            detail = "; ".join(str(error.get("detail") or error.get("title")) for error in errors) if errors else str(body)[:200]
+            raise AmadeusError(response.status_code, detail)
+        return body
+
+    async def search_flight_offers(self, originLocationCode: str, destinationLocationCode: str, departureDate: str, adults: int, max_offers: int = 3) -> dict:
+        '''
+        searches flight offers
+
+        not cached here, flight_offers caches the table built from the response instead of the raw offers
+        '''
+        params = {
+            "originLocationCode": originLocationCode.strip().upper(),
+            "destinationLocationCode": destinationLocationCode.strip().upper(),
+            "departureDate": departureDate.strip(),
+            "adults": int(adults),
+            "max": max_offers,
+            "currencyCode": "USD"
+        }
+        return await self.get(amadeus_flight_offers_url, params)
+
+    async def search_activities(self, latitude: float, longitude: float) -> dict:
+        '''
+        searches activities around a coordinate, nearby coordinates reuse the cached activity list
+        '''
+        latitude = float(latitude)
+        longitude = float(longitude)
+        cached_response = self.activities_cache.get(latitude, longitude)
+        if cached_response is not None:
+            return cached_response
+
+        async def fetch_and_store():
+            response = await self.get(amadeus_activities_url, {
+                "latitude": latitude,
+                "longitude": longitude,
+                "radius": ACTIVITIES_SEARCH_RADIUS_KM
+            })
+            if "data" in response:
+                self.activities_cache.set(latitude, longitude, response)
+            return response
+
+        return await self._activities_coalescer.do(self.activities_cache.cell(latitude, longitude), fetch_and_store)
+
+    def cache_stats(self) -> dict:
+        return {
+            "activities": dict(
+                self.activities_cache.stats.to_json(),
+                size=len(self.activities_cache),
+                bytes=self.activities_cache.entries.current_bytes
+            )
+        }
+
+    async def close(self):
+        if self._http_client is not None:
+            await self._http_client.aclose()
+            self._http_client = None
+
+# Create a global instance of AmadeusClient shared by every tool
+amadeus_client = AmadeusClient()
@@ -0,0 +1,95 @@
+'''fans session events out to every websocket subscribed to a conversation'''
+
+import asyncio
+import os
+from collections import deque
+
+from fastapi import WebSocket
+
+SUBSCRIBER_QUEUE_SIZE = int(os.getenv("SUBSCRIBER_QUEUE_SIZE", "64"))
+
+class Subscriber:
+    '''
+    one websocket listening to a session, with its own bounded outbound queue
+
+    frames are queued without waiting and a dedicated task writes them to the socket, so a slow
+    client only ever delays itself. while the client lags behind, consecutive delta frames are
+    merged into one. if the queue is still full, the oldest delta frames are dropped first (the
+    final frame of a reply carries the whole text anyway), then the oldest frames
+    '''
+    def __init__(self, websocket: WebSocket, max_queue_size: int = SUBSCRIBER_QUEUE_SIZE):
+        self.websocket = websocket
+        self.max_queue_size = max_queue_size
+        self.queue = deque()
+        self.dropped_count = 0
+        self.closed = False
+        self._has_frames = asyncio.Event()
+        self._sender = None
+
+    def start(self, on_closed):
+        self._sender = asyncio.create_task(self._send_frames())
+        self._sender.add_done_callback(lambda _: on_closed(self))
+
+    def offer(self, frame):
+        if self.closed:
+            return
+
+        if len(self.queue) > 0 and frame.is_delta and self.queue[-1].is_delta and self.queue[-1].type == frame.type:
+            last_frame = self.queue.pop()
+            frame = type(frame)(frame.type, last_frame.response + frame.response, is_delta=True)
+        elif len(self.queue) >= self.max_queue_size:
+            self._drop_one()
+        self.queue.append(frame)
+        self._has_frames.set()
+
+    def _drop_one(self):
+        for index, queued_frame in enumerate(self.queue):
+            if queued_frame.is_delta:
+                del self.queue[index]
+                break
+        else:
+            self.queue.popleft()
+        self.dropped_count += 1
+
+    async def _send_frames(self):
+        try:
+            while not self.closed:
+                await self._has_frames.wait()
+                self._has_frames.clear()
+                while len(self.queue) > 0 and not self.closed:
+                    await self.websocket.send_text(self.queue.popleft().to_json())
+        except Exception:
+            # the socket is gone, the done callback unsubscribes us
+            pass
+        finally:
+            self.closed = True
+
+    def close(self):
+        self.closed = True
+        self.queue.clear()
+        if self._sender is not None:
+            self._sender.cancel()
+
+class SessionBroadcaster:
+    '''
+    the set of subscribers of one session, publishing never waits on the network
+    '''
+    def __init__(self):
+        self.subscribers: set[Subscriber] = set()
+
+    def __len__(self) -> int:
+        return len(self.subscribers)
+
+    def subscribe(self, websocket: WebSocket) -> Subscriber:
+        subscriber = Subscriber(websocket)
+        self.subscribers.add(subscriber)
+        subscriber.start(self.unsubscribe)
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber):
+        self.subscribers.discard(subscriber)
+        subscriber.close()
+
+    def publish(self, frame):
+        for subscriber in list(self.subscribers):
+            subscriber.offer(frame)
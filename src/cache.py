@@ -0,0 +1,236 @@
+'''in-memory caches used in front of the upstream APIs'''
+
+import asyncio
+import json
+import math
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Hashable
+
+class CacheStats:
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.coalesced = 0
+
+    def to_json(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "coalesced": self.coalesced,
+            "hit_rate": self.hits / lookups if lookups else 0.0
+        }
+
+class TTLCache:
+    '''
+    bounded LRU cache where every entry expires ttl seconds after it was stored
+
+    max_entries bounds the number of entries, least recently used entries are evicted first
+    '''
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.stats = CacheStats()
+        self._entries: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.stats.misses += 1
+                return default
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                self._remove(key)
+                self.stats.expirations += 1
+                self.stats.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.stats.hits += 1
+            return value
+
+    def peek(self, key: Hashable) -> Any:
+        '''
+        returns the live value for key without updating recency or the counters
+        '''
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            return None
+        return entry[1]
+
+    def touch(self, key: Hashable):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+
+    def set(self, key: Hashable, value: Any):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._on_set(key, value)
+            while len(self._entries) > self.max_entries:
+                self._evict_oldest()
+
+    def delete(self, key: Hashable):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            while self._entries:
+                self._remove(next(iter(self._entries)))
+
+    def _evict_oldest(self):
+        self._remove(next(iter(self._entries)))
+        self.stats.evictions += 1
+
+    def _remove(self, key: Hashable):
+        self._entries.pop(key)
+
+    def _on_set(self, key: Hashable, value: Any):
+        pass
+
+class SizedTTLCache(TTLCache):
+    '''
+    TTLCache that also evicts least recently used entries once the estimated size of the stored values exceeds max_bytes
+    '''
+    def __init__(self, max_entries: int, ttl: float, max_bytes: int, sizeof: Callable[[Any], int] = None):
+        super().__init__(max_entries, ttl)
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof or json_sizeof
+        self.current_bytes = 0
+        self._sizes: dict[Hashable, int] = {}
+
+    def _on_set(self, key: Hashable, value: Any):
+        size = self.sizeof(value)
+        self._sizes[key] = size
+        self.current_bytes += size
+        # always keep the newest entry, even if it alone is larger than the cap
+        while self.current_bytes > self.max_bytes and len(self._entries) > 1:
+            self._evict_oldest()
+
+    def _remove(self, key: Hashable):
+        super()._remove(key)
+        self.current_bytes -= self._sizes.pop(key, 0)
+
+def json_sizeof(value: Any) -> int:
+    '''
+    rough size estimate of a JSON-like value, good enough to enforce a memory cap
+    '''
+    return len(json.dumps(value, default=str))
+
+def haversine_km(latitude_a: float, longitude_a: float, latitude_b: float, longitude_b: float) -> float:
+    latitude_a, longitude_a, latitude_b, longitude_b = map(math.radians, (latitude_a, longitude_a, latitude_b, longitude_b))
+    a = math.sin((latitude_b - latitude_a) / 2) ** 2 + math.cos(latitude_a) * math.cos(latitude_b) * math.sin((longitude_b - longitude_a) / 2) ** 2
+    return 6371.0 * 2 * math.asin(math.sqrt(a))
+
+class GeoCache:
+    '''
+    caches values by location, snapping coordinates onto a grid of cell_degrees wide cells
+
+    a lookup is served by the entry stored for its own cell, or by an entry in one of the eight
+    neighbouring cells whose original coordinates are within radius_km of the query. this way
+    35.6764,139.65 and 35.68,139.65 share the same cached value even across a cell border
+    '''
+    def __init__(self, cell_degrees: float, radius_km: float, max_entries: int, ttl: float, max_bytes: int):
+        self.cell_degrees = cell_degrees
+        self.radius_km = radius_km
+        self.entries = SizedTTLCache(max_entries, ttl, max_bytes, sizeof=lambda entry: json_sizeof(entry[2]))
+        self.stats = self.entries.stats
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def cell(self, latitude: float, longitude: float) -> tuple[int, int]:
+        return (math.floor(latitude / self.cell_degrees), math.floor(longitude / self.cell_degrees))
+
+    def get(self, latitude: float, longitude: float) -> Any:
+        row, column = self.cell(latitude, longitude)
+        candidate_cells = [(row, column)]
+        if self.radius_km > 0:
+            candidate_cells += [(row + row_offset, column + column_offset) for row_offset in (-1, 0, 1) for column_offset in (-1, 0, 1) if row_offset or column_offset]
+
+        for index, key in enumerate(candidate_cells):
+            entry = self.entries.peek(key)
+            if entry is None:
+                continue
+            cached_latitude, cached_longitude, value = entry
+            if index == 0 or haversine_km(latitude, longitude, cached_latitude, cached_longitude) <= self.radius_km:
+                self.entries.touch(key)
+                self.stats.hits += 1
+                return value
+        self.stats.misses += 1
+        return None
+
+    def set(self, latitude: float, longitude: float, value: Any):
+        self.entries.set(self.cell(latitude, longitude), (latitude, longitude, value))
+
+class InFlightCall:
+    __slots__ = ("future", "waiters")
+
+    def __init__(self, future: asyncio.Future):
+        self.future = future
+        self.waiters = 0
+
+class SingleFlight:
+    '''
+    coalesces concurrent calls for the same key into a single upstream call
+
+    the first caller for a key runs the call, every caller that arrives while it is still
+    in flight awaits the same result instead of issuing a duplicate request. a call keeps
+    running as long as one of its callers waits for it, once the last one is cancelled
+    (e.g. a speculative prefetch whose slots changed) the upstream call is cancelled too
+    '''
+    def __init__(self, stats: CacheStats = None):
+        self.stats = stats
+        self._in_flight: dict[Hashable, InFlightCall] = {}
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        call = self._in_flight.get(key)
+        if call is None:
+            call = self._in_flight[key] = InFlightCall(asyncio.ensure_future(fn()))
+            call.future.add_done_callback(lambda _: self._forget(key, call))
+        elif self.stats is not None:
+            self.stats.coalesced += 1
+
+        call.waiters += 1
+        try:
+            return await asyncio.shield(call.future)
+        finally:
+            call.waiters -= 1
+            if call.waiters == 0 and not call.future.done():
+                # forgotten right away so a caller arriving meanwhile starts a fresh call instead of joining a cancelled one
+                self._forget(key, call)
+                call.future.cancel()
+
+    def _forget(self, key: Hashable, call: InFlightCall):
+        if self._in_flight.get(key) is call:
+            del self._in_flight[key]
+
+async def cached_call(cache: TTLCache, coalescer: SingleFlight, key: Hashable, fn: Callable[[], Awaitable[Any]], should_cache: Callable[[Any], bool] = None) -> Any:
+    '''
+    returns the cached value for key, otherwise runs fn once (coalesced with concurrent callers) and caches the result
+    '''
+    cached_value = cache.get(key)
+    if cached_value is not None:
+        return cached_value
+
+    async def fetch_and_store():
+        value = await fn()
+        if should_cache is None or should_cache(value):
+            cache.set(key, value)
+        return value
+
+    return await coalescer.do(key, fetch_and_store)
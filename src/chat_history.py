@@ -0,0 +1,67 @@
+'''incremental, token budgeted chat history used to build LLM prompts'''
+
+import os
+from collections import deque
+
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "2000"))
+HISTORY_COMPACTED_TOKEN_BUDGET = int(os.getenv("HISTORY_COMPACTED_TOKEN_BUDGET", "400"))
+HISTORY_COMPACTED_TURN_CHARS = int(os.getenv("HISTORY_COMPACTED_TURN_CHARS", "160"))
+
+def estimate_tokens(text: str) -> int:
+    '''
+    cheap token estimate (about four characters per token for english text), good enough for budgeting
+    '''
+    return len(text) // 4 + 1
+
+class ChatHistory:
+    '''
+    keeps the rendered chat history of a session within a token budget
+
+    turns are appended once, in O(1), and the rendered string is cached until the next append.
+    when the recent turns no longer fit in the budget the oldest ones leave the window and are
+    compacted into short one line notes, which are themselves capped, so the prompt stays bounded
+    no matter how long the conversation runs
+    '''
+    def __init__(self, token_budget: int = HISTORY_TOKEN_BUDGET, compacted_token_budget: int = HISTORY_COMPACTED_TOKEN_BUDGET):
+        self.window_token_budget = max(token_budget - compacted_token_budget, 1)
+        self.compacted_token_budget = compacted_token_budget
+        self.turns: deque[tuple[str, int]] = deque()
+        self.token_count = 0
+        self.compacted: deque[tuple[str, int]] = deque()
+        self.compacted_token_count = 0
+        self.appended_count = 0 # number of turns appended so far, including the compacted ones
+        self._rendered = ""
+        self._is_rendered = True
+
+    def append(self, turn: str):
+        tokens = estimate_tokens(turn)
+        self.turns.append((turn, tokens))
+        self.token_count += tokens
+        self.appended_count += 1
+        self._is_rendered = False
+
+        # always keep the newest turn, even if it alone is over the budget
+        while self.token_count > self.window_token_budget and len(self.turns) > 1:
+            old_turn, old_tokens = self.turns.popleft()
+            self.token_count -= old_tokens
+            self._compact(old_turn)
+
+    def _compact(self, turn: str):
+        note = " ".join(turn.split())
+        if len(note) > HISTORY_COMPACTED_TURN_CHARS:
+            note = note[:HISTORY_COMPACTED_TURN_CHARS - 3] + "..."
+        tokens = estimate_tokens(note)
+        self.compacted.append((note, tokens))
+        self.compacted_token_count += tokens
+        while self.compacted_token_count > self.compacted_token_budget and len(self.compacted) > 0:
+            _, old_tokens = self.compacted.popleft()
+            self.compacted_token_count -= old_tokens
+
+    def render(self) -> str:
+        if not self._is_rendered:
+            rendered = ""
+            if len(self.compacted) > 0:
+                rendered = "[Earlier in the conversation]:\n" + "\n".join(note for note, _ in self.compacted) + "\n"
+            self._rendered = rendered + "".join(turn for turn, _ in self.turns)
+            self._is_rendered = True
+        return self._rendered
@@ -0,0 +1,122 @@
+'''cache of LLM completions keyed on the rendered prompt'''
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+from cache import CacheStats, SizedTTLCache
+
+COMPLETION_CACHE_SIZE = int(os.getenv("COMPLETION_CACHE_SIZE", "2048"))
+COMPLETION_CACHE_TTL = float(os.getenv("COMPLETION_CACHE_TTL", "3600"))
+COMPLETION_CACHE_MAX_BYTES = int(os.getenv("COMPLETION_CACHE_MAX_BYTES", str(8 * 1024 * 1024)))
+COMPLETION_CACHE_DB_PATH = os.getenv("COMPLETION_CACHE_DB_PATH", "")
+COMPLETION_CACHE_DISK_SIZE = int(os.getenv("COMPLETION_CACHE_DISK_SIZE", "100000"))
+
+# how many disk writes happen between two prunes of the disk tier
+DISK_PRUNE_EVERY = 500
+
+def normalize_prompt(prompt: str) -> str:
+    '''
+    prompts that only differ in whitespace or case get the same completion
+    '''
+    return " ".join(prompt.split()).lower()
+
+class CompletionCache:
+    '''
+    bounded LRU + TTL cache of completions in memory, optionally backed by a SQLite file
+
+    entries are keyed on a hash of the model and the normalized prompt. the memory tier is
+    capped both in entries and in bytes. when db_path is set, completions are also written to
+    disk so they survive restarts and are shared by every worker on the machine, a memory miss
+    then falls back to the disk before calling the model
+    '''
+    def __init__(self, max_entries: int = COMPLETION_CACHE_SIZE, ttl: float = COMPLETION_CACHE_TTL, max_bytes: int = COMPLETION_CACHE_MAX_BYTES, db_path: str = COMPLETION_CACHE_DB_PATH, disk_max_entries: int = COMPLETION_CACHE_DISK_SIZE):
+        self.enabled = max_entries > 0 and ttl > 0
+        self.ttl = ttl
+        self.entries = SizedTTLCache(max(max_entries, 1), ttl, max_bytes, sizeof=len)
+        self.stats: CacheStats = self.entries.stats
+        self.disk_hits = 0
+        self.db_path = db_path
+        self.disk_max_entries = disk_max_entries
+        self._connection = None
+        self._disk_lock = threading.Lock()
+        self._disk_writes = 0
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def key(self, model: str, prompt: str) -> str:
+        return hashlib.sha256((model + "\n" + normalize_prompt(prompt)).encode()).hexdigest()
+
+    def get(self, key: str) -> str:
+        if not self.enabled:
+            return None
+
+        completion = self.entries.peek(key)
+        if completion is not None:
+            self.entries.touch(key)
+            self.stats.hits += 1
+            return completion
+
+        completion = self._disk_get(key)
+        if completion is not None:
+            self.entries.set(key, completion)
+            self.stats.hits += 1
+            self.disk_hits += 1
+            return completion
+
+        self.stats.misses += 1
+        return None
+
+    def set(self, key: str, completion: str):
+        if not self.enabled:
+            return
+        self.entries.set(key, completion)
+        self._disk_set(key, completion)
+
+    def _get_connection(self) -> sqlite3.Connection:
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None, timeout=5)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            self._connection.execute("CREATE TABLE IF NOT EXISTS completions (key TEXT PRIMARY KEY, completion TEXT NOT NULL, expires_at REAL NOT NULL)")
+        return self._connection
+
+    def _disk_get(self, key: str) -> str:
+        if not self.db_path:
+            return None
+        with self._disk_lock:
+            row = self._get_connection().execute(
+                "SELECT completion FROM completions WHERE key = ? AND expires_at > ?", (key, time.time())
+            ).fetchone()
+        return row[0] if row is not None else None
+
+    def _disk_set(self, key: str, completion: str):
+        if not self.db_path:
+            return
+        with self._disk_lock:
+            connection = self._get_connection()
+            connection.execute(
+                "INSERT OR REPLACE INTO completions (key, completion, expires_at) VALUES (?, ?, ?)", (key, completion, time.time() + self.ttl)
+            )
+            self._disk_writes += 1
+            if self._disk_writes % DISK_PRUNE_EVERY == 0:
+                connection.execute("DELETE FROM completions WHERE expires_at <= ?", (time.time(),))
+                # the entries closest to expiring are also the least recently written ones
+                connection.execute(
+                    "DELETE FROM completions WHERE key IN (SELECT key FROM completions ORDER BY expires_at DESC LIMIT -1 OFFSET ?)", (self.disk_max_entries,)
+                )
+
+    def cache_stats(self) -> dict:
+        return dict(self.stats.to_json(), size=len(self.entries), bytes=self.entries.current_bytes, disk_hits=self.disk_hits)
+
+    def close(self):
+        with self._disk_lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+# Create a global instance of CompletionCache shared by every LLM call
+completion_cache = CompletionCache()
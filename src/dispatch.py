@@ -0,0 +1,286 @@
+'''deterministic pre-dispatch stage that decides which tools a turn needs before involving the agent'''
+
+import re
+
+from airport_index import get_airport_index, normalize
+import session_manager
+
+# the keys the summary prompt and the agent use for each slot, compared without case, spaces or punctuation
+SLOT_KEYS = {
+    "origin": {"cityofdeparture", "departurecity", "departure", "origin", "origincity", "originlocation", "originlocationcode", "from", "fromcity", "departureairport"},
+    "destination": {"cityofarrival", "arrivalcity", "arrival", "destination", "destinationcity", "destinationlocation", "destinationlocationcode", "to", "tocity", "arrivalairport"},
+    "date": {"departuredate", "dateofdeparture", "date", "traveldate", "departuretime", "departureday"},
+    "adults": {"numberofadulttravelers", "numberofadulttraveler", "adulttravelers", "adults", "numberofadults", "travelers", "travellers", "passengers", "numberoftravelers", "numberoftravellers"},
+    "stay": {"cityofstay", "staycity", "hotelcity", "city"},
+    "latitude": {"latitude", "lat"},
+    "longitude": {"longitude", "lon", "lng", "long"},
+}
+KEY_TO_SLOT = {key: slot for slot, keys in SLOT_KEYS.items() for key in keys}
+
+# the slots a flight search cannot do without, adults defaults to 1
+FLIGHT_SLOTS = ("origin", "destination", "date")
+
+# values the summary uses for slots it has not collected yet ("Not specified yet", "to be confirmed", "N/A"),
+# matched on the lowercased value with punctuation turned into spaces
+MISSING_VALUE_PATTERN = re.compile(
+    r"(?:unknown|tbd|tba|n ?a|none|pending)?(?: yet)?$"
+    r"|not (?:yet )?(?:specified|provided|mentioned|given|known|decided|confirmed|set)\b"
+    r"|to be (?:confirmed|decided|determined|specified)\b"
+)
+
+NUMBER_WORDS = {"one": 1, "two": 2, "three": 3, "four": 4, "five": 5, "six": 6, "seven": 7, "eight": 8, "nine": 9}
+
+KEY_VALUE_PATTERN = re.compile(
+    r"(?P<key>[A-Za-z][A-Za-z \-/()]{0,40}?)[ \t]*:[ \t]*(?P<value>[^\n;]+?)(?=[ \t]*(?:[\n;]|,[ \t]*[A-Za-z][A-Za-z \-/()]{0,40}?[ \t]*:|$))"
+)
+DATE_PATTERN = re.compile(r"\b\d{4}-\d{2}-\d{2}\b")
+
+# a range of dates ("a weekend in May") or several destinations ("Tokyo or Osaka"), which only the agent's flexible search covers
+FLEXIBLE_DATE_PATTERN = re.compile(
+    r"\b(weekends?|flexible|any ?time|any day|whenever|cheapest (day|date|time|week|month)|"
+    r"(in|during|next|this|early|late|mid) (week|month|january|february|march|april|may|june|july|august|september|october|november|december))\b"
+)
+MULTIPLE_DESTINATIONS_PATTERN = re.compile(r"\bor\b|/")
+
+# follow-ups on the flights already shown, read from the user's own words and answered from the cached offers
+CHEAPER_PATTERN = re.compile(r"\b(cheap|cheaper|cheapest|less expensive|lower price|lowest price|budget)\b")
+SHORTER_PATTERN = re.compile(r"\b(shorter|shortest|faster|fastest|quicker|quickest)\b")
+FEWER_STOPS_PATTERN = re.compile(r"\b(fewer|less) (stops|layovers|connections)\b")
+DIRECT_PATTERN = re.compile(r"\b(direct|non ?stop|no (stops|layovers|connections))\b")
+MAX_DURATION_PATTERN = re.compile(r"\b(?:under|below|less than|at most|within|shorter than|max|maximum) (\d+(?:\.\d+)?) ?(?:h|hrs?|hours?)\b")
+MAX_PRICE_PATTERN = re.compile(r"\b(?:under|below|less than|at most|cheaper than|max|maximum|up to) (?:usd ?|\$ ?)?(\d+(?:\.\d+)?)\b(?! ?(?:h|hrs?|hours?)\b)")
+# follow-ups about the shown flights the patterns above cannot turn into filters (an airline, a time of day), left to the agent
+FLIGHT_FOLLOW_UP_PATTERN = re.compile(r"\b(flights?|airlines?|options?|earlier|later|morning|afternoon|evening|night|layovers?|stops?)\b")
+
+def normalize_key(key: str) -> str:
+    key = re.sub(r"^\s*\d+\s*[.)]\s*", "", key)
+    return re.sub(r"[^a-z]", "", key.lower())
+
+def is_missing_value(value: str) -> bool:
+    return MISSING_VALUE_PATTERN.match(" ".join(re.sub(r"[^a-z0-9]", " ", value.lower()).split())) is not None
+
+def iter_slot_values(text: str):
+    '''
+    the (slot, raw value) pairs of a text, wherever the key sits in its line
+
+    "Here's the summary: Origin: Singapore" reads as a key that is no slot with the value
+    "Origin: Singapore", such a value is scanned again for the slot inside it
+    '''
+    for match in KEY_VALUE_PATTERN.finditer(text):
+        value = match.group("value")
+        if ":" in value and any(KEY_TO_SLOT.get(normalize_key(nested.group("key"))) for nested in KEY_VALUE_PATTERN.finditer(value)):
+            yield from iter_slot_values(value)
+            continue
+        slot = KEY_TO_SLOT.get(normalize_key(match.group("key")))
+        if slot is not None:
+            yield slot, value
+
+def extract_slots(text: str) -> dict:
+    '''
+    pulls "key: value" slots out of a summary or context text, later occurrences win
+    '''
+    slots = {}
+    text = text.replace("*", "").replace("`", "")
+    for slot, value in iter_slot_values(text):
+        value = value.strip().strip(".,").strip()
+        if "?" in value or is_missing_value(value):
+            continue
+
+        if slot == "date":
+            date_match = DATE_PATTERN.search(value)
+            if date_match is None:
+                continue
+            value = date_match.group(0)
+        elif slot == "adults":
+            number_match = re.search(r"\d+", value)
+            word_match = re.search(r"\b(" + "|".join(NUMBER_WORDS) + r")\b", value.lower())
+            if number_match is not None:
+                value = int(number_match.group(0))
+            elif word_match is not None:
+                value = NUMBER_WORDS[word_match.group(1)]
+            else:
+                continue
+        elif slot in ("latitude", "longitude"):
+            number_match = re.search(r"-?\d+(?:\.\d+)?", value)
+            if number_match is None:
+                continue
+            value = float(number_match.group(0))
+        slots[slot] = value
+
+    if "date" not in slots:
+        dates = DATE_PATTERN.findall(text)
+        if len(dates) == 1:
+            slots["date"] = dates[0]
+    return slots
+
+def resolve_airport(location: str) -> str:
+    '''
+    returns the IATA code to search flights with for a city, airport name or code, or None if it is not unambiguous enough
+
+    an airport name or code is used as it is. a city must be clear on two counts before the agent is
+    skipped: the country (the same city name in different countries is only resolved when the best
+    ranked city is the only one with an international airport, Paris, FR over Paris, TX) and the
+    airport. a city with several airports is searched by its IATA metro code, which covers all of
+    them (TYO, OSA, BKK), and left to the agent when it has none. picking one by score would send
+    Osaka to domestic Itami or Berlin to the closed Tegel
+    '''
+    airport_index = get_airport_index()
+    candidates = airport_index.search(location, limit=5)
+    if len(candidates) == 0 or candidates[0]["score"] < 0.9:
+        return None
+
+    location_key = normalize(location)
+    if normalize(candidates[0]["city"]) != location_key:
+        # an airport ("Narita", "JFK") rather than a city
+        return candidates[0]["iata"]
+
+    international_places = set()
+    airports_by_place = {}
+    for candidate in candidates:
+        if candidate["score"] < candidates[0]["score"] - 0.05 or normalize(candidate["city"]) != location_key:
+            continue
+        place = (candidate["city"], candidate["country"])
+        airports_by_place.setdefault(place, []).append(candidate["iata"])
+        if "international" in candidate["name"].lower():
+            international_places.add(place)
+
+    best_place = (candidates[0]["city"], candidates[0]["country"])
+    if len(airports_by_place) > 1 and international_places != {best_place}:
+        return None
+    metro_code = airport_index.table.metro_code(*best_place)
+    if metro_code is not None:
+        return metro_code
+    if len(airports_by_place[best_place]) > 1:
+        return None
+    return candidates[0]["iata"]
+
+def merge_context(context: str, slots: dict) -> str:
+    '''
+    writes the slots into the context text, replacing the lines that already hold them
+    '''
+    lines = context.splitlines()
+    for slot, value in slots.items():
+        slot_line = slot + ": " + str(value)
+        for index, line in enumerate(lines):
+            if line.lower().startswith(slot + ":"):
+                lines[index] = slot_line
+                break
+        else:
+            lines.append(slot_line)
+    return "\n".join(line for line in lines if line.strip())
+
+def has_flight_slots(slots: dict) -> bool:
+    return all(slot in slots for slot in FLIGHT_SLOTS)
+
+def flight_search_arguments(slots: dict) -> dict:
+    '''
+    the arguments of add_possible_flights_text for complete flight slots, None if an airport is ambiguous
+    '''
+    origin_code = resolve_airport(slots["origin"])
+    destination_code = resolve_airport(slots["destination"])
+    if origin_code is None or destination_code is None:
+        return None
+    return {
+        "originLocationCode": origin_code,
+        "destinationLocationCode": destination_code,
+        "departureDate": slots["date"],
+        "adults": slots.get("adults", 1)
+    }
+
+def extract_refinement(user_query: str) -> dict:
+    '''
+    the refine_flights_text filters a follow-up asks for ("anything cheaper?", "direct flights under $500"), None if it asks for none
+    '''
+    text = user_query.lower()
+    refinement = {}
+    if CHEAPER_PATTERN.search(text):
+        refinement["sort_by"] = "price"
+    elif SHORTER_PATTERN.search(text):
+        refinement["sort_by"] = "duration"
+    elif FEWER_STOPS_PATTERN.search(text):
+        refinement["sort_by"] = "stops"
+    if DIRECT_PATTERN.search(text):
+        refinement["max_stops"] = 0
+    duration_match = MAX_DURATION_PATTERN.search(text)
+    if duration_match is not None:
+        refinement["max_duration_hours"] = float(duration_match.group(1))
+    price_match = MAX_PRICE_PATTERN.search(text)
+    if price_match is not None:
+        refinement["max_price"] = float(price_match.group(1))
+    return refinement or None
+
+class ToolCall:
+    def __init__(self, name: str, arguments: dict):
+        self.name = name
+        self.arguments = arguments
+
+    def key(self) -> tuple:
+        return (self.name,) + tuple(sorted(self.arguments.items()))
+
+class DispatchPlan:
+    def __init__(self, tool_calls: list[ToolCall], needs_agent: bool, slots: dict):
+        self.tool_calls = tool_calls
+        self.needs_agent = needs_agent
+        self.slots = slots
+
+def plan_turn(current_session: session_manager.Session, summary_text: str, user_query: str = "") -> DispatchPlan:
+    '''
+    decides what the turn needs from the slots found in the session context and the summary
+
+    - every slot a tool needs is known and resolvable: the tool is called directly
+    - the slots are there but cannot be resolved deterministically (e.g. an ambiguous city): the agent runs
+    - the user is flexible about the date or the destination: the agent runs its flexible search
+    - the user follows up on the flights already shown: the offers are re-ranked directly when the
+      query asks for filters the dispatcher understands (cheaper, shorter, direct, under $500),
+      anything else about those flights goes to the agent
+    - otherwise no tool can fire (the summary is still asking questions) and the agent is skipped
+    '''
+    summary_slots = extract_slots(summary_text)
+    slots = extract_slots(current_session.context)
+    slots.update(summary_slots)
+
+    tool_calls = []
+    needs_agent = False
+    # a concrete date in this turn's summary wins over a vague phrase of the query ("next month, on the 12th")
+    flexible_date = "date" not in summary_slots and FLEXIBLE_DATE_PATTERN.search(user_query.lower()) is not None
+    flexible_search = "origin" in slots and "destination" in slots and (
+        flexible_date or MULTIPLE_DESTINATIONS_PATTERN.search(slots["destination"]) is not None
+    )
+
+    if has_flight_slots(slots) and not flexible_search:
+        flight_search = flight_search_arguments(slots)
+        if flight_search is None:
+            needs_agent = True
+        else:
+            tool_calls.append(ToolCall("add_possible_flights_text", flight_search))
+
+    if "latitude" in slots and "longitude" in slots:
+        tool_calls.append(ToolCall("add_possible_places_text", {
+            "latitude": slots["latitude"],
+            "longitude": slots["longitude"]
+        }))
+    elif "stay" in slots:
+        # the geo index only knows where a city's airports are, often tens of kilometers out of the
+        # centre (Tokyo's lands in Chiba), so the agent picks the coordinates to search activities around
+        needs_agent = True
+
+    # the same call was already answered earlier in the conversation, don't repeat it every turn
+    tool_calls = [tool_call for tool_call in tool_calls if tool_call.key() not in current_session.dispatched_tool_calls]
+    if needs_agent and len(tool_calls) == 0 and current_session.agent_slots == slots:
+        # the agent already saw exactly these slots on an earlier turn
+        needs_agent = False
+
+    if flexible_search:
+        # the date in the slots, if any, is only one of the dates the user is open to
+        needs_agent = True
+    # the slots repeat the search already shown, so the query itself may be a follow-up on those flights
+    elif current_session.flight_search is not None and not any(tool_call.name == "add_possible_flights_text" for tool_call in tool_calls):
+        refinement = extract_refinement(user_query)
+        if refinement is not None:
+            refine_call = ToolCall("refine_flights_text", dict(current_session.flight_search, **refinement))
+            if refine_call.key() not in current_session.dispatched_tool_calls:
+                tool_calls.append(refine_call)
+        elif FLIGHT_FOLLOW_UP_PATTERN.search(user_query.lower()):
+            needs_agent = True
+
+    return DispatchPlan(tool_calls, needs_agent, slots)
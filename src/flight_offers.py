@@ -0,0 +1,156 @@
+'''normalized flight offers kept in columns so they can be filtered and ranked without asking Amadeus again'''
+
+import json
+import os
+import re
+
+import numpy as np
+
+from amadeus_client import amadeus_client
+from cache import SizedTTLCache, SingleFlight, cached_call, json_sizeof
+
+FLIGHT_OFFERS_CACHE_TTL = float(os.getenv("FLIGHT_OFFERS_CACHE_TTL", "300"))
+FLIGHT_OFFERS_CACHE_SIZE = int(os.getenv("FLIGHT_OFFERS_CACHE_SIZE", "1024"))
+FLIGHT_OFFERS_CACHE_MAX_BYTES = int(os.getenv("FLIGHT_OFFERS_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+FLIGHT_OFFERS_FETCH_SIZE = int(os.getenv("FLIGHT_OFFERS_FETCH_SIZE", "50"))
+FLIGHT_OFFERS_SHOWN = int(os.getenv("FLIGHT_OFFERS_SHOWN", "3"))
+
+# weights of price, duration and stops, each normalized to 0..1 over the offer set, lower scores rank first.
+# "price" and "duration" are strict orders, "stops" only breaks ties between equal stops on price and duration
+SORT_WEIGHTS = {
+    "balanced": (0.5, 0.35, 0.15),
+    "price": (1.0, 0.0, 0.0),
+    "duration": (0.0, 1.0, 0.0),
+    "stops": (0.1, 0.1, 1.0),
+}
+
+DURATION_PATTERN = re.compile(r"P(?:(\d+)D)?T?(?:(\d+)H)?(?:(\d+)M)?")
+
+def parse_duration_minutes(duration: str) -> int:
+    '''
+    minutes of an ISO 8601 duration such as PT7H25M or P1DT2H
+    '''
+    match = DURATION_PATTERN.fullmatch(duration or "")
+    if match is None:
+        return 0
+    days, hours, minutes = (int(value) if value else 0 for value in match.groups())
+    return (days * 24 + hours) * 60 + minutes
+
+def format_minutes(minutes: int) -> str:
+    return str(minutes // 60) + "h" + str(minutes % 60).zfill(2) + "m"
+
+def normalize_offer(flight_offer: dict) -> dict:
+    '''
+    the outbound itinerary of an Amadeus offer with every segment, in the shape shown to the user
+    '''
+    itinerary = flight_offer["itineraries"][0]
+    segments = itinerary["segments"]
+    duration_minutes = parse_duration_minutes(itinerary.get("duration"))
+    return {
+        "Airline": "/".join(dict.fromkeys(segment["carrierCode"] for segment in segments)),
+        "AircraftType": segments[0].get("aircraft", {}).get("code", ""),
+        "DepartureTime": segments[0]["departure"]["at"],
+        "ArrivalTime": segments[-1]["arrival"]["at"],
+        "Duration": format_minutes(duration_minutes),
+        "Stops": len(segments) - 1,
+        "Price": flight_offer["price"]["total"],
+        "Segments": [
+            {
+                "From": segment["departure"]["iataCode"],
+                "To": segment["arrival"]["iataCode"],
+                "Departure": segment["departure"]["at"],
+                "Arrival": segment["arrival"]["at"],
+                "Flight": segment["carrierCode"] + segment.get("number", ""),
+                "Aircraft": segment.get("aircraft", {}).get("code", "")
+            }
+            for segment in segments
+        ]
+    }
+
+class FlightOfferTable:
+    '''
+    the offers of one search as parallel numpy columns (price, duration, stops, carriers) next to
+    the normalized offers themselves
+
+    filters are boolean masks and scoring is a weighted sum of min-max normalized columns, so
+    re-ranking the whole set for a follow-up ("anything shorter?") is a handful of array operations
+    '''
+    def __init__(self, offers: list[dict], durations: list[int]):
+        self.offers = offers
+        self.prices = np.array([float(offer["Price"]) for offer in offers], dtype=np.float64)
+        self.durations = np.array(durations, dtype=np.int32)
+        self.stops = np.array([offer["Stops"] for offer in offers], dtype=np.int16)
+        self.carriers = np.array(["/" + offer["Airline"] + "/" for offer in offers], dtype=np.str_)
+
+    def __len__(self) -> int:
+        return len(self.offers)
+
+    @classmethod
+    def from_amadeus(cls, flight_offers_response: dict) -> "FlightOfferTable":
+        offers = []
+        durations = []
+        for flight_offer in flight_offers_response.get("data", []):
+            try:
+                offer = normalize_offer(flight_offer)
+            except (KeyError, IndexError, ValueError):
+                continue
+            offers.append(offer)
+            durations.append(parse_duration_minutes(flight_offer["itineraries"][0].get("duration")))
+        return cls(offers, durations)
+
+    def score(self, sort_by: str = "balanced") -> np.ndarray:
+        price_weight, duration_weight, stops_weight = SORT_WEIGHTS.get(sort_by, SORT_WEIGHTS["balanced"])
+        return price_weight * min_max(self.prices) + duration_weight * min_max(self.durations) + stops_weight * min_max(self.stops)
+
+    def rank(self, limit: int = FLIGHT_OFFERS_SHOWN, sort_by: str = "balanced", max_price: float = None, max_duration_minutes: int = None, max_stops: int = None, airline: str = None) -> list[dict]:
+        '''
+        the best limit offers that pass every given filter
+        '''
+        if len(self.offers) == 0:
+            return []
+        mask = np.ones(len(self.offers), dtype=bool)
+        if max_price is not None:
+            mask &= self.prices <= max_price
+        if max_duration_minutes is not None:
+            mask &= self.durations <= max_duration_minutes
+        if max_stops is not None:
+            mask &= self.stops <= max_stops
+        if airline:
+            mask &= np.char.find(self.carriers, "/" + airline.strip().upper() + "/") >= 0
+
+        candidates = np.flatnonzero(mask)
+        scores = self.score(sort_by)[candidates]
+        # stable, so equal scores keep Amadeus' own order
+        best = candidates[np.argsort(scores, kind="stable")[:limit]]
+        return [self.offers[index] for index in best]
+
+def min_max(column: np.ndarray) -> np.ndarray:
+    column = column.astype(np.float64)
+    spread = column.max() - column.min()
+    if spread == 0:
+        return np.zeros_like(column)
+    return (column - column.min()) / spread
+
+# only the tables are cached, not the raw Amadeus responses they are built from. the normalized
+# offers dominate the size of a table, the numpy columns next to them are a few hundred bytes
+flight_offer_tables = SizedTTLCache(FLIGHT_OFFERS_CACHE_SIZE, FLIGHT_OFFERS_CACHE_TTL, FLIGHT_OFFERS_CACHE_MAX_BYTES, lambda table: json_sizeof(table.offers))
+_flight_offer_coalescer = SingleFlight(flight_offer_tables.stats)
+
+async def get_flight_offer_table(originLocationCode: str, destinationLocationCode: str, departureDate: str, adults: int = 1) -> FlightOfferTable:
+    '''
+    the table of a search, fetched once per FLIGHT_OFFERS_CACHE_TTL with FLIGHT_OFFERS_FETCH_SIZE offers
+
+    concurrent identical searches share a single upstream call, a failed search raises and is not cached
+    '''
+    key = (originLocationCode.strip().upper(), destinationLocationCode.strip().upper(), departureDate.strip(), int(adults))
+
+    async def fetch_table():
+        flight_offers_response = await amadeus_client.search_flight_offers(originLocationCode, destinationLocationCode, departureDate, adults, max_offers=FLIGHT_OFFERS_FETCH_SIZE)
+        if "data" not in flight_offers_response:
+            raise ValueError("The flight search failed: " + json.dumps(flight_offers_response.get("errors", flight_offers_response)))
+        return FlightOfferTable.from_amadeus(flight_offers_response)
+
+    return await cached_call(flight_offer_tables, _flight_offer_coalescer, key, fetch_table)
+
+def cache_stats() -> dict:
+    return dict(flight_offer_tables.stats.to_json(), size=len(flight_offer_tables), bytes=flight_offer_tables.current_bytes)
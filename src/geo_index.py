@@ -0,0 +1,195 @@
+'''vectorized geographic lookups over the coordinates of the airport table'''
+
+import functools
+import math
+
+import numpy as np
+
+from airport_index import get_airport_index
+from airport_table import AirportTable, get_airport_table, normalize
+
+EARTH_RADIUS_KM = 6371.0088
+
+# airports filed under the same city name and country in different subdivisions are one city when this close
+CITY_MERGE_KM = 100
+
+# how close a misspelled city name must be to an airport index entry, lower lets "Kyoto" turn into "Kyiv"
+FUZZY_CITY_MIN_SCORE = 0.5
+
+def unit_vectors(latitudes, longitudes) -> np.ndarray:
+    '''
+    points given in degrees as unit vectors, one row per point
+    '''
+    latitudes = np.radians(latitudes)
+    longitudes = np.radians(longitudes)
+    cos_latitudes = np.cos(latitudes)
+    return np.column_stack((cos_latitudes * np.cos(longitudes), cos_latitudes * np.sin(longitudes), np.sin(latitudes)))
+
+def unit_vector(latitude: float, longitude: float) -> np.ndarray:
+    latitude = math.radians(latitude)
+    longitude = math.radians(longitude)
+    return np.array((math.cos(latitude) * math.cos(longitude), math.cos(latitude) * math.sin(longitude), math.sin(latitude)))
+
+def haversine_km(dots: np.ndarray) -> np.ndarray:
+    '''
+    great circle distances from the dot products of unit vectors. the haversine of the angle is a
+    quarter of the squared chord (2 - 2 dot), so this is the haversine formula without any trigonometry
+    on the inputs
+    '''
+    half_chords = np.sqrt(np.clip(2 - 2 * dots, 0.0, 4.0)) / 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.minimum(half_chords, 1.0))
+
+class GeoIndex:
+    '''
+    airport coordinates as numpy columns, plus one centroid per city
+
+    airports are unit vectors, so nearest and within rank the whole table with one matrix-vector
+    product (about 0.1 ms), pick the closest with argpartition and only convert those to haversine
+    distances. a city groups the airports that share a city name and country and lie within
+    CITY_MERGE_KM of each other (Narita is filed under Chiba, Haneda under Tokyo, Paris TX and Paris
+    TN stay apart). its centroid is the mean of its airports' positions on the unit sphere, so a
+    city is resolved to coordinates without asking the model
+    '''
+    def __init__(self, table: AirportTable):
+        self.table = table
+        vectors = unit_vectors(table.latitudes, table.longitudes)
+        # one row per axis, so the dot products with a point read three contiguous columns
+        self.unit_vectors = np.ascontiguousarray(vectors.T)
+        self.international = np.array(["international" in name.lower() for name in table.columns["name"]], dtype=bool)
+
+        city_ids: dict[tuple, int] = {}
+        self.city_names: list[str] = []
+        self.city_subdivisions: list[str] = []
+        self.city_countries: list[str] = []
+        self.cities_by_key: dict[str, list[int]] = {}
+        city_of_airport = np.empty(len(table), dtype=np.int32)
+        for index, (city, subdivision, country) in enumerate(zip(table.columns["city"], table.columns["subd"], table.columns["country"])):
+            place = (normalize(city), subdivision, country)
+            city_id = city_ids.get(place)
+            if city_id is None:
+                city_id = self._find_nearby_city(place, vectors[index], city_of_airport[:index], vectors)
+            if city_id is None:
+                city_id = len(self.city_names)
+                self.city_names.append(city)
+                self.city_subdivisions.append(place[1])
+                self.city_countries.append(place[2])
+                if place[0]:
+                    self.cities_by_key.setdefault(place[0], []).append(city_id)
+            city_ids[place] = city_id
+            city_of_airport[index] = city_id
+
+        city_count = len(self.city_names)
+        self.city_airport_counts = np.bincount(city_of_airport, minlength=city_count)
+        self.city_international = np.bincount(city_of_airport, weights=self.international, minlength=city_count) > 0
+        # airports grouped by city, city i owns city_airports[city_offsets[i]:city_offsets[i + 1]]
+        self.city_airports = np.argsort(city_of_airport, kind="stable")
+        self.city_offsets = np.concatenate(([0], np.cumsum(self.city_airport_counts)))
+
+        sums = np.zeros((city_count, 3))
+        np.add.at(sums, city_of_airport, vectors)
+        self.city_latitudes = np.degrees(np.arctan2(sums[:, 2], np.hypot(sums[:, 0], sums[:, 1])))
+        self.city_longitudes = np.degrees(np.arctan2(sums[:, 1], sums[:, 0]))
+
+    def __len__(self) -> int:
+        return len(self.table)
+
+    def _find_nearby_city(self, place: tuple, vector: np.ndarray, city_of_airport: np.ndarray, vectors: np.ndarray) -> int:
+        '''
+        an already seen city with the same name and country in another subdivision, close enough to be the same one
+        '''
+        name, _, country = place
+        if not name:
+            return None
+        for city_id in self.cities_by_key.get(name, ()):
+            if self.city_countries[city_id] != country:
+                continue
+            first_airport = np.flatnonzero(city_of_airport == city_id)[0]
+            if vectors[first_airport] @ vector >= math.cos(CITY_MERGE_KM / EARTH_RADIUS_KM):
+                return city_id
+        return None
+
+    def dot_products(self, latitude: float, longitude: float) -> np.ndarray:
+        '''
+        the larger the dot product with a coordinate, the closer the airport, one matrix-vector product for the whole table
+        '''
+        return unit_vector(latitude, longitude) @ self.unit_vectors
+
+    def nearest(self, latitude: float, longitude: float, limit: int = 5, international_only: bool = False) -> list[dict]:
+        '''
+        the limit airports closest to a coordinate, closest first
+        '''
+        dots = self.dot_products(latitude, longitude)
+        if international_only:
+            # below any real dot product (-1), so these never make it into the result
+            dots = np.where(self.international, dots, -2.0)
+        limit = min(limit, len(dots))
+        closest = np.argpartition(-dots, limit - 1)[:limit]
+        closest = closest[np.argsort(-dots[closest], kind="stable")]
+        closest = closest[dots[closest] >= -1.0]
+        return [self.airport(index, distance_km) for index, distance_km in zip(closest, haversine_km(dots[closest]))]
+
+    def within(self, latitude: float, longitude: float, radius_km: float, limit: int = 20) -> list[dict]:
+        '''
+        the airports at most radius_km away from a coordinate, closest first, at most limit of them
+        '''
+        dots = self.dot_products(latitude, longitude)
+        inside = np.flatnonzero(dots >= np.cos(min(radius_km / EARTH_RADIUS_KM, np.pi)))
+        inside = inside[np.argsort(-dots[inside], kind="stable")[:limit]]
+        return [self.airport(index, distance_km) for index, distance_km in zip(inside, haversine_km(dots[inside]))]
+
+    def locate_city(self, city: str, country: str = "", limit: int = 5) -> list[dict]:
+        '''
+        candidate cities for a name, best first: cities with an international airport, then the ones
+        with the most airports. misspelled names go through the airport index to find the city meant
+        '''
+        city_ids = self.cities_by_key.get(normalize(city), [])
+        if len(city_ids) == 0:
+            city_ids = []
+            for candidate in get_airport_index().search(city, limit=limit, min_score=FUZZY_CITY_MIN_SCORE):
+                if candidate["score"] < FUZZY_CITY_MIN_SCORE:
+                    continue
+                for city_id in self.cities_by_key.get(normalize(candidate["city"]), []):
+                    if city_id not in city_ids:
+                        city_ids.append(city_id)
+        if country:
+            city_ids = [city_id for city_id in city_ids if self.city_countries[city_id] == country.strip().upper()]
+
+        city_ids = sorted(city_ids, key=lambda city_id: (not self.city_international[city_id], -self.city_airport_counts[city_id], city_id))
+        return [self.city(city_id) for city_id in city_ids[:limit]]
+
+    def airport(self, index: int, distance_km: float = None) -> dict:
+        result = {
+            "iata": self.table.code(index),
+            "name": self.table.field("name", index),
+            "city": self.table.field("city", index),
+            "country": self.table.field("country", index),
+            "latitude": float(self.table.latitudes[index]),
+            "longitude": float(self.table.longitudes[index]),
+        }
+        if distance_km is not None:
+            result["distance_km"] = round(float(distance_km), 1)
+        return result
+
+    def city(self, city_id: int) -> dict:
+        latitude = float(self.city_latitudes[city_id])
+        longitude = float(self.city_longitudes[city_id])
+        airport_indexes = self.city_airports[self.city_offsets[city_id]:self.city_offsets[city_id + 1]]
+        distances = haversine_km(unit_vector(latitude, longitude) @ self.unit_vectors[:, airport_indexes])
+        # international airports first, then the closest to the centre
+        order = np.lexsort((distances, ~self.international[airport_indexes]))
+        return {
+            "city": self.city_names[city_id],
+            "subd": self.city_subdivisions[city_id],
+            "country": self.city_countries[city_id],
+            "latitude": round(latitude, 4),
+            "longitude": round(longitude, 4),
+            "international": bool(self.city_international[city_id]),
+            "airports": [self.airport(airport_indexes[index], distances[index]) for index in order],
+        }
+
+@functools.cache
+def get_geo_index() -> GeoIndex:
+    '''
+    builds the geo index on first use over the shared airport table
+    '''
+    return GeoIndex(get_airport_table())
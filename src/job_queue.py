@@ -0,0 +1,140 @@
+'''bounded background job scheduler used to run queries off the request path'''
+
+import asyncio
+import os
+import time
+import traceback
+from collections import OrderedDict, deque
+from enum import Enum
+from typing import Awaitable, Callable
+
+import utilities
+
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+JOB_QUEUE_SIZE = int(os.getenv("JOB_QUEUE_SIZE", "100"))
+JOB_HISTORY_SIZE = int(os.getenv("JOB_HISTORY_SIZE", "10000"))
+
+class JobStatus(str, Enum):
+    QUEUED = "QUEUED"
+    RUNNING = "RUNNING"
+    COMPLETED = "COMPLETED"
+    FAILED = "FAILED"
+
+class QueueFullError(Exception):
+    pass
+
+class Job:
+    def __init__(self, conversation_id: str, work: Callable[[], Awaitable]):
+        self.job_id = utilities.generate_random_string(20)
+        self.conversation_id = conversation_id
+        self.work = work
+        self.status = JobStatus.QUEUED
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+
+    def to_json(self):
+        return {
+            "job_id": self.job_id,
+            "conversation_id": self.conversation_id,
+            "status": self.status,
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at
+        }
+
+class JobScheduler:
+    '''
+    runs submitted jobs on a fixed pool of asyncio workers
+
+    jobs of the same conversation run strictly one after another in submission order, jobs of
+    different conversations run in parallel. at most max_queue_size jobs may wait at once,
+    submit raises QueueFullError beyond that so callers can shed load instead of piling up
+    '''
+    def __init__(self, max_workers: int = JOB_WORKERS, max_queue_size: int = JOB_QUEUE_SIZE, history_size: int = JOB_HISTORY_SIZE):
+        self.max_workers = max_workers
+        self.max_queue_size = max_queue_size
+        self.history_size = history_size
+        self.jobs: OrderedDict[str, Job] = OrderedDict()
+        self.queued_count = 0
+        self._pending: dict[str, deque[Job]] = {}
+        self._ready_conversations: asyncio.Queue = None
+        self._workers: list[asyncio.Task] = []
+
+    def is_running(self) -> bool:
+        return len(self._workers) > 0
+
+    async def start(self):
+        if self.is_running():
+            return
+        self._ready_conversations = asyncio.Queue()
+        # conversations that got work before the workers were up
+        for conversation_id in self._pending:
+            self._ready_conversations.put_nowait(conversation_id)
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.max_workers)]
+
+    async def stop(self):
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    def submit(self, conversation_id: str, work: Callable[[], Awaitable]) -> Job:
+        if self.queued_count >= self.max_queue_size:
+            raise QueueFullError("The server is busy, try again later")
+
+        job = Job(conversation_id, work)
+        self._remember(job)
+        self.queued_count += 1
+
+        if conversation_id in self._pending:
+            # a worker owns this conversation already, it will pick the job up when it is done
+            self._pending[conversation_id].append(job)
+        else:
+            self._pending[conversation_id] = deque([job])
+            if self._ready_conversations is not None:
+                self._ready_conversations.put_nowait(conversation_id)
+        return job
+
+    def get_job(self, job_id: str) -> Job:
+        return self.jobs.get(job_id)
+
+    def _remember(self, job: Job):
+        self.jobs[job.job_id] = job
+        while len(self.jobs) > self.history_size:
+            oldest_job_id = next(iter(self.jobs))
+            if self.jobs[oldest_job_id].status in (JobStatus.QUEUED, JobStatus.RUNNING):
+                break
+            self.jobs.pop(oldest_job_id)
+
+    async def _worker(self):
+        while True:
+            conversation_id = await self._ready_conversations.get()
+            pending_jobs = self._pending[conversation_id]
+            job = pending_jobs.popleft()
+            self.queued_count -= 1
+
+            job.status = JobStatus.RUNNING
+            job.started_at = time.time()
+            try:
+                await job.work()
+                job.status = JobStatus.COMPLETED
+            except asyncio.CancelledError:
+                job.status = JobStatus.FAILED
+                job.error = "cancelled"
+                raise
+            except Exception as exception:
+                traceback.print_exc()
+                job.status = JobStatus.FAILED
+                job.error = str(exception)
+            finally:
+                job.finished_at = time.time()
+                if len(pending_jobs) > 0:
+                    self._ready_conversations.put_nowait(conversation_id)
+                else:
+                    del self._pending[conversation_id]
+
+# Create a global instance of JobScheduler
+job_scheduler = JobScheduler()
@@ -0,0 +1,32 @@
+'''shared LLM client used by every module that talks to the model'''
+
+import functools
+import os
+
+import httpx
+from dotenv import load_dotenv
+
+import metrics
+
+load_dotenv()
+
+TOGETHER_API_KEY = os.getenv("TOGETHER_API_KEY")
+TOGETHER_MODEL = os.getenv("TOGETHER_MODEL", "meta-llama/Meta-Llama-3-70B-Instruct-Turbo")
+TOGETHER_API_BASE = os.getenv("TOGETHER_API_BASE", "https://api.together.xyz/v1")
+
+@functools.cache
+def get_llm():
+    '''
+    returns the process wide TogetherLLM, created on first use
+
+    the together integration pulls in the openai client and tokenizers which take seconds to import,
+    so the import is deferred until the first query instead of slowing down every worker boot
+    '''
+    from llama_index.llms.together import TogetherLLM
+
+    return TogetherLLM(
+        model=TOGETHER_MODEL,
+        api_key=TOGETHER_API_KEY,
+        api_base=TOGETHER_API_BASE,
+        async_http_client=httpx.AsyncClient(event_hooks=metrics.http_event_hooks("together"))
+    )
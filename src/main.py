@@ -1,11 +1,87 @@
-from fastapi import FastAPI, WebSocket
+import asyncio
+import math
+import os
+import re
+from contextlib import asynccontextmanager
+
+from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, PlainTextResponse, Response
+from dotenv import load_dotenv
+
+# before any project import, the modules below read their settings from the environment when imported
+load_dotenv()
 
 import utilities
 import session_manager
 import ai
+import airport_index
+import geo_index
+import llm
+import metrics
+from agent_factory import agent_factory
+from admission import admission_controller, OverloadedError
+from amadeus_client import amadeus_client
+from completion_cache import completion_cache
+import flight_offers
+from job_queue import job_scheduler, QueueFullError
+
+LONG_POLL_MAX_WAIT = float(os.getenv("LONG_POLL_MAX_WAIT", "30"))
+
+# set once the server starts, queries wait for it instead of building the same resources on the event loop
+warm_up_task = None
+
+def warm_up():
+    '''
+    builds what the first query would otherwise build on the event loop: the LLM client (the
+    together and openai imports take seconds), the agent's tools, memory size and tokenizer, and
+    the airport table with its indexes (compiled first if the table is missing)
+    '''
+    llm.get_llm()
+    # the openai client under the LLM imports its whole API surface on the first request
+    import openai.resources.chat
+    # the agent itself is thrown away, building it resolves everything the agents of the queries share
+    agent_factory.create_agent()
+    airport_index.get_airport_index()
+    geo_index.get_geo_index()
+
+async def run_warm_up():
+    try:
+        await asyncio.to_thread(warm_up)
+    except Exception as error:
+        # whatever failed is built by the first query that needs it
+        print("Warm up failed: " + repr(error))
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global warm_up_task
+    await job_scheduler.start()
+    # runs in a thread while the server already accepts connections
+    warm_up_task = asyncio.create_task(run_warm_up())
+    yield
+    await job_scheduler.stop()
+    await amadeus_client.close()
+    session_manager.session_controller.store.close()
+    completion_cache.close()
+
+app = FastAPI(lifespan=lifespan)
 
-app = FastAPI()
+def get_cache_stats() -> dict:
+    return dict(amadeus_client.cache_stats(), flight_offers=flight_offers.cache_stats(), completions=completion_cache.cache_stats())
+
+# read when /metrics is scraped, nothing is counted on the request path for these
+metrics.registry.register(metrics.Gauge("yume_active_sessions", "Conversations held by the session store", lambda: len(session_manager.session_controller)))
+metrics.registry.register(metrics.Gauge("yume_queued_jobs", "Queries waiting for a worker", lambda: job_scheduler.queued_count))
+metrics.registry.register(metrics.CallbackCounter(
+    "yume_cache_events_total",
+    "Upstream cache lookups by outcome",
+    lambda: {
+        (cache, event): stats.get(event, 0)
+        for cache, stats in get_cache_stats().items()
+        for event in ("hits", "misses", "evictions", "expirations", "coalesced", "disk_hits")
+    },
+    ("cache", "event")
+))
 
 app.add_middleware(
     CORSMiddleware,
@@ -31,34 +107,111 @@ def create_conversation():
 @app.get("/query")
 async def query(user_query: str, conversation_id: str):
     '''
-    creates a particular query to the AI in response to a particular conversation
+    queues a particular query to the AI in response to a particular conversation
+
+    returns right away with a job id, poll /chat-status and /message (or listen on the websocket) for the result.
+    answers 429 with a Retry-After header when the conversation sends queries too fast or the LLM is overloaded
     '''
-    current_session = session_manager.session_controller.get_session(conversation_id)
+    current_session = await session_manager.session_controller.aget_session(conversation_id)
     if current_session == None:
         return {"error": "No such conversation exists"}
-    
-    await ai.handle_query(current_session, user_query=user_query)
-    return {"query": user_query}
+
+    try:
+        admission_controller.admit(conversation_id)
+    except OverloadedError as error:
+        return JSONResponse(status_code=429, content={"error": str(error)}, headers={"Retry-After": str(math.ceil(error.retry_after))})
+
+    async def run_query():
+        try:
+            if warm_up_task is not None:
+                try:
+                    # shielded, a cancelled query must not cancel the warm up of every other one
+                    await asyncio.shield(warm_up_task)
+                except asyncio.CancelledError:
+                    current_session.finish_turn(session_manager.SessionStatus.FAILED)
+                    raise
+            # ends the turn itself, with FAILED and an on_failed frame if it raises
+            await ai.handle_query(current_session, user_query=user_query)
+        finally:
+            admission_controller.release()
+
+    try:
+        job = job_scheduler.submit(conversation_id, run_query)
+    except QueueFullError as error:
+        admission_controller.release()
+        return JSONResponse(status_code=503, content={"error": str(error)})
+
+    current_session.job_queued()
+    return {"query": user_query, "job_id": job.job_id}
+
+@app.get("/job-status")
+async def get_job_status(job_id: str):
+    '''
+    returns the status of a queued query
+    '''
+    job = job_scheduler.get_job(job_id)
+    if job == None:
+        return {"error": "No such job exists"}
+    return job.to_json()
+
+def get_etag_version(request: Request) -> int:
+    '''
+    returns the session version sent back in the If-None-Match header, if any
+    '''
+    match = re.fullmatch(r'\s*(?:W/)?"(\d+)"\s*', request.headers.get("if-none-match", ""))
+    if match is None:
+        return None
+    return int(match.group(1))
+
+async def poll_session(request: Request, conversation_id: str, since_version: int, wait: float):
+    '''
+    looks up the session for a poll, holding it for up to wait seconds while the session is still at since_version
+
+    since_version defaults to the version in the If-None-Match header. returns the session and
+    the version the client already has
+    '''
+    if since_version is None:
+        since_version = get_etag_version(request)
+    if since_version is None or wait <= 0:
+        return await session_manager.session_controller.aget_session(conversation_id), since_version
+
+    current_session = await session_manager.session_controller.wait_for_change(conversation_id, since_version, min(wait, LONG_POLL_MAX_WAIT))
+    return current_session, since_version
+
+def versioned_response(current_session: session_manager.Session, since_version: int, build_body) -> Response:
+    '''
+    answers 304 when the client already has the current version of the session, the body otherwise
+    '''
+    headers = {"ETag": '"' + str(current_session.version) + '"', "Cache-Control": "no-cache"}
+    if since_version == current_session.version:
+        return Response(status_code=304, headers=headers)
+    return Response(content=build_body(), media_type="application/json", headers=headers)
 
 @app.get("/chat-status")
-async def get_conversation_status(conversation_id: str):
+async def get_conversation_status(request: Request, conversation_id: str, since_version: int = None, wait: float = 0):
     '''
     returns the conversation status (if it is still loading or completed)
+
+    pass the version from the ETag as since_version (or If-None-Match) together with wait to
+    hold the request until the session changes, 304 is returned if it did not change in time
     '''
-    current_session = session_manager.session_controller.get_session(conversation_id)
+    current_session, since_version = await poll_session(request, conversation_id, since_version, wait)
     if current_session == None:
         return {"error": "No such conversation exists"}
-    
-    return current_session.status
+
+    return versioned_response(current_session, since_version, lambda: '"' + current_session.status.value + '"')
 
 @app.websocket("/conversation/{conversation_id}")
 async def conversation_endpoint(websocket: WebSocket, conversation_id: str):
     '''
     websocket endpoint to handle the conversation between the user and the AI
-    there are three events that will be triggered by the server:
+    there are six events that will be triggered by the server:
     1. on_connect: when the client connects to the server
     2. on_loading: when the server is processing the data
-    3. on_response: when the server completes loading
+    3. on_response: the reply, streamed as delta frames and then sent whole once
+    4. on_partial_result: flights found so far by a search that is still running
+    5. on_completed: when the server completes loading, the latest message is ready
+    6. on_failed: when the query failed, nothing more comes for it
     '''
 
     def on_connected():
@@ -71,21 +224,44 @@ async def conversation_endpoint(websocket: WebSocket, conversation_id: str):
         websocket.send_text("Server completed loading")
 
     await websocket.accept()
-    current_session = session_manager.session_controller.get_session(conversation_id)
+    current_session = await session_manager.session_controller.aget_session(conversation_id)
     if current_session == None:
+        await websocket.close()
         return
     
-    current_session.set_websocket_connection(websocket)
-    await current_session.emit_message(session_manager.YumeTravelResponse(session_manager.YumeConversationResponseTypes.ON_CONNECTED, "Connected to the server"))
+    # every tab of the conversation gets its own subscription, they all receive the same events
+    subscriber = current_session.subscribe(websocket)
+    subscriber.offer(session_manager.YumeTravelResponse(session_manager.YumeConversationResponseTypes.ON_CONNECTED, "Connected to the server"))
 
-    while True:
-        event = await websocket.receive_text()
+    try:
+        while True:
+            event = await websocket.receive_text()
+    except WebSocketDisconnect:
+        pass
+    finally:
+        current_session.unsubscribe(subscriber)
 
 
-# returns the latest message in a particular conversation
+# returns the latest message in a particular conversation, long-polls like /chat-status
 @app.get("/message")
-async def read_latest_message(conversation_id: str):
-    current_session = session_manager.session_controller.get_session(conversation_id)
+async def read_latest_message(request: Request, conversation_id: str, since_version: int = None, wait: float = 0):
+    current_session, since_version = await poll_session(request, conversation_id, since_version, wait)
     if current_session == None:
         return {"error": "No such conversation exists"}
-    return {"message": current_session.get_latest_message()}
\ No newline at end of file
+    return versioned_response(current_session, since_version, current_session.get_latest_message_json)
+
+@app.get("/metrics")
+def read_metrics():
+    '''
+    stage, tool and upstream latencies plus counters in the Prometheus text format
+    '''
+    if not metrics.METRICS_ENABLED:
+        return JSONResponse(status_code=404, content={"error": "Metrics are disabled, set METRICS_ENABLED=true"})
+    return PlainTextResponse(metrics.registry.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/cache-stats")
+def read_cache_stats():
+    '''
+    returns hit/miss/eviction counters of the upstream and completion caches so TTLs can be tuned
+    '''
+    return get_cache_stats()
@@ -0,0 +1,235 @@
+'''timing spans and counters exposed in the Prometheus text format on /metrics'''
+
+import functools
+import inspect
+import os
+import time
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() in ("1", "true", "yes")
+
+# seconds, from a cache hit to a slow agent run
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+def escape_label_value(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def format_labels(label_names: tuple, label_values: tuple, extra: str = "") -> str:
+    pairs = [name + '="' + escape_label_value(value) + '"' for name, value in zip(label_names, label_values)]
+    if extra:
+        pairs.append(extra)
+    if len(pairs) == 0:
+        return ""
+    return "{" + ",".join(pairs) + "}"
+
+class Counter:
+    '''
+    a monotonically increasing value per label combination
+    '''
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, label_names: tuple = ()):
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self.values: dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, *label_values):
+        if not METRICS_ENABLED:
+            return
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def samples(self):
+        for label_values, value in self.values.items():
+            yield self.name + format_labels(self.label_names, label_values), value
+
+class Gauge:
+    '''
+    a value read from a callback when /metrics is scraped, so it costs nothing in between
+
+    the callback returns a number, or a dict from label values to numbers
+    '''
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, read, label_names: tuple = ()):
+        self.name = name
+        self.help = help
+        self.read = read
+        self.label_names = label_names
+
+    def samples(self):
+        values = self.read()
+        if not isinstance(values, dict):
+            values = {(): values}
+        for label_values, value in values.items():
+            yield self.name + format_labels(self.label_names, label_values), value
+
+class CallbackCounter(Gauge):
+    '''
+    a counter kept by another component (e.g. the cache stats), read when /metrics is scraped
+    '''
+    kind = "counter"
+
+class Histogram:
+    '''
+    counts observations into cumulative latency buckets per label combination
+    '''
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, label_names: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self.buckets = buckets
+        # label values -> [count per bucket..., count, sum]
+        self.values: dict[tuple, list] = {}
+
+    def observe(self, value: float, *label_values):
+        if not METRICS_ENABLED:
+            return
+        counts = self.values.get(label_values)
+        if counts is None:
+            counts = self.values[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[index] += 1
+                break
+        counts[-2] += 1
+        counts[-1] += value
+
+    def samples(self):
+        for label_values, counts in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                yield self.name + "_bucket" + format_labels(self.label_names, label_values, 'le="' + repr(bound) + '"'), cumulative
+            yield self.name + "_bucket" + format_labels(self.label_names, label_values, 'le="+Inf"'), counts[-2]
+            yield self.name + "_count" + format_labels(self.label_names, label_values), counts[-2]
+            yield self.name + "_sum" + format_labels(self.label_names, label_values), counts[-1]
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.append("# HELP " + metric.name + " " + metric.help)
+            lines.append("# TYPE " + metric.name + " " + metric.kind)
+            for name, value in metric.samples():
+                lines.append(name + " " + repr(float(value)))
+        return "\n".join(lines) + "\n"
+
+# Create a global instance of MetricsRegistry
+registry = MetricsRegistry()
+
+stage_seconds = registry.register(Histogram("yume_stage_seconds", "Time spent in each stage of a query", ("stage",)))
+tool_seconds = registry.register(Histogram("yume_tool_seconds", "Time spent in each tool invocation", ("tool", "outcome")))
+upstream_seconds = registry.register(Histogram("yume_upstream_request_seconds", "Time spent in upstream HTTP calls", ("service", "endpoint", "status")))
+llm_tokens = registry.register(Counter("yume_llm_tokens_total", "LLM tokens, prompt tokens are estimated", ("model_call", "kind")))
+agent_iterations = registry.register(Counter("yume_agent_iterations_total", "ReAct agent reasoning steps"))
+agent_runs = registry.register(Counter("yume_agent_runs_total", "Turns that needed the ReAct agent"))
+flight_prefetches = registry.register(Counter("yume_flight_prefetches_total", "Speculative flight searches started before the flights tool runs", ("outcome",)))
+
+class Span:
+    '''
+    times a block into a histogram, usable with both with and async with
+    '''
+    __slots__ = ("histogram", "label_values", "started_at")
+
+    def __init__(self, histogram: Histogram, label_values: tuple):
+        self.histogram = histogram
+        self.label_values = label_values
+
+    def __enter__(self):
+        self.started_at = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started_at, *self.label_values)
+
+    async def __aenter__(self):
+        return self.__enter__()
+
+    async def __aexit__(self, *exc_info):
+        self.__exit__(*exc_info)
+
+class NoopSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+NOOP_SPAN = NoopSpan()
+
+def span(stage: str):
+    '''
+    times a stage of a query, e.g. with metrics.span("summary"): ...
+    '''
+    if not METRICS_ENABLED:
+        return NOOP_SPAN
+    return Span(stage_seconds, (stage,))
+
+def http_event_hooks(service: str) -> dict:
+    '''
+    httpx event hooks timing every request of a client up to its response headers (the first
+    byte of a streamed response), labelled by the last segment of the url path
+    '''
+    if not METRICS_ENABLED:
+        return {}
+
+    async def on_request(request):
+        request.extensions["metrics_started_at"] = time.perf_counter()
+
+    async def on_response(response):
+        started_at = response.request.extensions.get("metrics_started_at")
+        if started_at is not None:
+            endpoint = response.request.url.path.rstrip("/").rsplit("/", 1)[-1]
+            upstream_seconds.observe(time.perf_counter() - started_at, service, endpoint, str(response.status_code))
+
+    return {"request": [on_request], "response": [on_response]}
+
+def instrument_tool(name: str, fn):
+    '''
+    wraps a tool function so every call is timed with its outcome, the signature and docstring the
+    agent sees stay the same. returns fn untouched when metrics are disabled
+    '''
+    if fn is None or not METRICS_ENABLED:
+        return fn
+
+    if inspect.iscoroutinefunction(fn):
+        @functools.wraps(fn)
+        async def timed_async_tool(*args, **kwargs):
+            started_at = time.perf_counter()
+            outcome = "error"
+            try:
+                result = await fn(*args, **kwargs)
+                outcome = "ok"
+                return result
+            finally:
+                tool_seconds.observe(time.perf_counter() - started_at, name, outcome)
+        return timed_async_tool
+
+    @functools.wraps(fn)
+    def timed_tool(*args, **kwargs):
+        started_at = time.perf_counter()
+        outcome = "error"
+        try:
+            result = fn(*args, **kwargs)
+            outcome = "ok"
+            return result
+        finally:
+            tool_seconds.observe(time.perf_counter() - started_at, name, outcome)
+    return timed_tool
@@ -0,0 +1,81 @@
+'''starts the flight search of a conversation in the background as soon as its slots are known'''
+
+import asyncio
+import os
+
+import dispatch
+from flight_offers import get_flight_offer_table
+import metrics
+import session_manager
+
+FLIGHT_PREFETCH_ENABLED = os.getenv("FLIGHT_PREFETCH_ENABLED", "true").lower() in ("1", "true", "yes")
+
+class FlightPrefetch:
+    '''
+    the flight search started for one set of flight slots
+
+    flight_slots are the raw origin, destination, date and adults the search was resolved from, so
+    a summary repeating them is recognized without resolving the airports again. arguments and task
+    are None when the slots name an ambiguous airport and the agent has to pick it
+    '''
+    __slots__ = ("flight_slots", "arguments", "task")
+
+    def __init__(self, flight_slots: tuple, arguments: dict = None, task: asyncio.Task = None):
+        self.flight_slots = flight_slots
+        self.arguments = arguments
+        self.task = task
+
+    def cancel(self):
+        if self.task is not None and not self.task.done():
+            self.task.cancel()
+            metrics.flight_prefetches.inc(1, "cancelled")
+
+def on_prefetch_done(task: asyncio.Task):
+    # nobody may ever await a prefetch, its failure is logged here instead of being reported as never retrieved
+    if not task.cancelled() and task.exception() is not None:
+        metrics.flight_prefetches.inc(1, "failed")
+        print("Flight prefetch failed: " + repr(task.exception()))
+
+def prefetch_flights(current_session: session_manager.Session, slots: dict) -> FlightPrefetch:
+    '''
+    starts the flight search for complete flight slots, cancelling the search of slots that changed since
+
+    the table lands in the flight offer cache, so the flights tool called on a later turn (or by the
+    agent) finds it there or joins the request still in flight instead of waiting for Amadeus
+    '''
+    if not FLIGHT_PREFETCH_ENABLED or not dispatch.has_flight_slots(slots):
+        return current_session.flight_prefetch
+
+    flight_slots = (slots["origin"], slots["destination"], slots["date"], slots.get("adults", 1))
+    prefetch = current_session.flight_prefetch
+    if prefetch is not None and prefetch.flight_slots == flight_slots:
+        return prefetch
+
+    arguments = dispatch.flight_search_arguments(slots)
+    task = None
+    # a search already shown in the conversation is not fetched again
+    if arguments is not None and dispatch.ToolCall("add_possible_flights_text", arguments).key() not in current_session.dispatched_tool_calls:
+        # must run on the event loop, a tool running in an executor thread raises here before the session is touched
+        task = asyncio.get_running_loop().create_task(get_flight_offer_table(**arguments))
+        task.add_done_callback(on_prefetch_done)
+        metrics.flight_prefetches.inc(1, "started")
+
+    if prefetch is not None:
+        prefetch.cancel()
+    prefetch = current_session.flight_prefetch = FlightPrefetch(flight_slots, arguments if task is not None else None, task)
+    return prefetch
+
+def prefetch_from_text(current_session: session_manager.Session, text: str, partial: bool = False) -> FlightPrefetch:
+    '''
+    prefetches the flights for the slots of the session context and a summary, the same slots the dispatcher reads
+
+    a summary still being generated (partial) has to name every flight slot itself, adults included.
+    until then its first lines mixed with the slots of the previous turn, or the default of 1 adult
+    before the adults line, would only start searches nobody asked for
+    '''
+    summary_slots = dispatch.extract_slots(text)
+    if partial and not (dispatch.has_flight_slots(summary_slots) and "adults" in summary_slots):
+        return current_session.flight_prefetch
+    slots = dispatch.extract_slots(current_session.context)
+    slots.update(summary_slots)
+    return prefetch_flights(current_session, slots)
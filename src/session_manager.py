@@ -1,17 +1,39 @@
+import asyncio
 from enum import Enum
 
 from fastapi import WebSocket
 import json
 
+from broadcaster import SessionBroadcaster, Subscriber
+from chat_history import ChatHistory
+import session_store
+from utilities import ConversationalMessageResponse
+
 class YumeConversationResponseTypes(str, Enum):
     ON_CONNECTED = "on_connected"
     ON_LOADING = "on_loading"
     ON_RESPONSE = "on_response"
+    ON_PARTIAL_RESULT = "on_partial_result"
+    ON_COMPLETED = "on_completed"
+    ON_FAILED = "on_failed"
 
 class YumeTravelResponse:
-    def __init__(self, type: YumeConversationResponseTypes):
+    '''
+    a single frame sent over the conversation websocket
+
+    is_delta marks an incremental chunk of a reply that is still being generated,
+    the final frame of a reply carries the whole assembled text with is_delta set to False.
+    partial results carry the constructed response (a dict) instead of text. on_completed has no
+    response, it tells the client the whole turn (tools and agent included) is done and the latest
+    message can be fetched. on_failed ends a turn that raised instead
+    '''
+    __slots__ = ("type", "response", "is_delta", "_json")
+
+    def __init__(self, type: YumeConversationResponseTypes, response: str | dict = "", is_delta: bool = False):
         self.type = type
-        self.responses = []
+        self.response = response
+        self.is_delta = is_delta
+        self._json = None
 
     def get_type(self):
         return self.type
@@ -20,89 +42,275 @@ class YumeTravelResponse:
         return self.response
 
     def to_json(self):
-        return json.dumps({
-            "type": self.type,
-            "response": self.response
-        })
+        # a frame is rendered once however many subscribers it is sent to
+        if self._json is None:
+            self._json = json.dumps({
+                "type": self.type,
+                "response": self.response,
+                "delta": self.is_delta
+            })
+        return self._json
     
 
 class Message:
+    __slots__ = ("role", "content", "responses", "_responses_json")
+
     def __init__(self, role: str, content: str):
         self.role = role
         self.content = content #the text content of the message
-        self.responses = [] #all the responses packed inside the message
+        self.responses: list[ConversationalMessageResponse] = [] #all the responses packed inside the message
+        self._responses_json = None #the serialized responses, dropped whenever one is added
+
+    def add_response(self, response: ConversationalMessageResponse):
+        self.responses.append(response)
+        self._responses_json = None
+
+    def replace_response(self, response_index: int, response: ConversationalMessageResponse):
+        self.responses[response_index] = response
+        self._responses_json = None
 
     def to_history(self):
         return "[" + self.role + "]: " + self.content + "\n"
     
     def to_json(self):
-        return self.responses
+        return [response.construct() for response in self.responses]
+
+    def responses_json(self) -> str:
+        '''
+        the serialized responses, built from the cached form of each response and kept until the next one is added
+        '''
+        if self._responses_json is None:
+            self._responses_json = "[" + ", ".join(response.to_json() for response in self.responses) + "]"
+        return self._responses_json
 
 class SessionStatus(str, Enum):
     LOADING = "LOADING"
     COMPLETED = "COMPLETED"
+    FAILED = "FAILED"
 
 class Session:
+    __slots__ = (
+        "conversation_id", "messages", "status", "context", "broadcaster", "history", "dispatched_tool_calls",
+        "agent_slots", "flight_search", "flight_prefetch", "pending_jobs", "version", "store", "_changed", "_latest_message_json"
+    )
+
     def __init__(self, conversation_id: str, messages: list[Message]):
         self.conversation_id = conversation_id
         self.messages = messages
         self.status = SessionStatus.LOADING
         self.context = ""
-        self.websocket_connection = None
+        self.broadcaster = SessionBroadcaster()
+        self.history = ChatHistory()
+        self.dispatched_tool_calls = set() # tool calls the pre-dispatch stage already ran for this session
+        self.agent_slots = None # the slots the agent was last run with
+        self.flight_search = None # arguments of the latest flight search, refinements re-rank its offers
+        self.flight_prefetch = None # the flight search started in the background once the flight slots were known
+        self.pending_jobs = 0 # queries of this session queued or running in this process
+        self.version = 0 # bumped on every change so stores and pollers can tell when the session moved on
+        self.store = None # the SessionStore persisting this session, if any
+        self._changed = None # event set on the next change, created by the first long-poll waiting for it
+        self._latest_message_json = (-1, None) # the serialized latest message and the version it was rendered at
+
+    # every change to the persisted state goes through the methods below so the store sees it
+
+    def add_message(self, message: Message):
+        self.messages.append(message)
+        self.mark_changed()
+        if self.store:
+            self.store.on_message_added(self, len(self.messages) - 1)
+
+    def append_to_latest_message(self, text: str):
+        self.messages[-1].content += text
+        self.mark_changed()
+        if self.store:
+            self.store.on_message_content_changed(self, len(self.messages) - 1)
+
+    def add_response(self, response: ConversationalMessageResponse, message_index: int = -1):
+        '''
+        packs a response into a message, the latest one unless message_index says otherwise
+        '''
+        message_index = message_index % len(self.messages)
+        self.messages[message_index].add_response(response)
+        self.mark_changed()
+        if self.store:
+            self.store.on_response_added(self, message_index, len(self.messages[message_index].responses) - 1)
+
+    def replace_response(self, response: ConversationalMessageResponse, message_index: int, response_index: int):
+        '''
+        swaps a response for a newer version of it, e.g. the ranking of a search whose results are still coming in
+        '''
+        message_index = message_index % len(self.messages)
+        self.messages[message_index].replace_response(response_index, response)
+        self.mark_changed()
+        if self.store:
+            # stored by its position, so writing it again replaces the older version
+            self.store.on_response_added(self, message_index, response_index)
+
+    def set_status(self, status: "SessionStatus"):
+        self.status = status
+        self.mark_changed()
+        if self.store:
+            self.store.on_session_changed(self)
+
+    def job_queued(self):
+        '''
+        a query of the session was queued, the session is loading until every queued query finished
+        '''
+        self.pending_jobs += 1
+        self.set_status(SessionStatus.LOADING)
 
-    def set_websocket_connection(self, websocket_connection: WebSocket):
-        self.websocket_connection = websocket_connection
+    def finish_turn(self, status: "SessionStatus"):
+        '''
+        a query is done, the status only leaves LOADING once no other query of the session is still queued or running
+        '''
+        self.pending_jobs = max(self.pending_jobs - 1, 0)
+        if self.pending_jobs == 0:
+            self.set_status(status)
 
-    async def emit_message(self, message: YumeTravelResponse):
-        if self.websocket_connection:
-            await self.websocket_connection.send_text(message.to_json())
+    def set_context(self, context: str):
+        self.context = context
+        self.mark_changed()
+        if self.store:
+            self.store.on_session_changed(self)
+
+    def add_dispatched_tool_call(self, key: tuple):
+        self.dispatched_tool_calls.add(key)
+        self.mark_changed()
+        if self.store:
+            self.store.on_session_changed(self)
+
+    def set_agent_slots(self, slots: dict):
+        self.agent_slots = slots
+        self.mark_changed()
+        if self.store:
+            self.store.on_session_changed(self)
+
+    def set_flight_search(self, flight_search: dict):
+        self.flight_search = flight_search
+        self.mark_changed()
+        if self.store:
+            self.store.on_session_changed(self)
+
+    def mark_changed(self):
+        '''
+        moves the session to a new version and wakes up the requests long-polling for it
+        '''
+        self.version += 1
+        self.notify_changed()
+
+    def notify_changed(self):
+        if self._changed is not None:
+            self._changed.set()
+            self._changed = None
+
+    async def wait_for_change(self, since_version: int, timeout: float) -> bool:
+        '''
+        waits until the session moves past since_version or the timeout runs out, returns whether it moved
+        '''
+        if self.version != since_version:
+            return True
+        if self._changed is None:
+            self._changed = asyncio.Event()
+        try:
+            await asyncio.wait_for(self._changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        return self.version != since_version
+
+    def subscribe(self, websocket_connection: WebSocket) -> Subscriber:
+        return self.broadcaster.subscribe(websocket_connection)
+
+    def unsubscribe(self, subscriber: Subscriber):
+        self.broadcaster.unsubscribe(subscriber)
+
+    def emit_message(self, message: YumeTravelResponse):
+        '''
+        queues the message for every websocket of the session, never waits on the network
+        '''
+        self.broadcaster.publish(message)
 
     def get_latest_message(self) -> str:
         if len(self.messages) > 0:
             return self.messages[-1].to_json()
         return ""
+
+    def get_latest_message_json(self) -> str:
+        '''
+        the serialized latest message, rendered once per version no matter how often it is polled
+        '''
+        version, rendered = self._latest_message_json
+        if version != self.version:
+            message_json = self.messages[-1].responses_json() if len(self.messages) > 0 else '""'
+            rendered = '{"message": ' + message_json + ', "version": ' + str(self.version) + '}'
+            self._latest_message_json = (self.version, rendered)
+        return rendered
     
     def get_chat_history(self) -> str:
-        chat_history = ""
-        for message in self.messages[:-1]:
-            chat_history += message.to_history()
-        return chat_history
+        # every message but the last one is finalized, feed the ones the history has not seen yet
+        while self.history.appended_count < len(self.messages) - 1:
+            self.history.append(self.messages[self.history.appended_count].to_history())
+        return self.history.render()
 
 class SessionController:
     '''
         Controls all the existing sessions
+
+        the sessions themselves live in a SessionStore, in memory by default or in SQLite
+        (SESSION_STORE=sqlite) so every worker process sees the same conversations
     '''
-    def __init__(self):
-        self.sessions = []
+    def __init__(self, store: session_store.SessionStore = None):
+        self.store = store if store is not None else session_store.create_session_store()
+
+    def __len__(self) -> int:
+        return len(self.store)
+
+    def __contains__(self, conversation_id: str) -> bool:
+        return self.store.get(conversation_id) is not None
 
     def create_session(self, conversation_id: str) -> Session:
-        session = Session(conversation_id, [])
-        self.sessions.append(session)
-        return session
+        return self.store.create(conversation_id)
     
     def delete_session(self, conversation_id: str):
-        for session in self.sessions:
-            if session.conversation_id == conversation_id:
-                self.sessions.remove(session)
-                return
+        self.store.delete(conversation_id)
 
     def get_session(self, conversation_id: str) -> Session:
-        for session in self.sessions:
-            if session.conversation_id == conversation_id:
+        return self.store.get(conversation_id)
+
+    async def aget_session(self, conversation_id: str) -> Session:
+        '''
+        get_session for request handlers, a store that has to re-read the session does it off the event loop
+        '''
+        return await self.store.aget(conversation_id)
+
+    async def wait_for_change(self, conversation_id: str, since_version: int, timeout: float) -> Session:
+        '''
+        holds a poll until the session moves past since_version or the timeout runs out
+
+        changes made by this process wake the poll right away, stores shared with other
+        processes are re-checked every poll_interval seconds
+        '''
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while True:
+            session = await self.aget_session(conversation_id)
+            remaining = deadline - loop.time()
+            if session is None or session.version != since_version or remaining <= 0:
                 return session
-        return None
+            if self.store.poll_interval is not None:
+                remaining = min(remaining, self.store.poll_interval)
+            await session.wait_for_change(since_version, remaining)
 
     def send_message(self, conversation_id: str, type: YumeConversationResponseTypes, message: str):
-        for session in self.sessions:
-            if session.conversation_id == conversation_id:
-                session.emit_message(YumeTravelResponse(type, message))
-                return
-
-    def add_message(self, conversation_id: str, message: str):
-        for session in self.sessions:
-            if session.conversation_id == conversation_id:
-                session.messages.append(message)
-                return
+        session = self.get_session(conversation_id)
+        if session == None:
+            return
+        return session.emit_message(YumeTravelResponse(type, message))
+
+    def add_message(self, conversation_id: str, message: Message):
+        session = self.get_session(conversation_id)
+        if session == None:
+            return
+        session.add_message(message)
     
 # Create a global instance of SessionController
 session_controller = SessionController()
@@ -0,0 +1,439 @@
+'''storage backends for the conversation sessions'''
+
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+
+SESSION_STORE = os.getenv("SESSION_STORE", "memory")
+SESSION_DB_PATH = os.getenv("SESSION_DB_PATH", "sessions.db")
+SESSION_STORE_FLUSH_INTERVAL = float(os.getenv("SESSION_STORE_FLUSH_INTERVAL", "0.05"))
+SESSION_STORE_FLUSH_BATCH_SIZE = int(os.getenv("SESSION_STORE_FLUSH_BATCH_SIZE", "500"))
+SESSION_STORE_REFRESH_INTERVAL = float(os.getenv("SESSION_STORE_REFRESH_INTERVAL", "0.2"))
+SESSION_STORE_MAX_FLUSH_ATTEMPTS = int(os.getenv("SESSION_STORE_MAX_FLUSH_ATTEMPTS", "3"))
+
+# columns added to the sessions table after it was first created, with their definition
+SESSION_COLUMNS = {
+    "flight_search": "TEXT NOT NULL DEFAULT ''",
+    "dispatched_tool_calls": "TEXT NOT NULL DEFAULT ''",
+    "agent_slots": "TEXT NOT NULL DEFAULT ''",
+}
+
+class SessionStore:
+    '''
+    interface every session backend implements
+
+    create/get/delete manage whole sessions, the on_* hooks are called by Session whenever
+    its persisted state changes so the backend can write the change out
+
+    poll_interval is how often a long-poll has to re-check a session, None when every change
+    happens in this process and wakes the poll by itself
+    '''
+    poll_interval = None
+
+    def create(self, conversation_id: str):
+        raise NotImplementedError
+
+    def get(self, conversation_id: str):
+        raise NotImplementedError
+
+    async def aget(self, conversation_id: str):
+        '''
+        get for the event loop, backends that have to read a database do it in a thread
+        '''
+        return self.get(conversation_id)
+
+    def delete(self, conversation_id: str):
+        raise NotImplementedError
+
+    def __len__(self) -> int:
+        raise NotImplementedError
+
+    def on_session_changed(self, session):
+        pass
+
+    def on_message_added(self, session, message_index: int):
+        pass
+
+    def on_message_content_changed(self, session, message_index: int):
+        pass
+
+    def on_response_added(self, session, message_index: int, response_index: int):
+        pass
+
+    def close(self):
+        pass
+
+class InMemorySessionStore(SessionStore):
+    '''
+    keeps the sessions in a dict of this process, indexed by conversation id
+
+    lookups and removals are O(1) regardless of how many conversations are alive. a re-entrant
+    lock guards the index so the store can be shared between asyncio tasks and worker threads
+    '''
+    def __init__(self):
+        self.sessions = {}
+        self._lock = threading.RLock()
+
+    def create(self, conversation_id: str):
+        import session_manager
+
+        session = session_manager.Session(conversation_id, [])
+        session.store = self
+        with self._lock:
+            self.sessions[conversation_id] = session
+        return session
+
+    def get(self, conversation_id: str):
+        # dict reads are atomic under the GIL, so lookups don't need to take the lock
+        return self.sessions.get(conversation_id)
+
+    def delete(self, conversation_id: str):
+        with self._lock:
+            self.sessions.pop(conversation_id, None)
+
+    def __len__(self) -> int:
+        return len(self.sessions)
+
+class SQLiteSessionStore(SessionStore):
+    '''
+    shares the sessions between worker processes through a local SQLite database in WAL mode
+
+    every process keeps the sessions it touched in memory. changes are queued and written
+    behind by a background thread in one transaction per batch, so appending messages and
+    responses never waits on the disk. a get re-reads a session only when another process
+    moved its version past the local one (checked at most every SESSION_STORE_REFRESH_INTERVAL).
+    aget does that read in a thread, the requests and long-polls of the server go through it
+
+    the job queue runs the queries of a conversation one after the other, but only within one
+    process. two workers running queries of the same conversation at the same time both append
+    at the message index they loaded, and the last write replaces the other. the load balancer
+    has to route a conversation to a single worker (e.g. by hashing conversation_id) to rule that out
+    '''
+    def __init__(self, path: str = SESSION_DB_PATH, flush_interval: float = SESSION_STORE_FLUSH_INTERVAL, batch_size: int = SESSION_STORE_FLUSH_BATCH_SIZE, refresh_interval: float = SESSION_STORE_REFRESH_INTERVAL):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.refresh_interval = refresh_interval
+        self.poll_interval = refresh_interval
+        self.sessions = {}
+        self._checked_at = {}
+        self._lock = threading.RLock()
+
+        self._write_connection = self._connect()
+        self._write_lock = threading.Lock()
+        self._read_connection = self._connect()
+        self._read_lock = threading.Lock()
+        self._create_tables()
+
+        # inserts must keep their order, updates of the same row are coalesced to the latest one
+        self._pending_inserts = []
+        self._pending_updates = {}
+        self._pending_lock = threading.Lock()
+        self._failed_flushes = 0 # flushes failed in a row, the batch is written statement by statement after max_flush_attempts
+        self.max_flush_attempts = SESSION_STORE_MAX_FLUSH_ATTEMPTS
+        self.dropped_writes = 0
+        self._flush_requested = threading.Event()
+        self._closed = False
+        self._flusher = threading.Thread(target=self._flush_loop, name="session-store-flusher", daemon=True)
+        self._flusher.start()
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=30)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        return connection
+
+    def _create_tables(self):
+        with self._write_lock:
+            self._write_connection.executescript("""
+                CREATE TABLE IF NOT EXISTS sessions (
+                    conversation_id TEXT PRIMARY KEY,
+                    status TEXT NOT NULL,
+                    context TEXT NOT NULL,
+                    version INTEGER NOT NULL,
+                    flight_search TEXT NOT NULL DEFAULT '',
+                    dispatched_tool_calls TEXT NOT NULL DEFAULT '',
+                    agent_slots TEXT NOT NULL DEFAULT ''
+                );
+                CREATE TABLE IF NOT EXISTS messages (
+                    conversation_id TEXT NOT NULL,
+                    message_index INTEGER NOT NULL,
+                    role TEXT NOT NULL,
+                    content TEXT NOT NULL,
+                    PRIMARY KEY (conversation_id, message_index)
+                );
+                CREATE TABLE IF NOT EXISTS responses (
+                    conversation_id TEXT NOT NULL,
+                    message_index INTEGER NOT NULL,
+                    response_index INTEGER NOT NULL,
+                    body TEXT NOT NULL,
+                    PRIMARY KEY (conversation_id, message_index, response_index)
+                );
+            """)
+            columns = {row[1] for row in self._write_connection.execute("PRAGMA table_info(sessions)")}
+            for column, definition in SESSION_COLUMNS.items():
+                if column in columns:
+                    continue
+                # a database created before the column was stored, another worker may be adding it too
+                try:
+                    self._write_connection.execute("ALTER TABLE sessions ADD COLUMN " + column + " " + definition)
+                except sqlite3.OperationalError:
+                    pass
+
+    def __len__(self) -> int:
+        with self._read_lock:
+            return self._read_connection.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+    def create(self, conversation_id: str):
+        import session_manager
+
+        session = session_manager.Session(conversation_id, [])
+        session.store = self
+        with self._lock:
+            self.sessions[conversation_id] = session
+            self._checked_at[conversation_id] = time.monotonic()
+        self.on_session_changed(session)
+        # written through right away, the next request of this conversation may land on another worker
+        self.flush()
+        return session
+
+    def _cached(self, conversation_id: str):
+        '''
+        the local session if it was checked against the database less than refresh_interval ago
+        '''
+        session = self.sessions.get(conversation_id)
+        if session is not None and time.monotonic() - self._checked_at.get(conversation_id, 0.0) < self.refresh_interval:
+            return session
+        return None
+
+    def get(self, conversation_id: str):
+        session = self._cached(conversation_id)
+        if session is not None:
+            return session
+        return self._apply(conversation_id, self._fetch(conversation_id))
+
+    async def aget(self, conversation_id: str):
+        session = self._cached(conversation_id)
+        if session is not None:
+            return session
+        return self._apply(conversation_id, await asyncio.to_thread(self._fetch, conversation_id))
+
+    def _fetch(self, conversation_id: str) -> tuple:
+        '''
+        reads the session row, and its messages and responses if the local copy is behind it
+
+        only reads, so it may run in a thread. the row is None if the session does not exist
+        '''
+        session = self.sessions.get(conversation_id)
+        local_version = session.version if session is not None else -1
+        with self._read_lock:
+            row = self._read_connection.execute(
+                "SELECT status, context, version, flight_search, dispatched_tool_calls, agent_slots FROM sessions WHERE conversation_id = ?", (conversation_id,)
+            ).fetchone()
+            if row is None or row[2] <= local_version:
+                return row, None, None
+            message_rows = self._read_connection.execute(
+                "SELECT role, content FROM messages WHERE conversation_id = ? ORDER BY message_index", (conversation_id,)
+            ).fetchall()
+            response_rows = self._read_connection.execute(
+                "SELECT message_index, body FROM responses WHERE conversation_id = ? ORDER BY message_index, response_index", (conversation_id,)
+            ).fetchall()
+        return row, message_rows, response_rows
+
+    def _apply(self, conversation_id: str, rows: tuple):
+        '''
+        brings the local session up to the rows read by _fetch, on the thread that owns the session
+        '''
+        row, message_rows, response_rows = rows
+        if row is None:
+            # never created, or deleted by another worker
+            with self._lock:
+                self.sessions.pop(conversation_id, None)
+                self._checked_at.pop(conversation_id, None)
+            return None
+
+        with self._lock:
+            session = self.sessions.get(conversation_id)
+            if session is None:
+                import session_manager
+
+                session = session_manager.Session(conversation_id, [])
+                session.store = self
+                session.version = -1
+                self.sessions[conversation_id] = session
+            # this process may have moved the session on while the rows were read
+            if message_rows is not None and row[2] > session.version:
+                self._load(session, row, message_rows, response_rows)
+            self._checked_at[conversation_id] = time.monotonic()
+        return session
+
+    def _load(self, session, session_row, message_rows: list, response_rows: list):
+        '''
+        refreshes a session in place from the database, references held by running jobs stay valid
+
+        the flight prefetch is a task of this process, it is kept and only reused if the slots match
+        '''
+        import session_manager
+        from chat_history import ChatHistory
+        from utilities import response_from_json
+
+        messages = [session_manager.Message(role, content) for role, content in message_rows]
+        for message_index, body in response_rows:
+            if message_index < len(messages):
+                messages[message_index].add_response(response_from_json(json.loads(body)))
+
+        session.messages = messages
+        session.status = session_manager.SessionStatus(session_row[0])
+        session.context = session_row[1]
+        session.version = session_row[2]
+        session.flight_search = json.loads(session_row[3]) if session_row[3] else None
+        # json turns the key tuples (name, (argument, value), ...) into lists
+        session.dispatched_tool_calls = {
+            (key[0],) + tuple(tuple(item) for item in key[1:]) for key in (json.loads(session_row[4]) if session_row[4] else [])
+        }
+        session.agent_slots = json.loads(session_row[5]) if session_row[5] else None
+        session.history = ChatHistory()
+        session.notify_changed()
+
+    def delete(self, conversation_id: str):
+        with self._lock:
+            session = self.sessions.pop(conversation_id, None)
+            self._checked_at.pop(conversation_id, None)
+        if session is not None:
+            # a job still running on the session must not write it back
+            session.store = None
+        with self._pending_lock:
+            # updates run after the inserts, they would create the deleted session again
+            self._pending_updates = {key: statement for key, statement in self._pending_updates.items() if key[1] != conversation_id}
+            for table in ("responses", "messages", "sessions"):
+                self._pending_inserts.append(("DELETE FROM " + table + " WHERE conversation_id = ?", (conversation_id,)))
+        self.flush()
+
+    def on_session_changed(self, session):
+        self._queue_update(("session", session.conversation_id), (
+            "INSERT INTO sessions (conversation_id, status, context, version, flight_search, dispatched_tool_calls, agent_slots) VALUES (?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (conversation_id) DO UPDATE SET status = excluded.status, context = excluded.context, version = excluded.version, "
+            "flight_search = excluded.flight_search, dispatched_tool_calls = excluded.dispatched_tool_calls, agent_slots = excluded.agent_slots",
+            (
+                session.conversation_id,
+                session.status.value,
+                session.context,
+                session.version,
+                json.dumps(session.flight_search) if session.flight_search else "",
+                json.dumps(sorted(session.dispatched_tool_calls, key=repr)) if session.dispatched_tool_calls else "",
+                json.dumps(session.agent_slots) if session.agent_slots is not None else ""
+            )
+        ))
+
+    def on_message_added(self, session, message_index: int):
+        message = session.messages[message_index]
+        self._queue_insert((
+            "INSERT OR REPLACE INTO messages (conversation_id, message_index, role, content) VALUES (?, ?, ?, ?)",
+            (session.conversation_id, message_index, message.role, message.content)
+        ))
+        self.on_session_changed(session)
+
+    def on_message_content_changed(self, session, message_index: int):
+        self._queue_update(("content", session.conversation_id, message_index), (
+            "UPDATE messages SET content = ? WHERE conversation_id = ? AND message_index = ?",
+            (session.messages[message_index].content, session.conversation_id, message_index)
+        ))
+        self.on_session_changed(session)
+
+    def on_response_added(self, session, message_index: int, response_index: int):
+        self._queue_insert((
+            "INSERT OR REPLACE INTO responses (conversation_id, message_index, response_index, body) VALUES (?, ?, ?, ?)",
+            (session.conversation_id, message_index, response_index, session.messages[message_index].responses[response_index].to_json())
+        ))
+        self.on_session_changed(session)
+
+    def _queue_insert(self, statement: tuple):
+        with self._pending_lock:
+            self._pending_inserts.append(statement)
+            pending_count = len(self._pending_inserts)
+        if pending_count >= self.batch_size:
+            self._flush_requested.set()
+
+    def _queue_update(self, key: tuple, statement: tuple):
+        with self._pending_lock:
+            # move the key to the end so the update runs after the inserts it depends on
+            self._pending_updates.pop(key, None)
+            self._pending_updates[key] = statement
+
+    def flush(self):
+        '''
+        writes every queued change in a single transaction
+
+        a failed batch stays queued for the next flush. once max_flush_attempts flushes failed in a
+        row, each statement gets its own savepoint and the ones that still fail are dropped (and
+        logged), so a single bad statement cannot hold back every later write
+        '''
+        with self._write_lock:
+            with self._pending_lock:
+                statements = self._pending_inserts + list(self._pending_updates.values())
+                self._pending_inserts = []
+                self._pending_updates = {}
+            if len(statements) == 0:
+                return
+            isolate = self._failed_flushes >= self.max_flush_attempts
+            try:
+                self._write_connection.execute("BEGIN IMMEDIATE")
+            except Exception:
+                # e.g. another worker holding the lock for longer than the timeout, nothing was written
+                self._requeue(statements)
+                raise
+            try:
+                for sql, parameters in statements:
+                    if isolate:
+                        self._execute_or_drop(sql, parameters)
+                    else:
+                        self._write_connection.execute(sql, parameters)
+                self._write_connection.execute("COMMIT")
+            except Exception:
+                self._write_connection.execute("ROLLBACK")
+                self._requeue(statements)
+                raise
+            self._failed_flushes = 0
+
+    def _requeue(self, statements: list):
+        # keep the changes queued (in their original order) for the next attempt
+        self._failed_flushes += 1
+        with self._pending_lock:
+            self._pending_inserts = statements + self._pending_inserts
+
+    def _execute_or_drop(self, sql: str, parameters: tuple):
+        self._write_connection.execute("SAVEPOINT statement")
+        try:
+            self._write_connection.execute(sql, parameters)
+        except sqlite3.Error as error:
+            self._write_connection.execute("ROLLBACK TO statement")
+            self.dropped_writes += 1
+            print("Dropped a session write after " + str(self._failed_flushes) + " failed flushes: " + repr(error) + " in " + sql + " " + repr(parameters)[:200])
+        self._write_connection.execute("RELEASE statement")
+
+    def _flush_loop(self):
+        while not self._closed:
+            self._flush_requested.wait(self.flush_interval)
+            self._flush_requested.clear()
+            try:
+                self.flush()
+            except Exception as error:
+                print("Failed to write sessions: " + repr(error))
+
+    def close(self):
+        self._closed = True
+        self._flush_requested.set()
+        self._flusher.join()
+        self.flush()
+        self._write_connection.close()
+        self._read_connection.close()
+
+def create_session_store() -> SessionStore:
+    if SESSION_STORE == "sqlite":
+        return SQLiteSessionStore()
+    if SESSION_STORE == "memory":
+        return InMemorySessionStore()
+    raise ValueError("Unknown SESSION_STORE " + SESSION_STORE + ", use memory or sqlite")
@@ -14,51 +14,62 @@ class ConversationalMessageResponseType(str):
     POSSIBLE_PLACES_TO_STAY = "possible_places_to_stay"
 
 class ConversationalMessageResponse:
-    def __init__(self, type: ConversationalMessageResponseType):
+    '''
+    base of every typed response packed inside a message
+
+    responses never change once built, so the serialized form is rendered on first use and kept
+    '''
+    __slots__ = ("type", "content", "_json")
+
+    def __init__(self, type: ConversationalMessageResponseType, content):
         self.type = type
+        self.content = content
+        self._json = None
 
-class SummaryMessage(ConversationalMessageResponse):
-    def __init__(self, summary: str):
-        super().__init__(ConversationalMessageResponseType.SUMMARY)
-        self.content = summary
-    
-    def construct(self):
+    def construct(self) -> dict:
         return {
             "type": self.type,
             "content": self.content
         }
 
+    def to_json(self) -> str:
+        if self._json is None:
+            self._json = json.dumps(self.construct())
+        return self._json
+
+class SummaryMessage(ConversationalMessageResponse):
+    __slots__ = ()
+
+    def __init__(self, summary: str):
+        super().__init__(ConversationalMessageResponseType.SUMMARY, summary)
+
 class PossiblePlacesMessage(ConversationalMessageResponse):
+    __slots__ = ()
+
     def __init__(self, places: list):
-        super().__init__(ConversationalMessageResponseType.POSSIBLE_PLACES)
-        self.content = places
-    
-    def construct(self):
-        return{
-            "type": self.type,
-            "content": self.content
-        }
+        super().__init__(ConversationalMessageResponseType.POSSIBLE_PLACES, places)
     
 class PossibleFlightsMessage(ConversationalMessageResponse):
+    __slots__ = ()
+
     def __init__(self, flights: list):
-        super().__init__(ConversationalMessageResponseType.POSSIBLE_FLIGHTS)
-        self.content = flights
-    
-    def construct(self):
-        return {
-            "type": self.type,
-            "content": self.content
-        }
+        super().__init__(ConversationalMessageResponseType.POSSIBLE_FLIGHTS, flights)
 
 class PossiblePlacesToStayMessage(ConversationalMessageResponse):
+    __slots__ = ()
+
     def __init__(self, places: list[str]):
-        super().__init__(ConversationalMessageResponseType.POSSIBLE_PLACES_TO_STAY)
-        self.content = places
-    
-    def to_json(self):
-        return {
-            "type": self.type,
-            "content": list(self.content)
-       }
-    
-    
\ No newline at end of file
+        super().__init__(ConversationalMessageResponseType.POSSIBLE_PLACES_TO_STAY, list(places))
+
+RESPONSE_TYPES = {
+    ConversationalMessageResponseType.SUMMARY: SummaryMessage,
+    ConversationalMessageResponseType.POSSIBLE_PLACES: PossiblePlacesMessage,
+    ConversationalMessageResponseType.POSSIBLE_FLIGHTS: PossibleFlightsMessage,
+    ConversationalMessageResponseType.POSSIBLE_PLACES_TO_STAY: PossiblePlacesToStayMessage,
+}
+
+def response_from_json(data: dict) -> ConversationalMessageResponse:
+    '''
+    rebuilds a typed response from its constructed form
+    '''
+    return RESPONSE_TYPES[data["type"]](data["content"])